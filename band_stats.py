@@ -0,0 +1,211 @@
+'''
++
+=======================================================================
+
+ NAME:
+      band_stats
+
+ DESCRIPTION:
+	per-band statistics of a cube gathered while it is written.
+- BandStats.add() takes the tiles as they are fused, on any number of threads,
+and keeps for every band the pixel count, minimum, maximum, sum and sum of squares
+(exact integers for integer data, so the result does not depend on the tile size,
+the number of workers or the order the tiles finish in) and a histogram of
+hist_bins fixed-width bins
+- the histograms are taken on every hist_step-th row and column of the cube (the
+same pixels whatever the tiling); hist_step = 1 counts every pixel
+- mean and standard deviation follow from the sums; percentiles are interpolated
+from the histogram
+- write_stats() puts min, max, mean and standard deviation of every band into the
+ENVI header ('band minimum', 'band maximum', 'band mean', 'band stddev') and all of
+it, histograms included, into the sidecar <base>_stats.json; load_stats() reads the
+sidecar back
+- output_stats() and save_stats() are the statistics of a fused cube and their saving,
+to the header of an ENVI cube or to the metadata of a chunked store
+
+ USES:
+numpy
+json, threading
+spectral (from the python package spectral), for the header
+
+ NOTES:
+values outside the histogram range are counted in the first or last bin; the
+minimum and maximum are exact regardless.
+
+ HISTORY:
+2026/10/17: created
+
+=======================================================================
+-
+'''
+
+import numpy as np
+import json
+import os
+import threading
+
+# bins of the histograms kept for each band
+hist_bins = 256
+# the histograms are taken on every hist_step-th row and column
+hist_step = 4
+# pixels per block the moments are accumulated over
+block_pixels = 256
+
+
+def stats_path(path):
+    # <base>_stats.json next to an output given as .hdr or as a .zcube store
+    base = os.path.splitext(path)[0] if path.lower().endswith(('.hdr', '.zcube')) else path
+    return base + '_stats.json'
+
+
+class BandStats:
+    '''
+    Running statistics of the bands of a [rows, cols, bands] cube; value_range is
+    the (low, high) range the histograms cover.
+    '''
+
+    def __init__(self, nbands, value_range, bins=None, dtype='uint16', step=None):
+        self.nbands = nbands
+        self.bins = hist_bins if bins is None else bins
+        self.step = hist_step if step is None else step
+        self.value_range = (float(value_range[0]), float(value_range[1]))
+        self.exact = np.issubdtype(np.dtype(dtype), np.integer)
+        self.count = 0
+        self.minimum = np.full(nbands, np.inf)
+        self.maximum = np.full(nbands, -np.inf)
+        # python integers for integer data, they never overflow
+        self.total = np.zeros(nbands, dtype=object if self.exact else np.float64)
+        self.total_sq = np.zeros(nbands, dtype=object if self.exact else np.float64)
+        self.hist = np.zeros((nbands, self.bins), dtype=np.int64)
+        self._lock = threading.Lock()
+
+    def add(self, tile, row0=0, col0=0):
+        '''
+        Adds the [rows, cols, bands] tile whose first pixel is at row0, col0 of the
+        cube. The statistics of the tile are computed outside the lock, only their
+        merge is serialised.
+        '''
+        tile = np.asarray(tile)
+        rows, cols = tile.shape[0], tile.shape[1]
+        if rows == 0 or cols == 0:
+            return
+        # the squares of 16 bit integers fit in 32 bits, their sums in 64 bits
+        sq_dtype, acc = (np.uint32, np.uint64) if tile.dtype.itemsize <= 2 and self.exact else \
+            (np.int64, np.int64) if self.exact else (np.float64, np.float64)
+        total = np.zeros(self.nbands, dtype=acc)
+        total_sq = np.zeros(self.nbands, dtype=acc)
+        minimum, maximum = np.full(self.nbands, np.inf), np.full(self.nbands, -np.inf)
+        block_rows = max(1, block_pixels // cols)
+        sq = np.empty((block_rows * cols, self.nbands), dtype=sq_dtype)
+        for r in range(0, rows, block_rows):
+            x = tile[r:r + block_rows].reshape(-1, self.nbands)
+            x_sq = sq[:x.shape[0]]
+            np.multiply(x, x, out=x_sq, dtype=sq_dtype)
+            total += x.sum(axis=0, dtype=acc)
+            total_sq += x_sq.sum(axis=0, dtype=acc)
+            np.minimum(minimum, x.min(axis=0), out=minimum)
+            np.maximum(maximum, x.max(axis=0), out=maximum)
+        # the histogram pixels are the ones on the global hist_step grid
+        x = tile[(-row0) % self.step::self.step, (-col0) % self.step::self.step].reshape(-1, self.nbands)
+        low, high = self.value_range
+        idx = np.floor((x - low) * (self.bins / (high - low)))
+        idx = np.clip(idx, 0, self.bins - 1).astype(np.intp)
+        idx += np.arange(self.nbands, dtype=np.intp) * self.bins
+        hist = np.bincount(idx.ravel(), minlength=self.nbands * self.bins).reshape(self.nbands, self.bins)
+        with self._lock:
+            self.count += rows * cols
+            np.minimum(self.minimum, minimum, out=self.minimum)
+            np.maximum(self.maximum, maximum, out=self.maximum)
+            if self.exact:
+                total, total_sq = total.astype(object), total_sq.astype(object)
+            self.total = self.total + total
+            self.total_sq = self.total_sq + total_sq
+            self.hist += hist
+
+    def mean(self):
+        return np.array([float(t) / self.count for t in self.total]) if self.count else np.full(self.nbands, np.nan)
+
+    def std(self):
+        if not self.count:
+            return np.full(self.nbands, np.nan)
+        n = self.count
+        # n * sum(x^2) - sum(x)^2 is exact for integer data
+        return np.array([np.sqrt(max(float(n * q - t * t), 0.0)) / n for t, q in zip(self.total, self.total_sq)])
+
+    def edges(self):
+        return np.linspace(self.value_range[0], self.value_range[1], self.bins + 1)
+
+    def record(self):
+        # everything, as a dict that json can write
+        return {'count': int(self.count), 'minimum': self.minimum.tolist(), 'maximum': self.maximum.tolist(),
+                'mean': self.mean().tolist(), 'stddev': self.std().tolist(),
+                'hist_range': list(self.value_range), 'hist_bins': self.bins, 'hist_step': self.step,
+                'histogram': self.hist.tolist()}
+
+
+def percentiles(stats, q, bands=None):
+    '''
+    The q-th percentiles (0-100, scalar or list) of the bands from the histograms of
+    a stats record (load_stats / BandStats.record), interpolated within the bins and
+    kept within each band's minimum and maximum; [bands, len(q)].
+    '''
+    hist = np.asarray(stats['histogram'], dtype=np.float64)
+    low, high = stats['hist_range']
+    edges = np.linspace(low, high, stats['hist_bins'] + 1)
+    bands = np.arange(hist.shape[0]) if bands is None else np.atleast_1d(bands)
+    q = np.atleast_1d(np.asarray(q, dtype=np.float64))
+    out = np.empty((len(bands), len(q)))
+    for i, b in enumerate(bands):
+        cdf = np.concatenate([[0], np.cumsum(hist[b])])
+        cdf /= max(cdf[-1], 1)
+        out[i] = np.interp(q / 100.0, cdf, edges)
+        np.clip(out[i], stats['minimum'][b], stats['maximum'][b], out=out[i])
+    return out
+
+
+def write_stats(output_path, stats, header=True):
+    '''
+    Saves the statistics of the cube at output_path to its _stats.json sidecar and,
+    for an ENVI .hdr, to its header. Returns the sidecar path.
+    '''
+    record = stats.record()
+    sidecar = stats_path(output_path)
+    tmp_path = sidecar + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(record, f)
+    os.replace(tmp_path, sidecar)
+    if header and output_path.lower().endswith('.hdr'):
+        import spectral.io.envi as envi
+        md = envi.read_envi_header(output_path)
+        md.update(header_metadata(stats))
+        envi.write_envi_header(output_path, md)
+    return sidecar
+
+
+def header_metadata(stats):
+    # the header fields of the statistics, as ENVI lists of strings
+    fmt = (lambda v: '%d' % v) if stats.exact else (lambda v: '%.6g' % v)
+    return {'band minimum': [fmt(v) for v in stats.minimum], 'band maximum': [fmt(v) for v in stats.maximum],
+            'band mean': ['%.6g' % v for v in stats.mean()], 'band stddev': ['%.6g' % v for v in stats.std()]}
+
+
+def output_stats(plan, scale_factor):
+    # statistics of the fused uint16 cube, the histograms covering reflectance 0 to 2
+    return BandStats(plan.n_out, (0, min(2 * scale_factor, 65536)), dtype='uint16')
+
+
+def save_stats(output_path, stats, store=None):
+    # the statistics go in the header of an ENVI cube, or in the metadata of a store
+    # (before it is closed), and in the _stats.json sidecar
+    if store is not None:
+        store.metadata.update(header_metadata(stats))
+    write_stats(output_path, stats, header=store is None)
+
+
+def load_stats(path):
+    # the statistics saved by write_stats for the cube at path, None if there are none
+    sidecar = stats_path(path)
+    if not os.path.exists(sidecar):
+        return None
+    with open(sidecar) as f:
+        return json.load(f)
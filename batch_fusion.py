@@ -0,0 +1,356 @@
+'''
++
+=======================================================================
+
+ NAME:
+      batch_fusion
+
+ DESCRIPTION:
+	headless batch driver: registers and fuses many VNIR/SWIR scene pairs
+listed in a manifest, without editing any source or opening any window.
+- reads a CSV or JSON manifest of pairs
+- for pairs with a saved homography, warps the SWIR onto the VNIR grid
+(coregister_controlpoints_gui.register_headless) to <swir>_warped.hdr
+- fuses VNIR and the registered SWIR into the full spectrum cube
+(build_cube.build_cube_streamed)
+- runs the pairs on a pool of processes; each pair logs to <output>.log
+- a stage whose outputs are newer than its inputs and were made with the same
+settings (kept in <output>_params.json) is skipped; outputs are written under a
+temporary name and renamed once complete, so a crashed batch is resumed by running
+it again
+- with --incremental every output keeps a checkpoint (checkpoint.py) and is updated
+in place, recomputing only the tiles whose inputs changed
+
+ USES:
+concurrent.futures
+csv, json
+build_cube, coregister_controlpoints_gui, register_and_fuse, stage_timing, overviews, checkpoint,
+band_stats (from this repository)
+
+ PARAMETERS:
+manifest   CSV file with a header row, or JSON file with a list of objects (or
+           {"pairs": [...]}); each pair has the fields
+             vnir        VNIR ENVI header (.hdr)
+             swir        SWIR ENVI header (.hdr); the raw SWIR if a homography
+                         is given, otherwise a SWIR already registered to the VNIR
+             output      full spectrum output header (.hdr)
+             homography  (optional) homography sidecar (.json) saved by
+                         coregister_controlpoints_gui, or a 3x3 text file
+           relative paths are taken relative to the manifest
+
+ KEYWORDS:
+--jobs N         number of pairs processed at the same time (processes)
+--workers N      threads warping/fusing within each pair
+--strip-rows N   rows per warp strip and fusion tile
+--scale-factor N reflectance scale factor of the uint16 output
+--force          redo every stage even if its outputs are up to date
+--single-pass    for pairs with a homography, warp and fuse in one pass
+                 (register_and_fuse) without writing the warped SWIR cube
+--plan-dir dir   where the fusion plans are cached, shared by all the pairs
+--interleave bsq|bil|bip   layout of the fused cubes (default bip)
+--interpolation nearest|linear|cubic|lanczos   kernel of the warp (default linear)
+--no-stats                 do not gather the per-band statistics of the fused cubes
+--prefetch N               overlap reading, computing and writing the tiles of every stage
+--overviews [F ...]        also write overviews of the fused cubes, as in build_cube
+--keep LO:HI,..., --bin-width W   only output these wavelength ranges / bin the output, as
+                           in build_cube
+--incremental    keep checkpoints and update existing outputs tile by tile instead of
+                 redoing a whole stage
+--report file    append a JSON line per stage of every pair, tagged with the pair's
+                 output (stage_timing); a failed pair shows which stage raised
+
+ RETURNS:
+the fused cubes (and warped SWIR cubes) next to the paths in the manifest;
+exits with status 1 if any pair failed
+
+=======================================================================
+-
+'''
+
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import contextlib
+import argparse
+import csv
+import json
+import os
+import sys
+import time
+import traceback
+from fusion_plan import default_plan_dir, parse_ranges
+from overviews import overview_path, overview_paths
+from checkpoint import checkpoint_path
+from band_stats import stats_path
+import stage_timing
+
+# ENVI data files sit next to the header, with one of these extensions
+data_file_exts = ['', '.img', '.IMG', '.dat', '.DAT', '.raw', '.RAW', '.bil', '.bip', '.bsq']
+
+
+def read_manifest(manifest_path):
+    if manifest_path.lower().endswith('.json'):
+        with open(manifest_path) as f:
+            pairs = json.load(f)
+        if isinstance(pairs, dict):
+            pairs = pairs['pairs']
+    else:
+        with open(manifest_path, newline='') as f:
+            pairs = [row for row in csv.DictReader(f)]
+
+    base = os.path.dirname(os.path.abspath(manifest_path))
+    resolved = []
+    for n, pair in enumerate(pairs):
+        for key in ('vnir', 'swir', 'output'):
+            if not pair.get(key):
+                raise ValueError('manifest entry %d has no %s' % (n, key))
+        entry = {}
+        for key in ('vnir', 'swir', 'output', 'homography'):
+            value = (pair.get(key) or '').strip()
+            entry[key] = os.path.join(base, value) if value else None
+        resolved.append(entry)
+    return resolved
+
+
+def envi_files(hdr_path):
+    # the header and its data file, if they exist
+    base = hdr_path[:-4] if hdr_path.lower().endswith('.hdr') else hdr_path
+    files = [hdr_path] if os.path.exists(hdr_path) else []
+    for ext in data_file_exts:
+        if os.path.isfile(base + ext) and base + ext != hdr_path:
+            files.append(base + ext)
+            break
+    return files
+
+
+def params_path(hdr_path):
+    return hdr_path[:-4] + '_params.json'
+
+
+def read_params(output_hdr):
+    # the settings the output was made with, None if it has no record of them
+    try:
+        with open(params_path(output_hdr)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def write_params(output_hdr, params):
+    tmp_path = params_path(output_hdr) + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(params, f, sort_keys=True)
+    os.replace(tmp_path, params_path(output_hdr))
+
+
+def is_up_to_date(output_hdr, input_files, params=None):
+    # newer than all the inputs and, if params are given, made with the same ones
+    # (compared as they read back from json, so tuples and lists are alike)
+    outputs = envi_files(output_hdr)
+    if len(outputs) < 2:
+        return False
+    if params is not None and read_params(output_hdr) != json.loads(json.dumps(params, sort_keys=True)):
+        return False
+    newest_input = max(os.path.getmtime(f) for f in input_files)
+    return min(os.path.getmtime(f) for f in outputs) >= newest_input
+
+
+def commit_output(tmp_hdr, final_hdr):
+    # move the finished header and data file into place, data file first so a
+    # header on its own never looks like a complete output; any overviews and the
+    # statistics go first
+    for factor, path in overview_paths(tmp_hdr).items():
+        commit_output(path, overview_path(final_hdr, factor))
+    if os.path.exists(stats_path(tmp_hdr)):
+        os.replace(stats_path(tmp_hdr), stats_path(final_hdr))
+    tmp_files = envi_files(tmp_hdr)
+    final_base = final_hdr[:-4]
+    for f in tmp_files[1:] + tmp_files[:1]:
+        ext = '.hdr' if f == tmp_hdr else f[len(tmp_hdr) - 4:]
+        os.replace(f, final_base + ext)
+    # and the checkpoint last, it vouches for the data file
+    if os.path.exists(checkpoint_path(tmp_hdr)):
+        os.replace(checkpoint_path(tmp_hdr), checkpoint_path(final_hdr))
+    elif os.path.exists(checkpoint_path(final_hdr)):
+        os.remove(checkpoint_path(final_hdr))
+
+
+def tmp_name(hdr_path):
+    return hdr_path[:-4] + '.partial.hdr'
+
+
+def run_stage(final_hdr, run, inputs, params, force=False, incremental=False):
+    '''
+    Runs run(output_hdr, checkpoint) for a stage writing final_hdr with the settings
+    params (a dict), unless the output is up to date. An output with a checkpoint is
+    updated in place (incremental); otherwise it is written under the temporary name
+    and moved into place. The params are recorded last, once the output is complete.
+    Returns what was done, None if nothing.
+    '''
+    if incremental and not force and os.path.exists(checkpoint_path(final_hdr)):
+        run(final_hdr, True)
+        write_params(final_hdr, params)
+        return 'updated'
+    if force or not is_up_to_date(final_hdr, inputs, params):
+        run(tmp_name(final_hdr), incremental)
+        commit_output(tmp_name(final_hdr), final_hdr)
+        write_params(final_hdr, params)
+        return 'written'
+    return None
+
+
+def process_pair(pair, workers=1, strip_rows=256, scale_factor=10000, force=False, single_pass=False,
+                 plan_dir=None, report=None, interleave='bip', overviews=None, incremental=False,
+                 interpolation='linear', stats=True, prefetch=0, keep=None, bin_width=None):
+    # imported here so the workers only pay for them once they get a pair
+    import build_cube
+    import coregister_controlpoints_gui
+    import register_and_fuse
+
+    log_path = pair['output'][:-4] + '.log'
+    status = []
+    stage_timing.configure(report, scene=pair['output'])
+    with open(log_path, 'a') as log, contextlib.redirect_stdout(log), stage_timing.stage('pair'):
+        print('====', time.strftime('%Y-%m-%d %H:%M:%S'), '====')
+        vnir_inputs = envi_files(pair['vnir'])
+        swir_inputs = envi_files(pair['swir'])
+        if len(vnir_inputs) < 2 or len(swir_inputs) < 2:
+            raise FileNotFoundError('missing VNIR or SWIR cube for ' + pair['output'])
+        # the settings that change what the stages write (not how fast)
+        warp_params = {'interpolation': interpolation}
+        fuse_params = {'scale_factor': scale_factor, 'keep': keep, 'bin_width': bin_width,
+                       'interleave': interleave, 'overviews': overviews, 'stats': stats}
+
+        ###
+        # warp and fuse in one pass, no intermediate warped SWIR cube
+        ###
+        if single_pass and pair['homography'] is not None:
+            def warp_fuse(output_hdr, checkpoint):
+                with stage_timing.stage('register_and_fuse'):
+                    register_and_fuse.register_and_fuse(pair['vnir'], pair['swir'], pair['homography'],
+                                                        output_hdr, scale_factor=scale_factor,
+                                                        strip_rows=strip_rows, workers=workers, plan_dir=plan_dir,
+                                                        interleave=interleave, overviews=overviews,
+                                                        checkpoint=checkpoint, interpolation=interpolation,
+                                                        stats=stats, prefetch=prefetch, keep=keep,
+                                                        bin_width=bin_width)
+            done = run_stage(pair['output'], warp_fuse, vnir_inputs + swir_inputs + [pair['homography']],
+                             dict(fuse_params, **warp_params), force=force, incremental=incremental)
+            if done:
+                status.append('warped and fused' if done == 'written' else 'warped and fused (incremental)')
+            else:
+                print('---> full spectrum cube is up to date: ', pair['output'])
+            return status
+
+        ###
+        # warp the SWIR onto the VNIR grid with the saved homography
+        ###
+        if pair['homography'] is not None:
+            warped_hdr = pair['swir'].replace('.hdr', '_warped.hdr')
+            def warp(output_hdr, checkpoint):
+                with stage_timing.stage('register'):
+                    coregister_controlpoints_gui.register_headless(pair['vnir'], pair['swir'], pair['homography'],
+                                                                   output_path=output_hdr, workers=workers,
+                                                                   strip_rows=strip_rows, checkpoint=checkpoint,
+                                                                   interpolation=interpolation, prefetch=prefetch)
+            done = run_stage(warped_hdr, warp, vnir_inputs + swir_inputs + [pair['homography']],
+                             warp_params, force=force, incremental=incremental)
+            if done:
+                status.append('warped' if done == 'written' else 'warped (incremental)')
+            else:
+                print('---> warped SWIR is up to date: ', warped_hdr)
+            swir_hdr = warped_hdr
+        else:
+            swir_hdr = pair['swir']
+
+        ###
+        # and fuse
+        ###
+        def fuse(output_hdr, checkpoint):
+            with stage_timing.stage('build_cube'):
+                build_cube.build_cube_streamed(pair['vnir'][:-4], swir_hdr[:-4], output_hdr,
+                                               scale_factor=scale_factor, strip_rows=strip_rows,
+                                               workers=workers, plan_dir=plan_dir, interleave=interleave,
+                                               overviews=overviews, checkpoint=checkpoint, stats=stats,
+                                               prefetch=prefetch, keep=keep, bin_width=bin_width)
+        done = run_stage(pair['output'], fuse, vnir_inputs + envi_files(swir_hdr), fuse_params,
+                         force=force, incremental=incremental)
+        if done:
+            status.append('fused' if done == 'written' else 'fused (incremental)')
+        else:
+            print('---> full spectrum cube is up to date: ', pair['output'])
+    return status
+
+
+def run_batch(pairs, jobs=1, workers=1, strip_rows=256, scale_factor=10000, force=False, single_pass=False,
+              plan_dir=None, report=None, interleave='bip', overviews=None, incremental=False,
+              interpolation='linear', stats=True, prefetch=0, keep=None, bin_width=None):
+    failed = []
+    kwargs = dict(workers=workers, strip_rows=strip_rows, scale_factor=scale_factor, force=force,
+                  single_pass=single_pass, plan_dir=plan_dir, report=report, interleave=interleave,
+                  overviews=overviews, incremental=incremental, interpolation=interpolation, stats=stats,
+                  prefetch=prefetch, keep=keep, bin_width=bin_width)
+    with ProcessPoolExecutor(max_workers=jobs) as pool:
+        futures = {pool.submit(process_pair, pair, **kwargs): pair for pair in pairs}
+        for n, future in enumerate(as_completed(futures)):
+            pair = futures[future]
+            try:
+                status = future.result()
+                print('[%d/%d] %s: %s' % (n+1, len(pairs), pair['output'],
+                                          ', '.join(status) if status else 'up to date'))
+            except Exception:
+                failed.append(pair)
+                print('[%d/%d] %s: FAILED' % (n+1, len(pairs), pair['output']))
+                traceback.print_exc()
+    return failed
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description='Register and fuse a manifest of VNIR/SWIR scene pairs.')
+    parser.add_argument('manifest', help='CSV or JSON manifest of pairs (vnir, swir, output[, homography])')
+    parser.add_argument('--jobs', type=int, default=1, help='pairs processed at the same time (default: %(default)s)')
+    parser.add_argument('--workers', type=int, default=1, help='warp/fusion threads per pair (default: %(default)s)')
+    parser.add_argument('--strip-rows', type=int, default=256, help='rows per warp strip and fusion tile (default: %(default)s)')
+    parser.add_argument('--scale-factor', type=int, default=10000,
+                        help='reflectance scale factor of the uint16 output (default: %(default)s)')
+    parser.add_argument('--force', action='store_true', help='redo every stage even if up to date')
+    parser.add_argument('--single-pass', action='store_true',
+                        help='warp and fuse pairs with a homography in one pass, without writing the warped SWIR')
+    parser.add_argument('--plan-dir', default=default_plan_dir,
+                        help='directory the fusion plans are cached in, "" to not cache (default: %(default)s)')
+    parser.add_argument('--interleave', choices=['bsq', 'bil', 'bip'], default='bip',
+                        help='interleave of the fused cubes (default: %(default)s)')
+    parser.add_argument('--interpolation', choices=['nearest', 'linear', 'cubic', 'lanczos'], default='linear',
+                        help='kernel resampling the SWIR onto the VNIR grid (default: %(default)s)')
+    parser.add_argument('--overviews', type=int, nargs='*', default=None, metavar='F',
+                        help='also write overviews of the fused cubes at these reduction factors '
+                             '(no factors: 4, 8, ... down to 128 pixels)')
+    parser.add_argument('--incremental', action='store_true',
+                        help='keep content-hashed checkpoints and only recompute the tiles whose inputs changed')
+    parser.add_argument('--prefetch', type=int, default=0,
+                        help='tiles read ahead and written behind while others are warped or fused, '
+                             'for cubes on network storage (default: %(default)s)')
+    parser.add_argument('--keep', type=parse_ranges, default=None, metavar='LO:HI,...',
+                        help='only output the bands within these wavelength ranges, e.g. 400:1340,1460:1790')
+    parser.add_argument('--bin-width', type=float, default=None,
+                        help='resample the output onto bands this far apart (in the units of the wavelengths)')
+    parser.add_argument('--no-stats', action='store_true',
+                        help='do not gather the per-band statistics of the fused cubes')
+    parser.add_argument('--report', default=None,
+                        help='append the time, CPU, bytes and peak memory of every stage of every pair '
+                             'to this JSON-lines file')
+    args = parser.parse_args()
+
+    start_time = time.time()
+    pairs = read_manifest(args.manifest)
+    print('---> processing', len(pairs), 'pairs on', args.jobs, 'process(es)')
+    failed = run_batch(pairs, jobs=args.jobs, workers=args.workers, strip_rows=args.strip_rows,
+                       scale_factor=args.scale_factor, force=args.force, single_pass=args.single_pass,
+                       plan_dir=args.plan_dir, report=args.report, interleave=args.interleave,
+                       overviews=args.overviews, incremental=args.incremental, interpolation=args.interpolation,
+                       stats=not args.no_stats, prefetch=args.prefetch, keep=args.keep,
+                       bin_width=args.bin_width)
+    print("--- %5.2f seconds ---" % (time.time() - start_time))
+    if failed:
+        print(len(failed), 'pair(s) failed, see their .log files; run again to retry them')
+        sys.exit(1)
+    print('CODE COMPLETION!')
@@ -0,0 +1,349 @@
+'''
++
+=======================================================================
+
+ NAME:
+      benchmark_pipeline
+
+ DESCRIPTION:
+	times the stages of the registration and fusion pipeline on synthetic
+VNIR/SWIR pairs and saves the results as JSON.
+- writes synthetic ENVI pairs (VNIR ~400-1000 nm, SWIR ~900-2500 nm) for every
+requested interleave and dtype; the SWIR is flipped and slightly rotated and
+shifted, with its homography saved next to it
+- runs each stage --repeat times in a fresh process and keeps the best wall time
+and the largest peak RSS:
+    load       spectral load() of both cubes
+    plan       FusionPlan.build
+    fuse       FusionPlan.apply on the whole scene
+    quantize   rounding the blended overlap bands to uint16, on its own
+    warp       the headless warp of the SWIR (save_image_envi)
+    write      writing the fused uint16 cube
+    build_cube, register_and_fuse   the streamed stages end to end (build_cube on
+               the SWIR warped beforehand)
+
+ USES:
+numpy
+spectral (from the python package spectral)
+concurrent.futures, multiprocessing, resource
+build_cube, coregister_controlpoints_gui, fusion_plan, register_and_fuse (from this repository)
+
+ PARAMETERS:
+--rows N, --cols N                 scene size (default 512 x 512)
+--vnir-bands N, --swir-bands N     number of bands (default 375 and 267)
+--interleave bsq bil bip           interleaves to generate (default: all three)
+--dtype uint16 float32 ...         sample types to generate (default: uint16)
+--stages ...                       stages to run (default: all)
+--repeat N                         runs per stage (default 3)
+--workers N, --strip-rows N        passed to the warp and streamed stages
+--workdir dir                      where the synthetic cubes go (default: a temporary directory)
+--out file.json                    results file (default benchmark_results.json)
+
+ RETURNS:
+a JSON file with the machine, the configuration and, for each pair, the seconds
+and peak RSS (MB) of every stage
+
+ NOTES:
+the cubes are read through the page cache (warm reads). setup_peak_rss_mb is the
+peak of the child process before the timed part.
+
+ HISTORY:
+2026/10/17: created
+
+=======================================================================
+-
+'''
+
+from concurrent.futures import ProcessPoolExecutor
+import multiprocessing
+import contextlib
+import argparse
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+
+import numpy as np
+import spectral.io.envi as envi
+
+try:
+    import resource
+except ImportError:
+    # not available on Windows, the peak RSS is then not reported
+    resource = None
+
+stage_names = ['load', 'plan', 'fuse', 'quantize', 'warp', 'write', 'build_cube', 'register_and_fuse']
+
+
+def peak_rss_mb():
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return rss / 1024.0**2 if sys.platform == 'darwin' else rss / 1024.0
+
+
+def synthetic_homography(nrows, ncols, angle=1.0, shift=(3.0, -2.0)):
+    # a small rotation about the centre and a shift, taking the flipped SWIR onto the VNIR
+    a = np.deg2rad(angle)
+    cy, cx = (nrows - 1) / 2.0, (ncols - 1) / 2.0
+    R = np.array([[np.cos(a), -np.sin(a), 0.0], [np.sin(a), np.cos(a), 0.0], [0.0, 0.0, 1.0]])
+    T = np.array([[1.0, 0.0, cx + shift[0]], [0.0, 1.0, cy + shift[1]], [0.0, 0.0, 1.0]])
+    C = np.array([[1.0, 0.0, -cx], [0.0, 1.0, -cy], [0.0, 0.0, 1.0]])
+    return T @ R @ C
+
+
+def write_synthetic_cube(hdr_path, nrows, ncols, wavelengths, interleave='bil', dtype='uint16',
+                         scale_factor=10000, seed=0, block_rows=64):
+    '''
+    Writes a [nrows, ncols, len(wavelengths)] ENVI cube of smooth, spatially varying
+    reflectance spectra, a block of rows at a time so any size can be generated.
+    '''
+    md = {'wavelength': [str(w) for w in wavelengths], 'description': 'synthetic benchmark cube'}
+    integer = np.issubdtype(np.dtype(dtype), np.integer)
+    if integer:
+        md['reflectance scale factor'] = scale_factor
+    image = envi.create_image(hdr_path, metadata=md, dtype=dtype, interleave=interleave,
+                              shape=(nrows, ncols, len(wavelengths)), offset=0, force=True)
+    mm = image.open_memmap(interleave='bip', writable=True)
+
+    rng = np.random.default_rng(seed)
+    wvl = np.asarray(wavelengths, dtype=np.float32)
+    phase = rng.uniform(0, 2*np.pi, 4).astype(np.float32)
+    x = np.arange(ncols, dtype=np.float32)[None, :, None]
+    for r0 in range(0, nrows, block_rows):
+        r1 = min(r0 + block_rows, nrows)
+        y = np.arange(r0, r1, dtype=np.float32)[:, None, None]
+        # low frequency "materials" in space, each with a smooth spectrum
+        base = 0.45 + 0.2*np.sin(x/37.0 + phase[0]) * np.cos(y/23.0 + phase[1])
+        shape = 0.5 + 0.4*np.sin(wvl/140.0 + phase[2] + x/90.0) * np.cos(wvl/410.0 + phase[3] + y/70.0)
+        block = base * shape + rng.normal(0, 0.01, (r1 - r0, ncols, wvl.size)).astype(np.float32)
+        if integer:
+            block = np.clip(np.rint(block * scale_factor), 0, np.iinfo(dtype).max)
+        mm[r0:r1] = block
+    mm.flush()
+    del mm
+
+
+def make_pair(workdir, nrows, ncols, vnir_bands=375, swir_bands=267, interleave='bil', dtype='uint16'):
+    # a VNIR cube, a raw (flipped, misregistered) SWIR cube on the same number of
+    # rows and columns, and the homography between them
+    name = '%s_%s_%dx%d' % (interleave, dtype, nrows, ncols)
+    pair = {'vnir': os.path.join(workdir, name + '_vnir.hdr'),
+            'swir': os.path.join(workdir, name + '_swir.hdr'),
+            'homography': os.path.join(workdir, name + '_homography.txt'),
+            'interleave': interleave, 'dtype': dtype,
+            'rows': nrows, 'cols': ncols, 'vnir_bands': vnir_bands, 'swir_bands': swir_bands}
+    vnir_wvl = np.round(np.linspace(398.0, 1002.0, vnir_bands), 3)
+    swir_wvl = np.round(np.linspace(899.0, 2502.0, swir_bands), 3)
+    write_synthetic_cube(pair['vnir'], nrows, ncols, vnir_wvl, interleave, dtype, seed=1)
+    write_synthetic_cube(pair['swir'], nrows, ncols, swir_wvl, interleave, dtype, seed=2)
+    np.savetxt(pair['homography'], synthetic_homography(nrows, ncols))
+    return pair
+
+
+###
+# the stages: each returns the function to time, everything before that is setup;
+# they run in a fresh process each (run_stage)
+###
+def open_pair(pair):
+    from spectral import open_image
+    return open_image(pair['vnir']), open_image(pair['swir'])
+
+
+def pair_plan(vnir_image, swir_image):
+    from fusion_plan import FusionPlan
+    return FusionPlan.build(np.copy(vnir_image.bands.centers), np.copy(swir_image.bands.centers), 10000,
+                            vnir_scale=vnir_image.scale_factor, swir_scale=swir_image.scale_factor)
+
+
+def blend_blocks(plan, vnir, swir):
+    # the sparse products of the overlap bands over the whole scene, in the blocks FusionPlan.apply uses
+    import fusion_plan
+    nrows, ncols = vnir.shape[0], vnir.shape[1]
+    block_rows = max(1, fusion_plan.chunk_pixels // ncols)
+    return [(r0, min(r0 + block_rows, nrows),
+             plan.blend_operator @ plan.gather(vnir[r0:r0+block_rows], swir[r0:r0+block_rows],
+                                               columns=plan.blend_cols))
+            for r0 in range(0, nrows, block_rows)]
+
+
+def stage_load(pair, settings):
+    def run():
+        vnir_image, swir_image = open_pair(pair)
+        return vnir_image.load(), swir_image.load()
+    return run
+
+
+def stage_plan(pair, settings):
+    vnir_image, swir_image = open_pair(pair)
+    return lambda: pair_plan(vnir_image, swir_image)
+
+
+def stage_fuse(pair, settings):
+    vnir_image, swir_image = open_pair(pair)
+    plan = pair_plan(vnir_image, swir_image)
+    vnir = np.array(vnir_image.open_memmap(interleave='bip'))
+    swir = np.array(swir_image.open_memmap(interleave='bip'))
+    out = np.empty((pair['rows'], pair['cols'], plan.n_out), dtype=np.uint16)
+    return lambda: plan.apply(vnir, swir, out=out)
+
+
+def stage_quantize(pair, settings):
+    from fusion_plan import quantize
+    vnir_image, swir_image = open_pair(pair)
+    plan = pair_plan(vnir_image, swir_image)
+    vnir = np.array(vnir_image.open_memmap(interleave='bip'))
+    swir = np.array(swir_image.open_memmap(interleave='bip'))
+    blocks = blend_blocks(plan, vnir, swir)
+    del vnir, swir
+    n_blend = plan.blend_rows.size
+    out = np.empty((pair['rows'], pair['cols'], n_blend), dtype=np.uint16)
+    def run():
+        for r0, r1, y in blocks:
+            quantize(y.reshape(n_blend, r1 - r0, pair['cols']), np.moveaxis(out[r0:r1], 2, 0))
+        return out
+    return run
+
+
+def stage_warp(pair, settings):
+    import coregister_controlpoints_gui as cg
+    M = np.loadtxt(pair['homography'])
+    output = os.path.join(settings['tmpdir'], 'warped.hdr')
+    def run():
+        (vnir_arr, vnir_profile, vnir_wvl), (swir_arr, swir_profile, swir_wvl) = cg.load_images_envi(pair['vnir'],
+                                                                                                     pair['swir'])
+        cg.save_image_envi(swir_arr, swir_wvl, pair['swir'], vnir_arr, vnir_profile, M, output_path=output,
+                           workers=settings['workers'], swir_scale=cg.reflectance_scale(swir_profile),
+                           strip_rows=settings['strip_rows'])
+    return run
+
+
+def stage_write(pair, settings):
+    from fusion_plan import output_metadata
+    vnir_image, swir_image = open_pair(pair)
+    plan = pair_plan(vnir_image, swir_image)
+    cube = np.random.default_rng(0).integers(0, 10000, (pair['rows'], pair['cols'], plan.n_out), dtype=np.uint16)
+    md = output_metadata(vnir_image, plan, 10000)
+    output = os.path.join(settings['tmpdir'], 'written.hdr')
+    def run():
+        image = envi.create_image(output, metadata=md, dtype='uint16', interleave='bip', shape=cube.shape,
+                                  offset=0, force=True)
+        mm = image.open_memmap(interleave='bip', writable=True)
+        mm[...] = cube
+        mm.flush()
+        del mm
+    return run
+
+
+def stage_build_cube(pair, settings):
+    from coregister_controlpoints_gui import register_headless
+    from build_cube import build_cube_streamed
+    # the SWIR is registered first, outside the timed part, as build_cube expects
+    warped = os.path.join(settings['tmpdir'], 'warped.hdr')
+    register_headless(pair['vnir'], pair['swir'], pair['homography'], output_path=warped,
+                      workers=settings['workers'], strip_rows=settings['strip_rows'])
+    output = os.path.join(settings['tmpdir'], 'fused.hdr')
+    return lambda: build_cube_streamed(pair['vnir'][:-4], warped[:-4], output,
+                                       strip_rows=settings['strip_rows'], workers=settings['workers'])
+
+
+def stage_register_and_fuse(pair, settings):
+    from register_and_fuse import register_and_fuse
+    output = os.path.join(settings['tmpdir'], 'fused.hdr')
+    return lambda: register_and_fuse(pair['vnir'], pair['swir'], pair['homography'], output,
+                                     strip_rows=settings['strip_rows'], workers=settings['workers'])
+
+
+def run_stage(name, pair, settings):
+    # runs in a fresh child process: set the stage up, then time it
+    tmpdir = tempfile.mkdtemp(dir=settings['workdir'])
+    settings = dict(settings, tmpdir=tmpdir)
+    try:
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+            run = globals()['stage_' + name](pair, settings)
+            setup_rss = peak_rss_mb()
+            start = time.perf_counter()
+            run()
+            seconds = time.perf_counter() - start
+    finally:
+        shutil.rmtree(tmpdir, ignore_errors=True)
+    return {'seconds': seconds, 'peak_rss_mb': peak_rss_mb(), 'setup_peak_rss_mb': setup_rss}
+
+
+def benchmark_pair(pair, stages, settings, repeat=3):
+    results = {}
+    context = multiprocessing.get_context('spawn')
+    for name in stages:
+        runs = []
+        for n in range(repeat):
+            # a new process for every run, so ru_maxrss is this run's peak only
+            with ProcessPoolExecutor(max_workers=1, mp_context=context) as pool:
+                runs.append(pool.submit(run_stage, name, pair, settings).result())
+        rss = [r['peak_rss_mb'] for r in runs if r['peak_rss_mb'] is not None]
+        setup_rss = [r['setup_peak_rss_mb'] for r in runs if r['setup_peak_rss_mb'] is not None]
+        results[name] = {'seconds': min(r['seconds'] for r in runs),
+                         'seconds_all': [r['seconds'] for r in runs],
+                         'peak_rss_mb': max(rss) if rss else None,
+                         'setup_peak_rss_mb': max(setup_rss) if setup_rss else None}
+        print('   %-18s %8.3f s   peak RSS %s MB' % (name, results[name]['seconds'],
+              '%.0f' % results[name]['peak_rss_mb'] if rss else 'n/a'))
+    return results
+
+
+def machine_info():
+    return {'platform': platform.platform(), 'python': platform.python_version(),
+            'numpy': np.__version__, 'cpu_count': os.cpu_count(), 'hostname': platform.node()}
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description='Benchmark the pipeline stages on synthetic VNIR/SWIR cubes.')
+    parser.add_argument('--rows', type=int, default=512, help='scene rows (default: %(default)s)')
+    parser.add_argument('--cols', type=int, default=512, help='scene columns (default: %(default)s)')
+    parser.add_argument('--vnir-bands', type=int, default=375, help='VNIR bands (default: %(default)s)')
+    parser.add_argument('--swir-bands', type=int, default=267, help='SWIR bands (default: %(default)s)')
+    parser.add_argument('--interleave', nargs='+', choices=['bsq', 'bil', 'bip'], default=['bsq', 'bil', 'bip'],
+                        help='interleaves of the synthetic cubes (default: %(default)s)')
+    parser.add_argument('--dtype', nargs='+', choices=['uint16', 'int16', 'float32'], default=['uint16'],
+                        help='sample types of the synthetic cubes (default: %(default)s)')
+    parser.add_argument('--stages', nargs='+', choices=stage_names, default=stage_names,
+                        help='stages to run (default: all)')
+    parser.add_argument('--repeat', type=int, default=3, help='runs per stage, the best is kept (default: %(default)s)')
+    parser.add_argument('--workers', type=int, default=1, help='threads for the warp and streamed stages (default: %(default)s)')
+    parser.add_argument('--strip-rows', type=int, default=256, help='rows per strip/tile (default: %(default)s)')
+    parser.add_argument('--workdir', default=None, help='where the synthetic cubes are written (default: a temporary directory)')
+    parser.add_argument('--out', default='benchmark_results.json', help='results file (default: %(default)s)')
+    args = parser.parse_args()
+
+    workdir = args.workdir or tempfile.mkdtemp(prefix='vnir_swir_bench_')
+    os.makedirs(workdir, exist_ok=True)
+    settings = {'workers': args.workers, 'strip_rows': args.strip_rows, 'workdir': workdir}
+    report = {'created': time.strftime('%Y-%m-%d %H:%M:%S'), 'machine': machine_info(),
+              'settings': {'workers': args.workers, 'strip_rows': args.strip_rows, 'repeat': args.repeat},
+              'runs': []}
+
+    try:
+        for interleave in args.interleave:
+            for dtype in args.dtype:
+                print('---> generating', interleave, dtype, 'pair of', args.rows, 'x', args.cols, '...', end='')
+                pair = make_pair(workdir, args.rows, args.cols, args.vnir_bands, args.swir_bands, interleave, dtype)
+                print(' ...done <---')
+                stages = benchmark_pair(pair, args.stages, settings, repeat=args.repeat)
+                config = {k: pair[k] for k in ('interleave', 'dtype', 'rows', 'cols', 'vnir_bands', 'swir_bands')}
+                report['runs'].append({'config': config, 'stages': stages})
+                for key in ('vnir', 'swir'):
+                    for f in (pair[key], pair[key][:-4] + '.img'):
+                        if os.path.exists(f) and args.workdir is None:
+                            os.remove(f)
+    finally:
+        if args.workdir is None:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    with open(args.out, 'w') as f:
+        json.dump(report, f, indent=2)
+    print('---> results written to: ', args.out)
+    print('CODE COMPLETION!')
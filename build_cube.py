@@ -14,15 +14,64 @@ VNIR and SWIR cubes collected with the DU Headwall HSI system.
 - uses a weighted sum approach to estimate the reflectance values in the overlap region
 - outputs a uint16 ENVI cube scaled by a scale factor, initially set to 10,000.  Note that
 the scale factor is written into the ENVI header file under the tage 'reflectance scale factor'
+- the scaled values are rounded to the nearest integer and saturated to [0, 65535]
+- with streaming = 1 the two cubes are read through memmaps in strips of rows, and each
+fused strip is written straight into an output cube pre-created with envi.create_image,
+so peak memory is bounded by strip_rows rather than by the size of the scene
+- the strips are cut into strip_rows x tile_cols tiles, fused on a pool of threads
+(--workers N) and, with --prefetch N, read and written on their own threads
+- per-band statistics of the fused cube (band_stats) are gathered as it is written and
+saved in the header and in <out>_stats.json
+- --overviews writes 1/4, 1/8, ... resolution copies (<out>_ovr<f>.hdr) along with it
+- --checkpoint keeps a content-hashed checkpoint (checkpoint.py), so a rerun only
+recomputes the tiles whose VNIR/SWIR data changed
+- --roi row0:row1,col0:col1 fuses only that window of the scene into a cube of its size
+- --format chunked writes a chunked, compressed store (chunked_store) instead
+- band selection, the resampling of the SWIR overlap and the blend weights are one sparse
+operator (fusion_plan.FusionPlan), cached in plan_dir; --keep and --bin-width cut the
+output down to wavelength ranges and/or bin it inside that operator
 
  USES:
 
 numpy
 spectralPy (from the python package spectral)
 time
+argparse
+tile_executor, fusion_plan, stage_timing, chunked_store, overviews, checkpoint, band_stats
+(from this repository)
 
  PARAMETERS:
-
+the input/output paths, scale_factor, streaming and strip_rows are set at the top of the code;
+the paths and scale factor can also be given on the command line:
+--vnir path, --swir path   ENVI base paths of the registered cubes (without .hdr)
+--out path.hdr             output full spectrum cube
+--scale-factor N           reflectance scale factor of the uint16 output
+--workers N        number of threads fusing tiles in parallel
+--prefetch N       overlap the reading, fusing and writing of tiles, with up to N tiles
+                   read ahead and N written behind (0: one after the other, default)
+--strip-rows N     rows per tile
+--tile-cols N      columns per tile, 0 for full width strips (only used when the inputs
+                   and the output are all BIP, see tile_executor.tile_cols_for)
+--plan-dir dir     where fusion plans are cached ("" to rebuild the plan every run)
+--roi row0:row1,col0:col1   only fuse this window of the scene (python slice bounds,
+                   either end may be left out, e.g. 1000:3000,:)
+--keep LO:HI,...   only output the bands within these wavelength ranges (e.g.
+                   400:1340,1460:1790,1960:2450 leaves out the water absorption bands)
+--bin-width W      resample the output onto bands every W (nm, the units of the headers),
+                   within each --keep range (fusion_plan.band_selection)
+--interleave bsq|bil|bip   layout of the fused cube (default bip, set by out_interleave)
+--format envi|chunked      write a raw ENVI cube (default) or a chunked compressed store
+                           (the directory <out>.zcube when --out is a .hdr)
+--chunks R,C,B, --codec zlib|lz4   chunk shape and codec of the store
+--checkpoint               reuse the tiles of an earlier run whose inputs have not changed
+                           (<out>_checkpoint.json, ENVI output only)
+--overviews [F ...]        also write overviews at these factors (default 4, 8, ... down to
+                           128 pixels on the smaller side)
+--no-stats         do not gather the per-band statistics
+--in-memory        load both cubes fully into memory instead of streaming
+--report file      append a JSON line per stage (load, overlap, fuse, save) with its wall
+                   and CPU time, bytes read/written and peak memory (stage_timing)
+--profile file     run under cProfile and save the stats
 
  KEYWORDS:
 
@@ -52,17 +101,17 @@ reflectance, scaled by a scale_factor, originally set at 10,000
 import numpy as np
 from spectral import *
 import spectral.io.envi as envi
+import argparse
 import time
+from tile_executor import (iter_tiles, run_tiles, run_pipeline, tile_cols_for, round_up, parse_roi, roi_window,
+                           crop_metadata)
+from fusion_plan import FusionPlan, default_plan_dir, band_index, parse_ranges, output_metadata
+from stage_timing import stage, count_bytes, configure, profiled
+from chunked_store import create_store, store_path, default_chunks
+from overviews import create_overviews
+from checkpoint import Checkpoint, content_key, image_layout
+from band_stats import output_stats, save_stats, stats_path
 
-###
-# starting stuff
-###
-start_time = time.time()
-start_hour = time.gmtime().tm_hour
-start_min = time.gmtime().tm_min
-start_sec = time.gmtime().tm_sec
-print('Starting time [GMT]: ', start_hour,':', start_min,':',start_sec)
-print('')
 ###
 # set up the input images
 ###
@@ -83,204 +132,371 @@ swir_path_dat = infolder + 'Symeon-SWIR-2022_09_07_06_03_05/data_SWIR_warped'
 saveimage = 1 # set to 1 to write out the final image
 outfolder = infolder # will write to the same place we opened the originals from
 full_outfilehdr = outfolder + 'Symeon_FullSpec.hdr'
+scale_factor = 10000
 
 ###
-# open up the two files
-###
-print ('opening VNIR image file: ', vnir_path_dat)
-vnir_image = open_image(vnir_path_dat+'.hdr').load()
-
-vnir_nrows = vnir_image.nrows
-vnir_ncols = vnir_image.ncols
-vnir_nbands = vnir_image.nbands
-print('VNIR IMAGE rows, cols, bands: ', vnir_image.nrows, vnir_image.ncols, vnir_image.nbands)
-print('')
-
-# and the SWIR
-print ('opening SWIR image file: ', swir_path_dat)
-swir_image = open_image(swir_path_dat+'.hdr').load()
-
-swir_nrows = swir_image.nrows
-swir_ncols = swir_image.ncols
-swir_nbands = swir_image.nbands
-print('SWIR IMAGE rows, cols, bands: ', swir_image.nrows, swir_image.ncols, swir_image.nbands)
-print('')
-
-###
-# BEGINNING of MAIN PROGRAM
-###
-
-#%% Determining region of spectral overlap and choosing the wavelength of least wavelength difference
-print('---> determining region of spectral overlap...', end = '')
-# vnir_wvl = np.array(vnir_image.nbands)
-# swir_wvl = np.array(swir_image.nbands)
-
-vnir_wvl = np.copy(vnir_image.bands.centers)
-swir_wvl = np.copy(swir_image.bands.centers)
-
-### Getting the overlap region
-swir_overlap = swir_wvl[np.where(swir_wvl <= vnir_wvl[-1])]
-vnir_overlap = vnir_wvl[np.where(vnir_wvl >= swir_wvl[0])]
-
-# get the indices - will need them later for sorting the cube by ascending wavelengths
-swir_overlap_indices = np.argwhere(swir_wvl <= vnir_wvl[-1])
-vnir_overlap_indices = np.argwhere(vnir_wvl >= swir_wvl[0])
-
-N_vnir_overlap, M_swir_overlap = len(vnir_overlap), len(swir_overlap)
-n_overlap = N_vnir_overlap + M_swir_overlap
-
-# these are the indices in the full combined wvl array that are the overlap
-# after concatenating the two wvl arrays together
-# add the last vnir index and one to the swir overlap indices for sorting later on
-swir_overlap_indices_p1 = vnir_overlap_indices[N_vnir_overlap-1]+swir_overlap_indices+1
-full_wvl_overlap_indices = np.concatenate((vnir_overlap_indices,swir_overlap_indices))
-# flatten this array
-full_wvl_overlap_indices = np.reshape(full_wvl_overlap_indices,-1)
-print(' ...done <---')
-
-###
-# now to sort the wavelength file to get everything in ascending order
-###
-print('---> Concatenating and sorting the two images... ')
-# last index in vnir cube before the overlap region, total # of bands in vnir - # in overlap
-last_vnir_b4_overlap = vnir_image.nbands - N_vnir_overlap
-# index of first swir band in full set of unsorted overlap indices, the last vnir + 1
-first_swir_overlap_in_full = full_wvl_overlap_indices[N_vnir_overlap-1] + 1
-# starting index of the swir cube in the full list of indices, last of the overlap indices + 1
-first_swir_after_overlap = full_wvl_overlap_indices[n_overlap-1] +1
-# last swir overlap band in swir indices
-last_full_overlap_band = first_swir_overlap_in_full + M_swir_overlap
-
-swir_wvl_after_overlap = swir_wvl[first_swir_after_overlap:swir_nbands]
-swir_wvl_after_overlap_nbands = np.size(swir_wvl_after_overlap)
-
-#-> combined_nbands is sum of both, need this for the sorting.
-combined_nbands = vnir_image.nbands + swir_image.nbands
-#-> final_combined_nbands is number of wvl bands in final image after spectral resampling
-final_combined_nbands = vnir_image.nbands + swir_wvl_after_overlap_nbands
-
-###
-# create the final cube array
+# streaming mode: set to 1 to read both cubes through memmaps in strips of
+# strip_rows lines and write each fused strip straight into the output file.
+# Peak memory is then bounded by the strip size instead of the scene size.
 ###
-full_cube = np.ndarray((vnir_image.shape[0],vnir_image.shape[1],final_combined_nbands))
-
+streaming = 1
+strip_rows = 256
 ###
-# get the final wavelength array: vnir_wvl + swir_wvl[first_swir_after_overlap: swir_bil.nbands
-# this is for the header file in the final output cube
+# tiles are strip_rows x tile_cols (0 = full width); with workers > 1 they are
+# fused on a pool of threads, the result is identical to workers = 1
 ###
-final_wvl = np.concatenate((vnir_wvl,swir_wvl[first_swir_after_overlap:-1]))
-final_nbands = np.size(final_wvl)
-final_wvl = np.reshape(final_wvl,final_nbands)
-
-print('---> Sorting the wavelength array... ', end = '')
-vnir_swir_wvl = np.array(combined_nbands)
-vnir_swir_wvl = np.concatenate((vnir_wvl,swir_wvl))
-
-wvl_sorted_indices = np.argsort(vnir_swir_wvl)
-vnir_swir_wvl_sorted = vnir_swir_wvl[wvl_sorted_indices]
-print('  ... done <--')
-
-print('--> Building the final cube....')
-
-print('   ---> building cubes 1 & 3 ....')
-cube1 = vnir_image[:,:,0:last_vnir_b4_overlap]
-cube3 = swir_image[:,:,first_swir_after_overlap:-1]
-print('Cube1: ', cube1.shape)
-print('Cube3: ', cube3.shape)
-print('   ... done <---')
-
+tile_cols = 0
+workers = 1
 ###
-# spectrally resample the SWIR cube to the VNIR wavelengths, then do
-# a linear weighted average of the VNIR and SWIR values on the new grid for cube 2
+# with prefetch > 0 a reader thread reads up to prefetch tiles ahead and a writer
+# thread writes the fused ones behind, so on a network drive the disk and the CPU
+# are busy at the same time; 2 is double buffering
 ###
-
-#-> Get the VNIR overlap cube, and wavelength grid, # of wvl in VNIR overlap: vnir_overlap_indices
-#print('size of, vnir_overlap: ', np.size(vnir_overlap), vnir_overlap)
-n1 = np.shape(vnir_image)[0]
-n2 = np.shape(vnir_image)[1]
-n3 = np.size(vnir_overlap_indices)
-vnir_overlap_cube = np.reshape(vnir_image[:,:,vnir_overlap_indices],[n1,n2,n3])
-print('size of vnir overlap cube: ', np.shape(vnir_overlap_cube))
-
-#-> Get the SWIR overlap cube, and wavelength grid: swir_overlap_indices
-n4 = np.size(swir_overlap_indices)
-swir_overlap_cube = np.reshape(swir_image[:,:,swir_overlap_indices],[n1,n2,n4])
-print('size of swir overlap cube: ', np.shape(swir_overlap_cube))
-
-#-> spectrally resample that to the VNIR wavelength grid
-### from spectral
-resample = BandResampler(swir_overlap, vnir_overlap)
-# # resample the entire image
-print('---> Resampling the SWIR cube to the VNIR wavelength grid... ', end = '')
-new_SWIR_size = swir_overlap_cube.shape
-data = swir_overlap_cube.reshape((-1, new_SWIR_size[2]))
-new_SWIR_image = resample.matrix.dot(data.T).T
-new_SWIR_image = new_SWIR_image.reshape(n1, n2, n3)
-print('... done <---')
-print('new SWIR image shape: ', new_SWIR_image.shape)
-
-#-> compute the weights for the weighted average between the two
-wgt_start = 0.5/(n3-1)
-wgt = np.arange(n3)/(n3)+wgt_start
-
-#-> create the new cube, spectrally sampled on the VNIR wvl spacing, as a
-#-> weighted average of the two at each wavlength
-print('---> Computing weighted reflectance values in overlap region ...', end = '')
-cube2 = np.ndarray((vnir_image.shape[0],vnir_image.shape[1],n3))
-for i in range(n3):
-    cube2[:,:,i] = vnir_overlap_cube[:,:,i] * (1.0-wgt[i]) + new_SWIR_image[:,:,i]*wgt[i]
-print(' ... done <---')
+prefetch = 0
 ###
-# concatenate the three cubes
+# the fusion plan (band selection, resampling and blend weights as one operator) is
+# saved here the first time a pair of wavelength grids is seen and reused after that
 ###
-print('   ---> concatenating ...')
-full_cube = np.concatenate((cube1,cube2,cube3),axis=2)
-#print('full_cube data type: ', full_cube.dtype)
-#print('Shape of full cube: ', full_cube.shape)
-print('   ... done <---')
-
-### try to free up some memory
-print('---> freeing up some memory... ', end = '')
-del swir_image
-del swir_overlap_cube
-del vnir_overlap_cube
-del new_SWIR_image
-del data
-del cube1
-del cube2
-del cube3
-print(' ... done <---')
-
+plan_dir = default_plan_dir
 ###
-# multiply by 10,000 and convert to int
+# interleave of the fused cube: 'bip' for per-pixel (spectral) consumers, 'bsq' for
+# band viewers, 'bil' in between
 ###
-print('---> Converting the cube to uint16 * a scale factor for writing....')
-scale_factor = 10000
-print('      -> scale factor = ',scale_factor)
-int_cube = full_cube * scale_factor
-int_cube = int_cube.astype('uint16')
-#print('int_cube data type: ', int_cube.dtype)
-#print('Shape of int cube: ', int_cube.shape)
-
-# free up more memory
-del full_cube
-
+out_interleave = 'bip'
 ###
-# save the full concatenated, sorted, cube
+# 'envi' writes the raw uint16 cube, 'chunked' a compressed store of
+# store_chunks (rows, cols, bands) chunks, see chunked_store
 ###
-if saveimage == 1 :
-    print('Saving the registered, sorted, full spectrum cube...')
-    md = vnir_image.metadata.copy()
-    md['wavelength'] = final_wvl
-    # md['nrows'] = vnir_img.shape[0]
-    # md['ncols'] = vnir_img.shape[1]
-    md['dtype'] = 'uint16'
-    md['bands'] = final_nbands
-    md['reflectance scale factor'] = scale_factor
-    print('---> Writing cube to: ', full_outfilehdr, end='')
-    envi.save_image(full_outfilehdr, int_cube, force='True', metadata=md)
-#    envi.save_image(full_outfilehdr, full_cube, force='True', metadata=md)
-    print('  ... done <---')
-
-print("--- %5.2f seconds ---" % (time.time() - start_time))
-print('CODE COMPLETION!')
+out_format = 'envi'
+store_chunks = default_chunks
+store_codec = 'zlib'
+
+
+def build_cube(vnir_path_dat, swir_path_dat, full_outfilehdr, scale_factor=10000, saveimage=1, plan_dir=None,
+               interleave='bip', output_format='envi', chunks=None, codec='zlib', overviews=None, stats=True,
+               keep=None, bin_width=None):
+
+    ###
+    # open up the two files
+    ###
+    with stage('load'):
+        print ('opening VNIR image file: ', vnir_path_dat)
+        vnir_image = open_image(vnir_path_dat+'.hdr').load()
+        print('VNIR IMAGE rows, cols, bands: ', vnir_image.nrows, vnir_image.ncols, vnir_image.nbands)
+        print('')
+
+        # and the SWIR
+        print ('opening SWIR image file: ', swir_path_dat)
+        swir_image = open_image(swir_path_dat+'.hdr').load()
+        print('SWIR IMAGE rows, cols, bands: ', swir_image.nrows, swir_image.ncols, swir_image.nbands)
+        print('')
+        count_bytes(read=vnir_image.nbytes + swir_image.nbytes)
+
+    #%% Determining region of spectral overlap and choosing the wavelength of least wavelength difference
+    #-> band selection, spectral resampling of the SWIR overlap to the VNIR wavelength
+    #-> grid and the blend weights, as one operator; load() has already divided out
+    #-> any reflectance scale factor
+    with stage('overlap'):
+        print('---> determining region of spectral overlap...')
+        plan = FusionPlan.cached(np.copy(vnir_image.bands.centers), np.copy(swir_image.bands.centers),
+                                 scale_factor, plan_dir=plan_dir, keep=keep, bin_width=bin_width)
+        print(' ...done <---')
+
+    with stage('fuse'):
+        print('--> Building the final cube....')
+        print('---> scale factor = ',scale_factor)
+        int_cube = plan.apply(vnir_image, swir_image)
+        band_stats = output_stats(plan, scale_factor) if stats else None
+        if band_stats is not None:
+            band_stats.add(int_cube)
+        print('   ... done <---')
+
+    ### try to free up some memory
+    del swir_image
+
+    ###
+    # save the full concatenated, sorted, cube
+    ###
+    if saveimage == 1 :
+        with stage('save'):
+            print('Saving the registered, sorted, full spectrum cube...')
+            md = output_metadata(vnir_image, plan, scale_factor)
+            if output_format == 'chunked':
+                full_outfilehdr = store_path(full_outfilehdr)
+                print('---> Writing cube to: ', full_outfilehdr, end='')
+                store = create_store(full_outfilehdr, int_cube.shape, 'uint16', metadata=md, chunks=chunks, codec=codec)
+                store.write(0, 0, int_cube)
+                if band_stats is not None:
+                    save_stats(full_outfilehdr, band_stats, store)
+                store.close()
+                count_bytes(written=store.stored_bytes)
+            else:
+                print('---> Writing cube to: ', full_outfilehdr, end='')
+                envi.save_image(full_outfilehdr, int_cube, force='True', metadata=md, interleave=interleave)
+                if band_stats is not None:
+                    save_stats(full_outfilehdr, band_stats)
+                count_bytes(written=int_cube.nbytes)
+            ovr = create_overviews(full_outfilehdr, int_cube.shape, md, overviews, interleave=interleave)
+            if ovr is not None:
+                ovr.write(0, 0, int_cube)
+                ovr.close()
+            print('  ... done <---')
+
+
+def build_cube_streamed(vnir_path_dat, swir_path_dat, full_outfilehdr, scale_factor=10000, strip_rows=256,
+                        tile_cols=0, workers=1, plan_dir=None, interleave='bip', output_format='envi', chunks=None,
+                        codec='zlib', overviews=None, checkpoint=False, stats=True, prefetch=0, keep=None,
+                        bin_width=None, roi=None):
+
+    ###
+    # open up the two files as memmaps, nothing is read yet
+    ###
+    with stage('load'):
+        print ('opening VNIR image file: ', vnir_path_dat)
+        vnir_image = open_image(vnir_path_dat+'.hdr')
+        vnir_mm = vnir_image.open_memmap(interleave='bip')
+        print('VNIR IMAGE rows, cols, bands: ', vnir_image.nrows, vnir_image.ncols, vnir_image.nbands)
+        print('')
+
+        # and the SWIR
+        print ('opening SWIR image file: ', swir_path_dat)
+        swir_image = open_image(swir_path_dat+'.hdr')
+        swir_mm = swir_image.open_memmap(interleave='bip')
+        print('SWIR IMAGE rows, cols, bands: ', swir_image.nrows, swir_image.ncols, swir_image.nbands)
+        print('')
+
+    if (vnir_image.nrows, vnir_image.ncols) != (swir_image.nrows, swir_image.ncols):
+        raise ValueError('VNIR and SWIR cubes are not on the same spatial grid; register the SWIR first')
+
+    with stage('overlap'):
+        print('---> determining region of spectral overlap...')
+        # the strips are read raw, so the header scale factors are folded into the plan
+        plan = FusionPlan.cached(np.copy(vnir_image.bands.centers), np.copy(swir_image.bands.centers),
+                                 scale_factor, vnir_scale=vnir_image.scale_factor,
+                                 swir_scale=swir_image.scale_factor, plan_dir=plan_dir, keep=keep,
+                                 bin_width=bin_width)
+        print(' ...done <---')
+
+    ###
+    # pre-create the output cube on disk in the requested interleave and fill it tile
+    # by tile; the tiles are written through a [rows, cols, bands] view of it, which
+    # numpy copies in the file's own order
+    ###
+    md = output_metadata(vnir_image, plan, scale_factor)
+    md['file type'] = 'ENVI Standard'
+    # with a region of interest only that window of the scene is read and fused
+    region = roi_window(roi, vnir_image.nrows, vnir_image.ncols)
+    if roi is not None:
+        md = crop_metadata(md, region)
+        print('---> region of interest: rows', region[0], 'to', region[1], ', cols', region[2], 'to', region[3])
+    nrows, ncols = region[1] - region[0], region[3] - region[2]
+    row_off, col_off = region[0], region[2]
+    store, out_mm = None, None
+    if checkpoint and output_format != 'envi':
+        print('---> a chunked store is always written whole, not checkpointed')
+    # the data file stays valid as long as the plan, the layout of the output and of
+    # the inputs stay the same; each tile is then keyed by its VNIR and SWIR data
+    roi_key = () if roi is None else (region,)
+    ck = Checkpoint(full_outfilehdr, content_key('build_cube', plan.key, (nrows, ncols, plan.n_out), interleave,
+                                                 image_layout(vnir_image), image_layout(swir_image), *roi_key),
+                    inputs=[vnir_image.filename, swir_image.filename], enabled=checkpoint and output_format == 'envi')
+    # tiles have to start on whole chunks of a store and on whole blocks of the overviews
+    row_steps, col_steps = [1], [1]
+    if output_format == 'chunked':
+        # a compressed store instead; each tile is fused into memory and handed to it whole
+        full_outfilehdr = store_path(full_outfilehdr)
+        store = create_store(full_outfilehdr, (nrows, ncols, plan.n_out), 'uint16', metadata=md, chunks=chunks,
+                             codec=codec)
+        row_steps.append(store.chunks[0])
+        col_steps.append(store.chunks[1])
+        interleave = 'bip'
+    else:
+        out_mm = ck.open_output(md, 'uint16', interleave, (nrows, ncols, plan.n_out))
+    ovr = create_overviews(full_outfilehdr, (nrows, ncols, plan.n_out), md, overviews, interleave=interleave,
+                           checkpoint=ck)
+    if ovr is not None:
+        row_steps.append(ovr.factors[-1])
+        col_steps.append(ovr.factors[-1])
+    strip_rows, tile_cols = round_up(strip_rows, *row_steps), round_up(tile_cols, *col_steps)
+    band_stats = output_stats(plan, scale_factor) if stats else None
+    # statistics and overviews saved with the checkpoint already hold the tiles that
+    # are up to date; those tiles are then not read back
+    keep_stats = band_stats is not None and ck.sidecars_current([stats_path(full_outfilehdr)])
+    read_back = (ovr is not None and not ovr.reused) or (band_stats is not None and not keep_stats)
+    skipped = []
+
+    tile_cols = tile_cols_for([vnir_image.metadata['interleave'], swir_image.metadata['interleave'], interleave],
+                              tile_cols)
+    tiles = list(iter_tiles(nrows, ncols, strip_rows, tile_cols))
+
+    # a tile is read, fused and written in three steps; with prefetch they overlap
+    # (tile_executor.run_pipeline), and the tiles are then copied out of and into the
+    # memmaps by the reader and writer threads instead of being used in place; a tile
+    # is keyed from the memmaps before, so one that is up to date is not copied
+    load = np.array if prefetch else np.asarray
+    # only the bands the plan uses are read
+    vnir_bands, swir_bands = band_index(plan.vnir_bands), band_index(plan.swir_bands)
+    tile_plan = plan.on_used_bands()
+
+    def read_tile(tile):
+        row0, row1, col0, col1 = tile
+        rows, cols = slice(row0 + row_off, row1 + row_off), slice(col0 + col_off, col1 + col_off)
+        vnir_tile, swir_tile = vnir_mm[rows, cols, vnir_bands], swir_mm[rows, cols, swir_bands]
+        key = ck.stale(tile, lambda: content_key(vnir_tile, swir_tile))
+        if key is None:
+            # up to date; only overviews or statistics made anew need the fused tile
+            if read_back:
+                return None, load(out_mm[row0:row1, col0:col1])
+            skipped.append(tile)
+            return None, None
+        return key, (load(vnir_tile), load(swir_tile))
+
+    def fuse_tile(tile, data):
+        row0, row1, col0, col1 = tile
+        key, tiles_in = data
+        if key is None:
+            out_tile = tiles_in
+        elif store is None and not prefetch:
+            out_tile = tile_plan.apply(*tiles_in, out=out_mm[row0:row1, col0:col1])
+        else:
+            out_tile = tile_plan.apply(*tiles_in)
+        if out_tile is not None:
+            if ovr is not None:
+                ovr.write(row0, col0, out_tile)
+            if band_stats is not None:
+                band_stats.add(out_tile, row0, col0)
+        return key, out_tile, 0 if key is None else tiles_in[0].nbytes + tiles_in[1].nbytes
+
+    def write_tile(tile, result):
+        row0, row1, col0, col1 = tile
+        key, out_tile, nbytes_read = result
+        if key is None:
+            return
+        if store is not None:
+            store.write(row0, col0, out_tile)
+        elif prefetch:
+            out_mm[row0:row1, col0:col1] = out_tile
+        ck.record(tile, key)
+        count_bytes(read=nbytes_read, written=out_tile.nbytes)
+        print('      -> rows', row0, 'to', row1, ', cols', col0, 'to', col1)
+
+    with stage('fuse', tiles=len(tiles), workers=workers, prefetch=prefetch):
+        print('---> Fusing the cube in', len(tiles), 'tiles of', strip_rows, 'rows on', workers,
+              'worker(s), scale factor =', scale_factor)
+        if prefetch:
+            run_pipeline(tiles, read_tile, fuse_tile, write_tile, workers=workers, depth=prefetch)
+        else:
+            run_tiles(tiles, lambda tile: write_tile(tile, fuse_tile(tile, read_tile(tile))), workers=workers)
+        ck.report()
+        if keep_stats and ck.computed:
+            # the saved statistics are out of date, the tiles skipped are read back for new ones
+            run_tiles(skipped, lambda t: band_stats.add(out_mm[t[0]:t[1], t[2]:t[3]], t[0], t[2]), workers=workers)
+            keep_stats = False
+
+    with stage('save'):
+        print('---> Writing cube to: ', full_outfilehdr, end='')
+        sidecars = []
+        if ovr is not None:
+            ovr.close()
+            sidecars += ovr.files
+        if store is None:
+            out_mm.flush()
+            del out_mm
+            if band_stats is not None:
+                if not keep_stats:
+                    save_stats(full_outfilehdr, band_stats)
+                sidecars.append(stats_path(full_outfilehdr))
+            ck.save(md, sidecars)
+        else:
+            if band_stats is not None:
+                save_stats(full_outfilehdr, band_stats, store)
+            store.close()
+            print(' (%.1f MB compressed to %.1f MB)' % (store.raw_bytes / 1024.0**2, store.stored_bytes / 1024.0**2),
+                  end='')
+        if ovr is not None:
+            print(' and overviews at 1/' + ', 1/'.join(str(f) for f in ovr.factors), end='')
+        print('  ... done <---')
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description='Build the full spectrum cube from registered VNIR and SWIR cubes.')
+    parser.add_argument('--vnir', default=vnir_path_dat,
+                        help='VNIR cube, ENVI base path without .hdr (default: %(default)s)')
+    parser.add_argument('--swir', default=swir_path_dat,
+                        help='registered SWIR cube, ENVI base path without .hdr (default: %(default)s)')
+    parser.add_argument('--out', default=full_outfilehdr,
+                        help='output full spectrum .hdr (default: %(default)s)')
+    parser.add_argument('--scale-factor', type=int, default=scale_factor,
+                        help='reflectance scale factor of the uint16 output (default: %(default)s)')
+    parser.add_argument('--workers', type=int, default=workers,
+                        help='number of threads fusing tiles in parallel (default: %(default)s)')
+    parser.add_argument('--strip-rows', type=int, default=strip_rows,
+                        help='rows per strip/tile, bounds the memory per worker (default: %(default)s)')
+    parser.add_argument('--tile-cols', type=int, default=tile_cols,
+                        help='columns per tile, 0 for full width strips; only used for BIP files (default: %(default)s)')
+    parser.add_argument('--plan-dir', default=plan_dir,
+                        help='directory the fusion plans are cached in, "" to not cache (default: %(default)s)')
+    parser.add_argument('--interleave', choices=['bsq', 'bil', 'bip'], default=out_interleave,
+                        help='interleave of the fused cube (default: %(default)s)')
+    parser.add_argument('--format', choices=['envi', 'chunked'], default=out_format,
+                        help='raw ENVI cube or chunked compressed store (default: %(default)s)')
+    parser.add_argument('--chunks', default=','.join(str(n) for n in store_chunks),
+                        help='rows,cols,bands of a chunk of the store (default: %(default)s)')
+    parser.add_argument('--codec', choices=['zlib', 'lz4'], default=store_codec,
+                        help='compression of the store, lz4 needs the lz4 package (default: %(default)s)')
+    parser.add_argument('--overviews', type=int, nargs='*', default=None, metavar='F',
+                        help='also write overviews of the fused cube at these reduction factors '
+                             '(no factors: 4, 8, ... down to 128 pixels)')
+    parser.add_argument('--checkpoint', action='store_true',
+                        help='keep a content-hashed checkpoint and only recompute the tiles whose inputs changed')
+    parser.add_argument('--prefetch', type=int, default=prefetch,
+                        help='tiles read ahead and written behind on their own threads while tiles are fused, '
+                             '0 to read, fuse and write one after the other (default: %(default)s)')
+    parser.add_argument('--no-stats', action='store_true',
+                        help='do not gather the per-band statistics (header and <out>_stats.json)')
+    parser.add_argument('--roi', type=parse_roi, default=None, metavar='ROW0:ROW1,COL0:COL1',
+                        help='only read and fuse this window of the scene, e.g. 1000:3000,500:2500')
+    parser.add_argument('--keep', type=parse_ranges, default=None, metavar='LO:HI,...',
+                        help='only output the bands within these wavelength ranges, e.g. 400:1340,1460:1790')
+    parser.add_argument('--bin-width', type=float, default=None,
+                        help='resample the output onto bands this far apart (in the units of the wavelengths)')
+    parser.add_argument('--in-memory', action='store_true',
+                        help='load both cubes fully into memory instead of streaming')
+    parser.add_argument('--report', default=None,
+                        help='append the time, CPU, bytes and peak memory of every stage to this JSON-lines file')
+    parser.add_argument('--profile', default=None, help='run under cProfile and write the stats to this file')
+    args = parser.parse_args()
+    args.chunks = tuple(int(n) for n in args.chunks.split(','))
+    configure(args.report, scene=args.out)
+
+    ###
+    # starting stuff
+    ###
+    start_time = time.time()
+    start_hour = time.gmtime().tm_hour
+    start_min = time.gmtime().tm_min
+    start_sec = time.gmtime().tm_sec
+    print('Starting time [GMT]: ', start_hour,':', start_min,':',start_sec)
+    print('')
+
+    with profiled(args.profile), stage('build_cube'):
+        if args.roi is not None and args.in_memory:
+            print('---> a region of interest is always streamed, --in-memory is ignored')
+        if (streaming == 1 and not args.in_memory) or args.roi is not None:
+            build_cube_streamed(args.vnir, args.swir, args.out,
+                                scale_factor=args.scale_factor, strip_rows=args.strip_rows,
+                                tile_cols=args.tile_cols, workers=args.workers, plan_dir=args.plan_dir,
+                                interleave=args.interleave, output_format=args.format, chunks=args.chunks,
+                                codec=args.codec, overviews=args.overviews, checkpoint=args.checkpoint,
+                                stats=not args.no_stats, prefetch=args.prefetch, keep=args.keep,
+                                bin_width=args.bin_width, roi=args.roi)
+        else:
+            build_cube(args.vnir, args.swir, args.out,
+                       scale_factor=args.scale_factor, saveimage=saveimage, plan_dir=args.plan_dir,
+                       interleave=args.interleave, output_format=args.format, chunks=args.chunks,
+                       codec=args.codec, overviews=args.overviews, stats=not args.no_stats,
+                       keep=args.keep, bin_width=args.bin_width)
+
+    print("--- %5.2f seconds ---" % (time.time() - start_time))
+    print('CODE COMPLETION!')
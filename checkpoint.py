@@ -0,0 +1,233 @@
+'''
++
+=======================================================================
+
+ NAME:
+      checkpoint
+
+ DESCRIPTION:
+	content-hashed checkpoints of the tiled outputs (the warped SWIR and the fused
+cube), so a rerun after a change only redoes what the change invalidated.
+- next to an output x.hdr, x_checkpoint.json records
+  data_key    a hash of everything that fixes the layout of the data file and the
+              meaning of its values (shape, dtype, interleave, the fusion plan, the
+              layout of the input files); if it changes the output is rebuilt
+  params_key  a hash of the parameters every tile depends on (e.g. the homography)
+  inputs      the size and modification time of the input files
+  header_key  a hash of the metadata written to the header
+  tiles       the hash of the input data of every tile, by (row0,row1,col0,col1)
+  sidecars    the size and modification time of the statistics and overview files
+              saved along with the output
+- on a rerun with the same data_key the existing data file is opened in place
+(never truncated): a tile whose inputs hash to the recorded key is skipped, any
+other tile is recomputed and written; if the input files and params_key have not
+changed at all, the tiles are skipped without reading anything
+- when only the metadata changed, only the header is rewritten
+- sidecars that still match the checkpoint (and a header that was not rewritten)
+already hold what the up-to-date tiles contribute to them, so those tiles need not
+be read back to make them again
+- the checkpoint is removed before an output is rebuilt from scratch and written
+(under a temporary name) only once every tile is done; a run that dies halfway
+leaves either no checkpoint or the old one, whose keys do not match the tiles it
+already rewrote, so those are simply redone
+
+ USES:
+numpy
+spectral (from the python package spectral)
+hashlib, json, threading
+
+ NOTES:
+the fusion plan has its own cache keyed by its inputs, see fusion_plan.FusionPlan.cached.
+Hashes use blake2b, which reads at about the speed of a memory copy.
+
+ HISTORY:
+2026/10/17: created
+
+=======================================================================
+-
+'''
+
+import numpy as np
+import spectral.io.envi as envi
+import hashlib
+import json
+import os
+import threading
+
+# bump when the keys are computed differently, so old checkpoints are not trusted
+checkpoint_version = 1
+
+# header fields describing the data file itself, kept when only the metadata is rewritten
+layout_fields = ('samples', 'lines', 'bands', 'header offset', 'file type', 'data type', 'interleave',
+                 'byte order')
+
+
+def checkpoint_path(output_hdr):
+    return output_hdr[:-4] + '_checkpoint.json'
+
+
+def update_hash(h, a):
+    # feeds the bytes of an array to h in memory order, without copying whole memmap
+    # views: the axes are put in order of decreasing stride and contiguous blocks are
+    # hashed as they are
+    a = np.asarray(a)
+    if a.ndim > 1:
+        a = a.transpose(np.argsort([-abs(s) for s in a.strides], kind='stable'))
+    if a.flags.c_contiguous:
+        h.update(a.reshape(-1).view(np.uint8))
+    elif a.ndim > 1:
+        for sub in a:
+            update_hash(h, sub)
+    else:
+        h.update(np.ascontiguousarray(a).view(np.uint8))
+
+
+def content_key(*parts):
+    '''
+    Hash of the parts: numpy arrays by their values (and dtype and shape), anything
+    else by its repr.
+    '''
+    h = hashlib.blake2b(digest_size=20)
+    for p in parts:
+        if isinstance(p, np.ndarray):
+            h.update(repr((p.dtype.str, p.shape)).encode())
+            update_hash(h, p)
+        else:
+            h.update(repr(p).encode())
+        h.update(b'|')
+    return h.hexdigest()
+
+
+def image_layout(image):
+    # what decides how the values of a spectral image are read from its data file
+    return (image.filename, tuple(image.shape), np.dtype(image.dtype).str, image.metadata.get('interleave'),
+            image.byte_order, image.offset, image.scale_factor)
+
+
+def file_fingerprint(paths):
+    fp = {}
+    for path in paths:
+        st = os.stat(path)
+        fp[os.path.abspath(path)] = [st.st_size, st.st_mtime_ns]
+    return fp
+
+
+def metadata_key(metadata):
+    return content_key(sorted((str(k), str(v)) for k, v in metadata.items() if k not in layout_fields))
+
+
+def tile_name(tile):
+    return '%d,%d,%d,%d' % tuple(tile)
+
+
+class Checkpoint:
+    '''
+    The checkpoint of the output output_hdr; with enabled=False nothing is reused
+    or saved and every tile is computed.
+    '''
+
+    def __init__(self, output_hdr, data_key, params_key='', inputs=(), enabled=True):
+        self.output_hdr = output_hdr
+        self.path = checkpoint_path(output_hdr)
+        self.enabled = enabled
+        self.data_key, self.params_key = data_key, params_key
+        self.inputs = file_fingerprint(inputs) if enabled else {}
+        self.reusable = False
+        self.inputs_unchanged = False
+        self.header_key = None
+        self.header_rewritten = False
+        self.old_tiles, self.tiles = {}, {}
+        self.sidecars = {}
+        self.computed = 0
+        self._lock = threading.Lock()
+        if not enabled or not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path) as f:
+                record = json.load(f)
+        except (OSError, ValueError):
+            return
+        if record.get('version') != checkpoint_version or record.get('data_key') != data_key:
+            return
+        data_files = [f for f in (output_hdr[:-4] + ext for ext in ('.img', '', '.dat', '.raw')) if os.path.isfile(f)]
+        if not data_files:
+            return
+        self.reusable = True
+        self.old_tiles = record['tiles']
+        self.header_key = record.get('header_key')
+        self.sidecars = record.get('sidecars', {})
+        self.inputs_unchanged = record.get('inputs') == self.inputs and record.get('params_key') == params_key
+
+    def open_output(self, metadata, dtype, interleave, shape, view_interleave='bip'):
+        '''
+        A writable memmap of the output: the existing data file when the checkpoint
+        can be reused (its header rewritten if the metadata changed), otherwise a
+        newly created one.
+        '''
+        if self.reusable:
+            if metadata_key(metadata) != self.header_key:
+                header = envi.read_envi_header(self.output_hdr)
+                layout = dict((k, header[k]) for k in layout_fields if k in header)
+                header = dict((k, v) for k, v in metadata.items() if k not in layout_fields)
+                header.update(layout)
+                envi.write_envi_header(self.output_hdr, header)
+                self.header_rewritten = True
+                print('---> metadata changed, header rewritten: ', self.output_hdr)
+            return envi.open(self.output_hdr).open_memmap(interleave=view_interleave, writable=True)
+        # the old checkpoint must not vouch for the tiles of a new file
+        if os.path.exists(self.path):
+            os.remove(self.path)
+        image = envi.create_image(self.output_hdr, metadata=metadata, dtype=dtype, interleave=interleave,
+                                  shape=shape, offset=0, force=True)
+        return image.open_memmap(interleave=view_interleave, writable=True)
+
+    def stale(self, tile, key_fn):
+        '''
+        None if tile is up to date, otherwise the key to record() once it is
+        written; key_fn() hashes the tile's inputs and is only called when needed.
+        '''
+        name = tile_name(tile)
+        if self.reusable and self.inputs_unchanged and name in self.old_tiles:
+            key = self.old_tiles[name]
+        elif not self.enabled:
+            key = ''
+        else:
+            key = key_fn()
+        if self.reusable and self.old_tiles.get(name) == key:
+            with self._lock:
+                self.tiles[name] = key
+            return None
+        return key
+
+    def sidecars_current(self, paths):
+        '''
+        True if the files at paths are the ones saved with this checkpoint, unchanged
+        since, and the header was kept as it was.
+        '''
+        if not self.reusable or self.header_rewritten or not paths:
+            return False
+        if not all(os.path.exists(p) for p in paths):
+            return False
+        return all(self.sidecars.get(p) == fp for p, fp in file_fingerprint(paths).items())
+
+    def record(self, tile, key):
+        with self._lock:
+            self.tiles[tile_name(tile)] = key
+            self.computed += 1
+
+    def save(self, metadata, sidecars=()):
+        # sidecars: the files written along with the output, once they are complete
+        if not self.enabled:
+            return
+        record = {'version': checkpoint_version, 'data_key': self.data_key, 'params_key': self.params_key,
+                  'inputs': self.inputs, 'header_key': metadata_key(metadata), 'tiles': self.tiles,
+                  'sidecars': file_fingerprint(sidecars)}
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(record, f)
+        os.replace(tmp_path, self.path)
+
+    def report(self):
+        if self.reusable:
+            print('---> checkpoint: %d tile(s) up to date, %d recomputed'
+                  % (len(self.tiles) - self.computed, self.computed))
@@ -0,0 +1,367 @@
+'''
++
+=======================================================================
+
+ NAME:
+      chunked_store
+
+ DESCRIPTION:
+	a chunked, losslessly compressed cube store, as an alternative to the raw
+ENVI output of the fused cube.
+- the cube is cut into rows x cols x bands chunks, each compressed on its own
+(zlib, or lz4 if the lz4 package is installed) after a byte shuffle, which puts
+the high and low bytes of the uint16 values in separate runs
+- a store is a directory with the compressed chunks in data.bin and an index.json
+holding the shape, dtype, chunk shape, codec, the ENVI metadata of the cube and
+the offset and length of every chunk
+- CubeWriter takes chunk-aligned blocks from any number of threads; the index is
+written last, so a store whose writer did not finish has none
+- ChunkedCube opens a store lazily: cube.read(rows=(r0, r1), cols=(c0, c1),
+bands=(b0, b1)) or cube[r0:r1, c0:c1, b0:b1] decompress only the chunks they touch
+- from the command line, converts an ENVI cube to a store and back
+
+ USES:
+numpy
+spectralPy (from the python package spectral), only for the conversions
+zlib, json, threading
+lz4 (optional, pip install lz4)
+
+ PARAMETERS:
+python chunked_store.py in.hdr out.zcube   converts an ENVI cube to a store
+python chunked_store.py in.zcube out.hdr   and a store back to an ENVI cube
+--chunks R,C,B      chunk shape (default 64,64,32)
+--codec zlib|lz4    compression codec (default zlib)
+--level N           compression level
+
+ NOTES:
+missing chunks (never written) read back as zeros.
+
+ HISTORY:
+2026/10/17: created
+
+=======================================================================
+-
+'''
+
+import numpy as np
+import argparse
+import collections
+import json
+import os
+import threading
+import zlib
+
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+
+# bump when the layout of data.bin or index.json changes
+store_version = 1
+
+# rows, cols, bands of a chunk: 64x64 pixels keeps a chunk of 32 uint16 bands at 256 kB
+default_chunks = (64, 64, 32)
+
+# zlib level 1 compresses about twice as fast as the default 6, for ~10% more size
+default_levels = {'zlib': 1, 'lz4': 0}
+
+# decompressed chunks ChunkedCube keeps, so reading spectra pixel by pixel is not
+# one decompression per pixel
+cache_chunks = 64
+
+
+def _compress(raw, codec, level):
+    if codec == 'zlib':
+        return zlib.compress(raw, level)
+    if codec == 'lz4':
+        if lz4 is None:
+            raise ImportError('the lz4 codec needs the lz4 package (pip install lz4)')
+        return lz4.frame.compress(raw, compression_level=level)
+    if codec == 'none':
+        return raw
+    raise ValueError('unknown codec: ' + str(codec))
+
+
+def _decompress(blob, codec):
+    if codec == 'zlib':
+        return zlib.decompress(blob)
+    if codec == 'lz4':
+        if lz4 is None:
+            raise ImportError('this store is lz4 compressed, reading it needs the lz4 package (pip install lz4)')
+        return lz4.frame.decompress(blob)
+    if codec == 'none':
+        return blob
+    raise ValueError('unknown codec: ' + str(codec))
+
+
+def _shuffle(block):
+    # all the first bytes of the values, then all the second bytes, ...
+    return np.ascontiguousarray(block).view(np.uint8).reshape(-1, block.dtype.itemsize).T.tobytes()
+
+
+def _unshuffle(raw, dtype, shape):
+    dtype = np.dtype(dtype)
+    b = np.frombuffer(raw, dtype=np.uint8).reshape(dtype.itemsize, -1)
+    return np.ascontiguousarray(b.T).view(dtype).reshape(shape)
+
+
+def _chunk_key(i, j, k):
+    return '%d,%d,%d' % (i, j, k)
+
+
+def _span(sel, n):
+    # (start, stop) of a slice with step 1, a (start, stop) pair or None
+    if sel is None:
+        return 0, n
+    if isinstance(sel, slice):
+        start, stop, step = sel.indices(n)
+        if step != 1:
+            raise ValueError('only contiguous ranges can be read, not steps of ' + str(step))
+        return start, max(start, stop)
+    start, stop = sel
+    if not 0 <= start <= stop <= n:
+        raise IndexError('range %s out of bounds for size %d' % (str((start, stop)), n))
+    return int(start), int(stop)
+
+
+class CubeWriter:
+    '''
+    Writes a [rows, cols, bands] cube into a new store at path, block by block.
+    Call close() once every block is written; until then the store has no index.
+    '''
+
+    def __init__(self, path, shape, dtype, metadata=None, chunks=None, codec='zlib', level=None):
+        self.path = path
+        self.shape = tuple(int(n) for n in shape)
+        self.dtype = np.dtype(dtype)
+        self.chunks = tuple(int(n) for n in (chunks or default_chunks))
+        # a chunk is never bigger than the cube
+        self.chunks = tuple(min(c, n) for c, n in zip(self.chunks, self.shape))
+        self.codec = codec
+        self.level = default_levels.get(codec, 0) if level is None else level
+        self.metadata = dict(metadata or {})
+        self.index = {}
+        self.raw_bytes = 0
+        self.stored_bytes = 0
+        _compress(b'', codec, self.level)   # fail now on a codec that is not available
+        os.makedirs(path, exist_ok=True)
+        # an old store at this path stops being readable until the new one is complete
+        for name in ('index.json', 'data.bin'):
+            if os.path.exists(os.path.join(path, name)):
+                os.remove(os.path.join(path, name))
+        self._data = open(os.path.join(path, 'data.bin'), 'wb')
+        self._lock = threading.Lock()
+
+    def write(self, row0, col0, block, band0=0):
+        '''
+        Compresses and stores block, whose [0, 0, 0] is the cube's [row0, col0, band0].
+        The block has to start on a chunk boundary and end on one or at the edge
+        of the cube, so no chunk is ever split between two calls.
+        '''
+        block = np.asarray(block)
+        starts = (row0, col0, band0)
+        for axis, (start, size) in enumerate(zip(starts, block.shape)):
+            c, n = self.chunks[axis], self.shape[axis]
+            stop = start + size
+            if start % c or (stop % c and stop != n) or stop > n:
+                raise ValueError('block %s at %s is not aligned to the chunks %s of the store'
+                                 % (block.shape, starts, self.chunks))
+        cr, cc, cb = self.chunks
+        for r in range(0, block.shape[0], cr):
+            for c in range(0, block.shape[1], cc):
+                for b in range(0, block.shape[2], cb):
+                    chunk = block[r:r + cr, c:c + cc, b:b + cb].astype(self.dtype, copy=False)
+                    blob = _compress(_shuffle(chunk), self.codec, self.level)
+                    key = _chunk_key((row0 + r) // cr, (col0 + c) // cc, (band0 + b) // cb)
+                    with self._lock:
+                        offset = self._data.tell()
+                        self._data.write(blob)
+                        self.index[key] = [offset, len(blob)]
+                        self.raw_bytes += chunk.nbytes
+                        self.stored_bytes += len(blob)
+
+    def close(self):
+        self._data.close()
+        index = {'format': 'chunked cube', 'version': store_version, 'shape': list(self.shape),
+                 'dtype': self.dtype.str, 'chunks': list(self.chunks), 'codec': self.codec,
+                 'shuffle': True, 'metadata': self.metadata, 'chunk_index': self.index}
+        tmp_path = os.path.join(self.path, 'index.json.tmp')
+        with open(tmp_path, 'w') as f:
+            # numpy arrays in the metadata (e.g. the wavelengths) go in as lists
+            json.dump(index, f, default=lambda v: v.tolist() if hasattr(v, 'tolist') else str(v))
+        os.replace(tmp_path, os.path.join(self.path, 'index.json'))
+
+
+def create_store(path, shape, dtype, metadata=None, chunks=None, codec='zlib', level=None):
+    return CubeWriter(path, shape, dtype, metadata=metadata, chunks=chunks, codec=codec, level=level)
+
+
+def store_path(path):
+    # where the store of an output given as an ENVI header goes: x.hdr -> x.zcube
+    return path[:-4] + '.zcube' if path.lower().endswith('.hdr') else path
+
+
+def is_store(path):
+    return os.path.isfile(os.path.join(path, 'index.json'))
+
+
+class ChunkedCube:
+    '''
+    A store opened for reading; nothing but the index is read until a region is
+    asked for.  cube[r0:r1, c0:c1, b0:b1] and cube.read() return [rows, cols, bands]
+    numpy arrays.
+    '''
+
+    def __init__(self, path):
+        index_path = os.path.join(path, 'index.json')
+        if not os.path.isfile(index_path):
+            raise FileNotFoundError('no chunked cube at ' + path + ' (or its writer did not finish)')
+        with open(index_path) as f:
+            index = json.load(f)
+        if index.get('version') != store_version:
+            raise ValueError('chunked cube ' + path + ' has an unsupported version: ' + str(index.get('version')))
+        self.path = path
+        self.shape = tuple(index['shape'])
+        self.nrows, self.ncols, self.nbands = self.shape
+        self.dtype = np.dtype(index['dtype'])
+        self.chunks = tuple(index['chunks'])
+        self.codec = index['codec']
+        self.metadata = index['metadata']
+        self.chunk_index = index['chunk_index']
+        self._data = open(os.path.join(path, 'data.bin'), 'rb')
+        self._lock = threading.Lock()
+        self._cache = collections.OrderedDict()
+
+    @property
+    def wavelengths(self):
+        return np.array(self.metadata['wavelength'], dtype=float) if 'wavelength' in self.metadata else None
+
+    @property
+    def scale_factor(self):
+        return float(self.metadata.get('reflectance scale factor', 1))
+
+    def read_chunk(self, i, j, k):
+        # the decompressed chunk (i, j, k) of the chunk grid
+        key = _chunk_key(i, j, k)
+        with self._lock:
+            if key in self._cache:
+                self._cache.move_to_end(key)
+                return self._cache[key]
+        shape = tuple(min(c, n - c * ijk) for c, n, ijk in zip(self.chunks, self.shape, (i, j, k)))
+        if key not in self.chunk_index:
+            chunk = np.zeros(shape, dtype=self.dtype)
+        else:
+            offset, nbytes = self.chunk_index[key]
+            with self._lock:
+                self._data.seek(offset)
+                blob = self._data.read(nbytes)
+            chunk = _unshuffle(_decompress(blob, self.codec), self.dtype, shape)
+        with self._lock:
+            self._cache[key] = chunk
+            while len(self._cache) > cache_chunks:
+                self._cache.popitem(last=False)
+        return chunk
+
+    def read(self, rows=None, cols=None, bands=None):
+        '''
+        The [rows, cols, bands] block of the cube; each of rows, cols and bands is a
+        (start, stop) pair, a slice with step 1 or None for all of them.  Only the
+        chunks the block overlaps are read.
+        '''
+        spans = [_span(sel, n) for sel, n in zip((rows, cols, bands), self.shape)]
+        out = np.zeros([stop - start for start, stop in spans], dtype=self.dtype)
+        if out.size == 0:
+            return out
+        grid = [range(start // c, (stop - 1) // c + 1) for (start, stop), c in zip(spans, self.chunks)]
+        for i in grid[0]:
+            for j in grid[1]:
+                for k in grid[2]:
+                    chunk = self.read_chunk(i, j, k)
+                    src, dst = [], []
+                    for (start, stop), c, ijk in zip(spans, self.chunks, (i, j, k)):
+                        lo, hi = max(start, c * ijk), min(stop, c * (ijk + 1))
+                        src.append(slice(lo - c * ijk, hi - c * ijk))
+                        dst.append(slice(lo - start, hi - start))
+                    out[tuple(dst)] = chunk[tuple(src)]
+        return out
+
+    def __getitem__(self, key):
+        if not isinstance(key, tuple):
+            key = (key,)
+        if len(key) > 3:
+            raise IndexError('a cube has 3 dimensions')
+        key = key + (slice(None),) * (3 - len(key))
+        spans, squeeze = [], []
+        for axis, sel in enumerate(key):
+            if isinstance(sel, (int, np.integer)):
+                n = self.shape[axis]
+                sel = int(sel) + n if sel < 0 else int(sel)
+                if not 0 <= sel < n:
+                    raise IndexError('index %d out of bounds for size %d' % (sel, n))
+                spans.append((sel, sel + 1))
+                squeeze.append(axis)
+            else:
+                spans.append(sel)
+        block = self.read(*spans)
+        return block.squeeze(axis=tuple(squeeze)) if squeeze else block
+
+    def close(self):
+        self._data.close()
+
+
+def open_store(path):
+    return ChunkedCube(path)
+
+
+def envi_to_store(hdr_path, path, chunks=None, codec='zlib', level=None):
+    # streams an ENVI cube into a new store, one strip of chunk rows at a time
+    from spectral import open_image
+    image = open_image(hdr_path)
+    mm = image.open_memmap(interleave='bip')
+    writer = create_store(path, mm.shape, mm.dtype, metadata=image.metadata, chunks=chunks, codec=codec,
+                          level=level)
+    rows = writer.chunks[0]
+    for row0 in range(0, image.nrows, rows):
+        writer.write(row0, 0, mm[row0:row0 + rows])
+    writer.close()
+    return writer
+
+
+def store_to_envi(path, hdr_path, interleave='bip'):
+    # writes a store back out as an ENVI cube, one strip of chunk rows at a time
+    import spectral.io.envi as envi
+    cube = open_store(path)
+    md = dict(cube.metadata)
+    md['file type'] = 'ENVI Standard'
+    out = envi.create_image(hdr_path, metadata=md, dtype=cube.dtype, interleave=interleave, shape=cube.shape,
+                            offset=0, force=True)
+    out_mm = out.open_memmap(interleave='bip', writable=True)
+    rows = cube.chunks[0]
+    for row0 in range(0, cube.nrows, rows):
+        out_mm[row0:row0 + rows] = cube.read(rows=(row0, min(row0 + rows, cube.nrows)))
+    out_mm.flush()
+    cube.close()
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description='Convert an ENVI cube to a chunked compressed store, or back.')
+    parser.add_argument('input', help='ENVI header (.hdr) or store directory')
+    parser.add_argument('output', help='store directory, or ENVI header (.hdr) when the input is a store')
+    parser.add_argument('--chunks', default=','.join(str(n) for n in default_chunks),
+                        help='rows,cols,bands of a chunk (default: %(default)s)')
+    parser.add_argument('--codec', choices=['zlib', 'lz4', 'none'], default='zlib',
+                        help='compression codec (default: %(default)s)')
+    parser.add_argument('--level', type=int, default=None, help='compression level of the codec')
+    parser.add_argument('--interleave', choices=['bsq', 'bil', 'bip'], default='bip',
+                        help='interleave of the ENVI cube written from a store (default: %(default)s)')
+    args = parser.parse_args()
+
+    if is_store(args.input):
+        store_to_envi(args.input, args.output, interleave=args.interleave)
+        print('---> ENVI cube written to: ', args.output)
+    else:
+        chunks = tuple(int(n) for n in args.chunks.split(','))
+        writer = envi_to_store(args.input, args.output, chunks=chunks, codec=args.codec, level=args.level)
+        print('---> store written to: ', args.output, ' %.1f MB -> %.1f MB'
+              % (writer.raw_bytes / 1024.0**2, writer.stored_bytes / 1024.0**2))
@@ -7,33 +7,74 @@
 
  DESCRIPTION:
 registers a SWIR HSI to the VNIR HSI by allowing the user to choose control points in a GUI window
-- reads in the VNIR and SWIR cubes
-- displays a GUI with both images side by side
+- opens the VNIR and SWIR cubes as memmaps and reads only the ~950 nm bands it displays,
+ so the window comes up without loading either full cube into memory
+- displays a GUI with both images side by side; each is shown through an overview
+ pyramid (overviews.ImagePyramid), drawing only the level that matches the screen and
+ full resolution only for the region zoomed into, so large scenes pan and zoom smoothly
 - user chooses control points: note that it is very useful to zoom in to choose
  accurate points; you can zoom with the left mouse button (after selecting the
  magnifying glass in the menu bar) and choose the points in each window with the right mouse button
+- or, with --auto, matches features between the two ~950 nm images automatically
 - computes the homography at the two images nearest to 950 nm
-- warps the entire SWIR image with that homography
+- warps the entire SWIR image with that homography: the flip and the homography are folded
+ into one cv2.remap map pair (the homography maps native SWIR pixels to VNIR pixels, so
+ the resolution change happens in the same single interpolation), and the SWIR is streamed in strips of the VNIR grid, each
+ reading only the SWIR rows it samples from, warped on a thread pool and written straight
+ into the memmapped (BSQ, float32 reflectance) ENVI output
 - outputs a warped SWIR image
+- saves the homography, the control points and the RANSAC inlier mask to a sidecar
+<orig_file_homography.json>, keyed by a hash of both headers and of the bands used for
+the registration; running the same pair again reuses it without opening the GUI
+- with --homography the SWIR is warped headless from a saved sidecar (or a plain 3x3
+text file), e.g. the one from another scan taken with the same rig geometry; sidecars
+record the grid shapes, so one found at another spatial binning is rescaled to fit
 
  USES:
 cv2 (from the package OpenCV)
 numpy
-matplotlib
+matplotlib (for the GUI only, imported when it is opened)
 sys
 spectral (from the python package spectral)
 os
 time
+argparse
+hashlib
+json
+tile_executor, stage_timing, overviews, checkpoint (from this repository)
 
  PARAMETERS:
-needs the paths to the VNIR and SWIR envi header files all the way at the bottom of the code
+needs the paths to the VNIR and SWIR envi header files all the way at the bottom of the code,
+or on the command line:
+--vnir path.hdr, --swir path.hdr
+--homography file   warp with a saved homography (.json sidecar or 3x3 text file) instead of
+                    picking points in the GUI
+--reselect          ignore the cached homography of this pair and pick the points again
+--auto              pick the control points automatically (ORB/AKAZE features matched on an
+                    image pyramid, refined at full resolution); the GUI is only opened when
+                    fewer than --min-inliers RANSAC inliers are found
+--min-inliers N, --detector orb|akaze|sift
+--workers N         threads warping strips of the SWIR in parallel
+--strip-rows N      rows of the VNIR grid per warped strip (default 256)
+--prefetch N        overlap reading, warping and writing the strips, with up to N strips
+                    read ahead and N written behind (0: one after the other, default)
+--interpolation nearest|linear|cubic|lanczos
+                    kernel resampling the SWIR onto the VNIR grid (default linear)
+--roi row0:row1,col0:col1
+                    only warp that window of the VNIR grid; only the SWIR rows and columns
+                    it samples from are read
+--checkpoint        with --homography, only re-warp the strips whose SWIR data or homography
+                    changed since the last run (<swir>_warped_checkpoint.json)
+--report file       append a JSON line per stage (load, auto_registration, warp, save) with
+                    its wall and CPU time, bytes read/written and peak memory (stage_timing)
+--profile file      run under cProfile and save the stats
 
  KEYWORDS:
 
 
  RETURNS:
 saves a warped SWIR image to the same directory where the original file is with a
-new file name <orig_file_warped.hdr>
+new file name <orig_file_warped.hdr>, and the homography sidecar <orig_file_homography.json>
 
  NOTES:
 the code assumes that the SWIR image is flipped relative to the VNIR image which should
@@ -52,13 +93,17 @@ always be the case unless the camera orientations are changed
 
 import cv2
 import numpy as np
-import matplotlib.pyplot as plt
-from matplotlib.widgets import Slider, Button
 import sys
 from spectral.io import envi
 import os
 import time
-from scipy.ndimage import zoom
+import argparse
+import hashlib
+import json
+from tile_executor import iter_tiles, run_tiles, run_pipeline, parse_roi, roi_window, crop_metadata
+from overviews import ImagePyramid, ViewportImage, pyramid_view
+from checkpoint import Checkpoint, content_key, image_layout
+from stage_timing import stage, part, count_bytes, configure, profiled
 # import rasterio
 
 # def visualize_matches(image1, keypoints1, image2, keypoints2, matches):
@@ -92,13 +137,14 @@ def load_images_envi(vnir_path, swir_path):
     vnir_profile = vnir_ds.metadata
     vnir_wavelengths = vnir_profile["wavelength"]
     vnir_wavelengths = np.array([float(i) for i in vnir_wavelengths])
-    vnir_arr = np.transpose(vnir_ds.load(), [2,0,1])
+    # band-first memmap views, nothing is read until a band is asked for
+    vnir_arr = vnir_ds.open_memmap(interleave='bsq')
 
     swir_ds = envi.open(swir_path)
     swir_profile = swir_ds.metadata
     swir_wavelengths = swir_profile["wavelength"]
     swir_wavelengths = np.array([float(i) for i in swir_wavelengths])
-    swir_arr = np.transpose(swir_ds.load(), [2,0,1])
+    swir_arr = swir_ds.open_memmap(interleave='bsq')
 
     print(' ... done <---')
     print('Shape of VNIR: ', vnir_arr.shape[0], vnir_arr.shape[1], vnir_arr.shape[2])
@@ -106,10 +152,29 @@ def load_images_envi(vnir_path, swir_path):
 
     return (vnir_arr, vnir_profile, vnir_wavelengths), (swir_arr, swir_profile, swir_wavelengths)
 
-def init_figs(vnir_arr,
-              vnir_wavelengths,
-              swir_arr,
-              swir_wavelengths):
+def reflectance_scale(profile):
+    # what the raw values are divided by to get reflectance
+    return float(profile.get('reflectance scale factor', 1))
+
+def read_bands(arr, bands, scale=1.0):
+    # reads just these bands of a lazily opened (band-first) cube as a C-ordered
+    # float32 [bands, rows, cols] block of reflectance, the same values load() would
+    # have given for them. How the copy is done follows the file's interleave: from
+    # BSQ and BIL every band row is already contiguous on disk and is copied as is,
+    # from BIP (bands varying fastest) each image row is transposed on its own, which
+    # stays in cache, instead of one strided copy across the whole block.
+    block = arr[bands]
+    if block.ndim == 3 and abs(block.strides[0]) < abs(block.strides[2]):
+        out = np.empty(block.shape, dtype=np.float32)
+        for r in range(block.shape[1]):
+            out[:, r, :] = block[:, r, :]
+    else:
+        out = np.array(block, dtype=np.float32, order='C')
+    if scale != 1:
+        out /= np.float32(scale)
+    return out
+
+def registration_bands(vnir_wavelengths, swir_wavelengths):
 
     # picking a band close to
     vnir_pair_index = np.argmin(abs((vnir_wavelengths - 950)))
@@ -121,10 +186,30 @@ def init_figs(vnir_arr,
     window_size_vnir = int((window_size / res_vnir) / 2)
     res_swir = 6
     window_size_swir = int((window_size / res_swir) / 2)
-    vnir_image = np.mean(vnir_arr[vnir_pair_index - window_size_vnir:vnir_pair_index + window_size_vnir],
-                         0)  # spectral res: 1.6 nm
-    swir_image = np.mean(swir_arr[swir_pair_index - window_size_swir:swir_pair_index + window_size_swir],
-                         0)  # spectral res: 6 nm
+    return (slice(vnir_pair_index - window_size_vnir, vnir_pair_index + window_size_vnir),  # spectral res: 1.6 nm
+            slice(swir_pair_index - window_size_swir, swir_pair_index + window_size_swir))  # spectral res: 6 nm
+
+def registration_images(vnir_arr, vnir_wavelengths, swir_arr, swir_wavelengths, vnir_scale=1.0, swir_scale=1.0):
+    # the band-averaged images near 950 nm the homography is computed from, only
+    # these bands are read from the cubes
+    vnir_bands, swir_bands = registration_bands(vnir_wavelengths, swir_wavelengths)
+    vnir_image = np.mean(read_bands(vnir_arr, vnir_bands, vnir_scale), 0)
+    swir_image = np.mean(read_bands(swir_arr, swir_bands, swir_scale), 0)
+    return vnir_image, swir_image
+
+def to_uint8(x):
+    return ((x - x.min()) / (x.max() - x.min()) * 255).astype(np.uint8)
+
+def display_pyramids(vnir_image, swir_image):
+    # the uint8 images shown for picking points and their overview pyramids, built
+    # once per session rather than on every retry
+    vnir_image_uint8 = to_uint8(vnir_image)
+    swir_image_uint8 = np.fliplr(to_uint8(swir_image))
+    return vnir_image_uint8, swir_image_uint8, ImagePyramid(vnir_image_uint8), ImagePyramid(swir_image_uint8)
+
+def init_figs(vnir_image, swir_image, display=None):
+    # matplotlib is only imported by the GUI, so headless use does not load it
+    import matplotlib.pyplot as plt
 
     # Create a figure with two subplots in a single row
     fig, (ax1, ax2) = plt.subplots(1, 2, figsize=(10, 5))
@@ -132,20 +217,158 @@ def init_figs(vnir_arr,
     # convert that to uint8 for cv2
     plt.suptitle("Use the right mouse button to pick points; at least 4. \n"
                  "Close the figure when finished.")
-    to_uint8 = lambda x: ((x - x.min()) / (x.max() - x.min()) * 255).astype(np.uint8)
-    vnir_image_uint8 = to_uint8(vnir_image)
-    swir_image_uint8 = np.fliplr(to_uint8(swir_image))
+    if display is None:
+        display = display_pyramids(vnir_image, swir_image)
+    vnir_image_uint8, swir_image_uint8, vnir_pyramid, swir_pyramid = display
 
-    # Display the VNIR image on the left subplot
-    ax1.imshow(vnir_image_uint8)
+    # Display the VNIR image on the left subplot; only the overview level matching the
+    # screen is drawn, and full resolution only for the region zoomed into
+    fig.vnir_view = pyramid_view(ax1, vnir_pyramid)
     ax1.set_title('VNIR Image')
 
     # Display the SWIR image on the right subplot
-    ax2.imshow(swir_image_uint8)
+    fig.swir_view = pyramid_view(ax2, swir_pyramid)
     ax2.set_title('SWIR Image')
 
     return fig, ax1, ax2, vnir_image, vnir_image_uint8, swir_image, swir_image_uint8
 
+def overlay_view(ax, vnir_pyramid, swir_pyramid, M):
+    # the SWIR warped with M under the VNIR, both at half opacity. Only the visible
+    # region is warped, at the resolution of the VNIR level on screen and from the
+    # matching SWIR level, so zooming and panning stay interactive on large scenes
+    vnir_full, swir_full = vnir_pyramid.levels[0], swir_pyramid.levels[0]
+    Minv = np.linalg.inv(np.asarray(M, dtype=np.float64))
+
+    def render_swir(ax, x0, x1, y0, y1, screen_px):
+        k, (i0, i1, j0, j1), extent = vnir_pyramid.grid(x0, x1, y0, y1, screen_px)
+        ks = min(k, len(swir_pyramid.levels) - 1)
+        # shown pixel (u, v) -> full resolution VNIR -> full resolution SWIR -> SWIR level ks
+        shown_to_vnir = np.linalg.inv(vnir_pyramid.to_level(k)) @ np.array([[1, 0, j0], [0, 1, i0], [0, 0, 1.0]])
+        T = swir_pyramid.to_level(ks) @ Minv @ shown_to_vnir
+        warped = cv2.warpPerspective(swir_pyramid.levels[ks], T, (j1 - j0, i1 - i0),
+                                     flags=cv2.INTER_LINEAR | cv2.WARP_INVERSE_MAP)
+        return warped, extent
+
+    # fixed color limits, so the contrast does not change with the region shown
+    swir_view = ViewportImage(ax, vnir_full.shape, render_swir, alpha=0.5,
+                              vmin=min(0.0, float(swir_full.min())), vmax=float(swir_full.max()))
+    vnir_view = pyramid_view(ax, vnir_pyramid, alpha=0.5, vmin=float(vnir_full.min()), vmax=float(vnir_full.max()))
+    return swir_view, vnir_view
+
+def match_features(vnir_uint8, swir_uint8, detector='orb', ratio=0.8):
+    # detect and match features between the two (already flipped) images, Lowe's ratio test
+    if detector == 'orb':
+        det, norm = cv2.ORB_create(nfeatures=4000), cv2.NORM_HAMMING
+    elif detector == 'akaze' and hasattr(cv2, 'AKAZE_create'):
+        det, norm = cv2.AKAZE_create(), cv2.NORM_HAMMING
+    elif detector == 'sift' and hasattr(cv2, 'SIFT_create'):
+        det, norm = cv2.SIFT_create(), cv2.NORM_L2
+    else:
+        raise ValueError('feature detector %s is not available in this OpenCV build' % detector)
+    kp_v, des_v = det.detectAndCompute(vnir_uint8, None)
+    kp_s, des_s = det.detectAndCompute(swir_uint8, None)
+    if des_v is None or des_s is None or len(kp_v) < 2 or len(kp_s) < 2:
+        return np.zeros((0, 2)), np.zeros((0, 2))
+    matcher = cv2.BFMatcher(norm)
+    good = [m[0] for m in matcher.knnMatch(des_s, des_v, k=2)
+            if len(m) == 2 and m[0].distance < ratio * m[1].distance]
+    swir_pts = np.array([kp_s[m.queryIdx].pt for m in good]).reshape(-1, 2)
+    vnir_pts = np.array([kp_v[m.trainIdx].pt for m in good]).reshape(-1, 2)
+    return vnir_pts, swir_pts
+
+def refine_points(vnir_image, swir_flipped, H, swir_pts, half_size=15, search=6, min_score=0.6):
+    # refines coarse matches at full resolution: the SWIR image is warped onto the VNIR
+    # grid with the coarse homography and a patch around each predicted point is
+    # template matched against the VNIR, with a parabolic fit for the sub-pixel peak
+    nrows, ncols = vnir_image.shape
+    warped = cv2.warpPerspective(swir_flipped, H, (ncols, nrows))
+    pred = cv2.perspectiveTransform(swir_pts.reshape(-1, 1, 2).astype(np.float64), H).reshape(-1, 2)
+    Hinv = np.linalg.inv(H)
+    r, sr = half_size, half_size + search
+    vnir_out, swir_out = [], []
+    for px, py in np.round(pred).astype(int):
+        if px - sr < 0 or py - sr < 0 or px + sr >= ncols or py + sr >= nrows:
+            continue
+        template = warped[py-r:py+r+1, px-r:px+r+1]
+        if template.std() < 1e-6:
+            continue
+        window = vnir_image[py-sr:py+sr+1, px-sr:px+sr+1]
+        score = cv2.matchTemplate(window, template, cv2.TM_CCOEFF_NORMED)
+        _, peak, _, (ix, iy) = cv2.minMaxLoc(score)
+        if peak < min_score:
+            continue
+        dx, dy = float(ix), float(iy)
+        if 0 < ix < score.shape[1] - 1:
+            l, c, rr = score[iy, ix-1], score[iy, ix], score[iy, ix+1]
+            dx += 0.5 * (l - rr) / (l - 2*c + rr) if (l - 2*c + rr) != 0 else 0.0
+        if 0 < iy < score.shape[0] - 1:
+            u, c, d = score[iy-1, ix], score[iy, ix], score[iy+1, ix]
+            dy += 0.5 * (u - d) / (u - 2*c + d) if (u - 2*c + d) != 0 else 0.0
+        # the template centre (px, py) is where this SWIR point lands, and its content
+        # is found in the VNIR at (px, py) + offset
+        swir_out.append(cv2.perspectiveTransform(np.array([[[px, py]]], np.float64), Hinv)[0, 0])
+        vnir_out.append((px + dx - search, py + dy - search))
+    return np.array(vnir_out).reshape(-1, 2), np.array(swir_out).reshape(-1, 2)
+
+def reprojection_error(M, swir_pts, vnir_pts):
+    proj = cv2.perspectiveTransform(swir_pts.reshape(-1, 1, 2).astype(np.float64), M).reshape(-1, 2)
+    return np.sqrt(np.sum((proj - vnir_pts)**2, axis=1))
+
+def fit_homography(swir_points, vnir_points):
+    # the homography of the picked points and the RANSAC inlier mask, or None when
+    # cv2.findHomography finds none (e.g. the points are collinear or repeated)
+    M, mask = cv2.findHomography(np.asarray(swir_points, dtype=np.float64), np.asarray(vnir_points, dtype=np.float64),
+                                 cv2.RANSAC, 5)
+    if M is None:
+        return None
+    return M, mask
+
+def auto_control_points(vnir_image, swir_image, detector='orb', max_levels=3, min_size=256):
+    '''
+    Picks the control points automatically on the ~950 nm images: features are
+    detected and matched on the coarsest level of an image pyramid (fast on large
+    scenes), the coarse homography is scaled up and each inlier match is refined at
+    full resolution, then the homography is fitted with the same
+    cv2.findHomography(..., cv2.RANSAC, 5) as the GUI points.  SWIR points are in
+    the flipped SWIR image, like in the GUI.  Returns a dict with the points, M, the
+    inlier mask, the number of inliers and the reprojection errors, or None when no
+    homography could be found.
+    '''
+    vnir_image = vnir_image.astype(np.float32)
+    swir_flipped = np.ascontiguousarray(np.fliplr(swir_image)).astype(np.float32)
+
+    # coarse level: halve both images until the smaller side gets near min_size
+    level = 0
+    vnir_coarse, swir_coarse = vnir_image, swir_flipped
+    while level < max_levels and min(vnir_coarse.shape + swir_coarse.shape) >= 2 * min_size:
+        vnir_coarse, swir_coarse = cv2.pyrDown(vnir_coarse), cv2.pyrDown(swir_coarse)
+        level += 1
+    vnir_pts, swir_pts = match_features(to_uint8(vnir_coarse), to_uint8(swir_coarse), detector=detector)
+    print('      -> pyramid level', level, ':', len(vnir_pts), 'feature matches')
+    if len(vnir_pts) < 4:
+        return None
+    H, mask = cv2.findHomography(swir_pts, vnir_pts, cv2.RANSAC, 3)
+    if H is None:
+        return None
+    inliers = mask.ravel() == 1
+    S = np.diag([2.0**level, 2.0**level, 1.0])
+    H = S @ H @ np.linalg.inv(S)
+    swir_pts = swir_pts[inliers] * 2.0**level
+
+    # full resolution refinement
+    vnir_pts, swir_pts = refine_points(vnir_image, swir_flipped, H, swir_pts)
+    print('      ->', len(vnir_pts), 'points refined at full resolution')
+    if len(vnir_pts) < 4:
+        return None
+    M, mask = cv2.findHomography(swir_pts, vnir_pts, cv2.RANSAC, 5)
+    if M is None:
+        return None
+    inliers = mask.ravel() == 1
+    errors = reprojection_error(M, swir_pts[inliers], vnir_pts[inliers])
+    return {'vnir_points': vnir_pts, 'swir_points': swir_pts, 'M': M, 'mask': mask,
+            'n_inliers': int(inliers.sum()),
+            'rms_error': float(np.sqrt(np.mean(errors**2))), 'max_error': float(errors.max())}
+
 
 # def save_image(swir_arr, swir_wavelengths, swir_path, vnir_arr, vnir_profile, M):
 #     swir_registered_bands = []
@@ -172,37 +395,82 @@ def init_figs(vnir_arr,
 #     print("Registered Image Saved to " + output_path)
 #     sys.exit()
 
-def save_image_envi(swir_arr, swir_wavelengths, swir_path, vnir_arr, vnir_profile, M):
-
-# need to upsample the SWIR image to the VNIR image spatial grid first
-# Upsample each band
-#     print("     ---> Spatially Upsampling Each Band...", end="")
-#     print('')
-#     print('swir_path:', swir_path)
-#     print('bands : samples : lines')
-#     print('Shape of VNIR: ', vnir_arr.shape[0], vnir_arr.shape[1], vnir_arr.shape[2])
-#     print('Shape of SWIR: ', swir_arr.shape[0], swir_arr.shape[1], swir_arr.shape[2])
-#     upsample_ratio = vnir_arr.shape[2] / swir_arr.shape[2]
-#     print('upsample ratio: ', upsample_ratio)
-#     swir_cube_up = zoom(swir_arr, zoom=[1,upsample_ratio,upsample_ratio])
-#     print('  ... done <---')
-# # Get the dimensions of the data cube
-#     b,c,r = swir_cube_up.shape
-#     print('VNIR shape: ', vnir_arr.shape[0], vnir_arr.shape[1], vnir_arr.shape[2])
-#     print('Shape of upsampled SWIR cube [r,c,b]: ',r,c,b )
-# #    sys.exit()
-
-    swir_registered_bands = []
-    for i in range(len(swir_wavelengths)):
-        swir_registered_bands.append(
-            cv2.warpPerspective(np.fliplr(swir_arr[i]), M, (vnir_arr.shape[2], vnir_arr.shape[1])))
-            #cv2.warpPerspective(np.fliplr(swir_cube_up[i]), M, (vnir_arr.shape[2], vnir_arr.shape[1])))
-    par_dir = os.path.dirname(swir_path)
-
-    print('Saving the registered SWIR cube...')
-    output_path = swir_path.replace(".hdr","_warped.hdr")
-    print(output_path)
-
+# interpolation kernels of the warp: the cv2 flag and the number of source pixels the
+# kernel reaches on each side of a sample position
+interpolations = {'nearest': (cv2.INTER_NEAREST, 1),
+                  'linear': (cv2.INTER_LINEAR, 1),
+                  'cubic': (cv2.INTER_CUBIC, 2),
+                  'lanczos': (cv2.INTER_LANCZOS4, 4)}
+
+def grid_scale(from_shape, to_shape):
+    # 3x3 matrix taking (x, y) pixel coordinates of a to_shape grid to those of a
+    # from_shape grid covering the same area (e.g. the same sensor binned differently)
+    ky, kx = from_shape[0] / to_shape[0], from_shape[1] / to_shape[1]
+    return np.array([[kx, 0.0, (kx - 1) / 2],
+                     [0.0, ky, (ky - 1) / 2],
+                     [0.0, 0.0, 1.0]])
+
+def rescale_homography(M, swir_from, swir_to, vnir_from, vnir_to):
+    # the homography M, found between a swir_from and a vnir_from grid, for the same
+    # scene on swir_to and vnir_to grids: the change of resolution is composed into
+    # M, so the warp still takes the native SWIR to the VNIR grid in one remap instead
+    # of resampling the cube first and interpolating it a second time (the flip
+    # commutes with the scaling, so this holds for the flipped SWIR coordinates too)
+    return np.linalg.inv(grid_scale(vnir_from, vnir_to)) @ np.asarray(M, dtype=np.float64) @ grid_scale(swir_from, swir_to)
+
+def build_remap(M, swir_shape, vnir_shape, rows=None, cols=None, block_rows=256):
+    # precomputes the cv2.remap maps taking each (unflipped) SWIR band straight onto the
+    # VNIR grid: the left-right flip is folded into the inverse homography, so a single
+    # remap replaces np.fliplr + cv2.warpPerspective, which re-derives the same mapping
+    # for every band. M maps native SWIR pixels to VNIR pixels, so any difference in
+    # resolution is part of it and the SWIR is never upsampled separately. The maps stay float32 (converting them to OpenCV's fixed-point
+    # format would snap the sample positions to 1/32 pixel and change the result).
+    # rows/cols = (start, stop) restrict the maps to a window of the VNIR grid.
+    nrows, ncols = vnir_shape
+    row0, row1 = rows if rows is not None else (0, nrows)
+    col0, col1 = cols if cols is not None else (0, ncols)
+    flip = np.array([[-1.0, 0.0, swir_shape[1] - 1.0],
+                     [0.0, 1.0, 0.0],
+                     [0.0, 0.0, 1.0]])
+    Minv = flip @ np.linalg.inv(np.asarray(M, dtype=np.float64))
+
+    map_x = np.empty((row1 - row0, col1 - col0), dtype=np.float32)
+    map_y = np.empty((row1 - row0, col1 - col0), dtype=np.float32)
+    x = np.arange(col0, col1, dtype=np.float64)
+    for r0 in range(row0, row1, block_rows):
+        r1 = min(r0 + block_rows, row1)
+        y = np.arange(r0, r1, dtype=np.float64)[:, None]
+        w = Minv[2,0]*x + Minv[2,1]*y + Minv[2,2]
+        w = np.where(w != 0, 1.0 / w, 0.0)
+        map_x[r0-row0:r1-row0] = (Minv[0,0]*x + Minv[0,1]*y + Minv[0,2]) * w
+        map_y[r0-row0:r1-row0] = (Minv[1,0]*x + Minv[1,1]*y + Minv[1,2]) * w
+    return map_x, map_y
+
+def remap_source_window(map_x, map_y, swir_shape, interpolation='linear'):
+    # the (row0, row1, col0, col1) block of the SWIR the maps sample from, padded by
+    # the footprint of the interpolation kernel; None if the maps fall entirely outside
+    # the SWIR. Warping just this block gives exactly the values of warping the whole SWIR.
+    reach = interpolations[interpolation][1]
+    margin = reach + 1
+    inside = ((map_x > -reach) & (map_x < swir_shape[1] + reach - 1) &
+              (map_y > -reach) & (map_y < swir_shape[0] + reach - 1))
+    if not inside.any():
+        return None
+    xs, ys = map_x[inside], map_y[inside]
+    return (max(int(np.floor(ys.min())) - margin + 1, 0), min(int(np.floor(ys.max())) + margin + 1, swir_shape[0]),
+            max(int(np.floor(xs.min())) - margin + 1, 0), min(int(np.floor(xs.max())) + margin + 1, swir_shape[1]))
+
+def remap_bands(src, map_x, map_y, out, interpolation='linear'):
+    # warps a [rows, cols, bands] float32 block into out [map rows, map cols, bands],
+    # in the channel batches that have exact float paths in cv2.remap
+    flag = interpolations[interpolation][0]
+    for b0, b1 in band_batches(src.shape[2]):
+        warped = cv2.remap(np.ascontiguousarray(src[:,:,b0:b1]), map_x, map_y, flag,
+                           borderMode=cv2.BORDER_CONSTANT, borderValue=0)
+        out[:,:,b0:b1] = warped.reshape(map_x.shape + (b1 - b0,))
+    return out
+
+def warped_metadata(vnir_profile, swir_wavelengths):
     # replicating vnir metadata except the bands and wavelength
     metadata = {}
     for k, v in vnir_profile.items():
@@ -210,25 +478,242 @@ def save_image_envi(swir_arr, swir_wavelengths, swir_path, vnir_arr, vnir_profil
             metadata[k] = vnir_profile[k]
     metadata["bands"] = str(len(swir_wavelengths))
     metadata["wavelength"] = [str(i) for i in swir_wavelengths]
+    metadata["file type"] = "ENVI Standard"
+    # the warped values are reflectance already (any SWIR scale factor is applied on
+    # reading), so the VNIR scale factor must not be carried over
+    metadata.pop("reflectance scale factor", None)
+    return metadata
+
+def band_batches(nbands):
+    # cv2.remap has exact float paths for 1, 3 and 4 channels only; any other channel
+    # count is sampled on a 1/32 pixel fixed-point grid, so bands are warped in
+    # batches of 4 with the remainder split into 3 or 1+1 (this holds for the linear
+    # and cubic kernels; lanczos is always fixed-point and takes at most 4 channels)
+    batches = [(b0, b0 + 4) for b0 in range(0, nbands - nbands % 4, 4)]
+    b0 = nbands - nbands % 4
+    if nbands % 4 == 3:
+        batches.append((b0, b0 + 3))
+    else:
+        batches += [(b, b + 1) for b in range(b0, nbands)]
+    return batches
+
+def save_image_envi(swir_arr, swir_wavelengths, swir_path, vnir_arr, vnir_profile, M, output_path=None,
+                    workers=1, swir_scale=1.0, strip_rows=256, checkpoint=False, interpolation='linear',
+                    prefetch=0, roi=None):
+    # the SWIR is resampled onto the VNIR spatial grid by the warp itself: M takes the
+    # native SWIR pixels to the VNIR pixels, so each band is interpolated only once;
+    # with roi (row0, row1, col0, col1) only that window of the VNIR grid is warped
 
-    swir_arr_out = np.transpose(swir_registered_bands, [1,2,0])
-    # envi.save_image(swir_path.replace(".hdr", "_warped_2.hdr"), swir_arr, metadata=metadata, force=True)
-    envi.save_image(output_path, swir_arr_out, metadata=metadata, force=True)
+    print('Saving the registered SWIR cube...')
+    if output_path is None:
+        output_path = swir_path.replace(".hdr","_warped.hdr")
+    print(output_path)
 
-def main(vnir_path,swir_path):
+    metadata = warped_metadata(vnir_profile, swir_wavelengths)
+
+    # pre-create the output on disk as BSQ (float32 reflectance), so every warped band
+    # of a strip is one contiguous write
+    vnir_shape = tuple(vnir_arr.shape[1:])
+    region = roi_window(roi, *vnir_shape)
+    if roi is not None:
+        metadata = crop_metadata(metadata, region)
+        print('---> region of interest: rows', region[0], 'to', region[1], ', cols', region[2], 'to', region[3])
+    nrows, ncols = region[1] - region[0], region[3] - region[2]
+    row_off, col_off = region[0], region[2]
+    nbands = len(swir_wavelengths)
+    swir_shape = swir_arr.shape[1:]
+    # with checkpoint, a strip is keyed by the homography and the SWIR block it samples,
+    # and only the strips whose key changed since the last run are warped again
+    M = np.asarray(M, dtype=np.float64)
+    swir_image = envi.open(swir_path) if checkpoint else None
+    roi_key = () if roi is None else (region,)
+    ck = Checkpoint(output_path, content_key('warp', (nrows, ncols, nbands), swir_scale, interpolation,
+                                             image_layout(swir_image) if checkpoint else None, *roi_key),
+                    params_key=content_key(M), inputs=[swir_image.filename] if checkpoint else [],
+                    enabled=checkpoint)
+    out_mm = ck.open_output(metadata, 'float32', 'bsq', (nrows, ncols, nbands), view_interleave='bsq')
+
+    # the SWIR is streamed: each strip of the VNIR grid reads only the block of SWIR
+    # rows it samples from (all bands), scales it to reflectance and warps it with
+    # the strip's part of the map pair, on the thread pool; with prefetch the reading,
+    # warping and writing of strips overlap (tile_executor.run_pipeline)
+    def read_strip(strip):
+        row0, row1, col0, col1 = strip
+        with part('remap'):
+            map_x, map_y = build_remap(M, swir_shape, vnir_shape, rows=(row0 + row_off, row1 + row_off),
+                                       cols=(col_off, col_off + ncols))
+            window = remap_source_window(map_x, map_y, swir_shape, interpolation)
+        key = ck.stale(strip, lambda: content_key(M, window, None if window is None else
+                                                  swir_arr[:, window[0]:window[1], window[2]:window[3]]))
+        if key is None:
+            return None
+        src = None
+        if window is not None:
+            y0, y1, x0, x1 = window
+            with part('read'):
+                src = read_bands(swir_arr, (slice(None), slice(y0, y1), slice(x0, x1)), swir_scale)
+            count_bytes(read=swir_arr[:, y0:y1, x0:x1].nbytes)
+        return key, map_x, map_y, window, src
+
+    def warp_strip(strip, data):
+        if data is None:
+            return None
+        row0, row1, col0, col1 = strip
+        key, map_x, map_y, window, src = data
+        warped = np.zeros((nbands, row1 - row0, ncols), dtype=np.float32)
+        if window is not None:
+            y0, y1, x0, x1 = window
+            with part('warp'):
+                remap_bands(np.transpose(src, [1,2,0]), map_x - np.float32(x0), map_y - np.float32(y0),
+                            np.transpose(warped, [1,2,0]), interpolation)
+        return key, warped
+
+    def write_strip(strip, result):
+        if result is None:
+            return
+        row0, row1, col0, col1 = strip
+        key, warped = result
+        with part('write'):
+            out_mm[:, row0:row1] = warped
+        count_bytes(written=warped.nbytes)
+        ck.record(strip, key)
+
+    strips = list(iter_tiles(nrows, ncols, strip_rows))
+    with stage('warp', strips=len(strips), workers=workers, prefetch=prefetch):
+        print('---> warping', nbands, 'bands (%s) in' % interpolation, len(strips), 'strips of', strip_rows,
+              'rows on', workers, 'worker(s)...', end='')
+        if prefetch:
+            run_pipeline(strips, read_strip, warp_strip, write_strip, workers=workers, depth=prefetch)
+        else:
+            run_tiles(strips, lambda strip: write_strip(strip, warp_strip(strip, read_strip(strip))),
+                      workers=workers)
+    with stage('save'):
+        out_mm.flush()
+        del out_mm
+        ck.save(metadata)
+    print(' ... done <---')
+    ck.report()
+
+def registration_key(vnir_path, swir_path, vnir_arr, vnir_wavelengths, swir_arr, swir_wavelengths,
+                     vnir_scale=1.0, swir_scale=1.0):
+    # content hash of both headers and of the bands the homography is computed
+    # from, so a cached homography is only reused for exactly the same data
+    h = hashlib.sha256()
+    for path in (vnir_path, swir_path):
+        with open(path, 'rb') as f:
+            h.update(f.read())
+    vnir_bands, swir_bands = registration_bands(vnir_wavelengths, swir_wavelengths)
+    h.update(read_bands(vnir_arr, vnir_bands, vnir_scale).tobytes())
+    h.update(read_bands(swir_arr, swir_bands, swir_scale).tobytes())
+    return h.hexdigest()
+
+def homography_sidecar_path(swir_path):
+    return swir_path.replace(".hdr", "_homography.json")
+
+def save_homography(sidecar_path, M, vnir_points, swir_points, mask, key, vnir_path, swir_path,
+                    vnir_shape=None, swir_shape=None):
+    # vnir_shape/swir_shape, the (rows, cols) of the grids M was found on, let the
+    # homography be reused for scans binned differently (see resolve_homography)
+    record = {'homography': np.asarray(M).tolist(),
+              'vnir_points': np.asarray(vnir_points).tolist(),
+              'swir_points': np.asarray(swir_points).tolist(),
+              'inlier_mask': np.asarray(mask).ravel().astype(int).tolist(),
+              'key': key,
+              'vnir_path': os.path.abspath(vnir_path),
+              'swir_path': os.path.abspath(swir_path),
+              'vnir_shape': None if vnir_shape is None else [int(n) for n in vnir_shape],
+              'swir_shape': None if swir_shape is None else [int(n) for n in swir_shape],
+              'created': time.strftime('%Y-%m-%d %H:%M:%S')}
+    with open(sidecar_path, 'w') as f:
+        json.dump(record, f, indent=2)
+    print('---> homography saved to: ', sidecar_path)
+
+def load_homography(path):
+    # a sidecar written by save_homography, or a plain text file with the 3x3 matrix
+    if path.lower().endswith('.json'):
+        with open(path) as f:
+            record = json.load(f)
+        record['homography'] = np.array(record['homography'])
+        return record
+    return {'homography': np.loadtxt(path), 'key': None}
+
+def resolve_homography(homography, vnir_shape, swir_shape):
+    '''
+    The homography for warping a SWIR of swir_shape (rows, cols) onto a VNIR of
+    vnir_shape: `homography` is a 3x3 matrix or the path of a sidecar/text file (see
+    load_homography). A sidecar recording other grid shapes (the same rig, scanned
+    with another spatial binning) is rescaled to these grids.
+    '''
+    if not isinstance(homography, str):
+        return np.asarray(homography, dtype=np.float64)
+    print('---> using the homography in: ', homography)
+    record = load_homography(homography)
+    M = np.asarray(record['homography'], dtype=np.float64)
+    vnir_from, swir_from = record.get('vnir_shape'), record.get('swir_shape')
+    if vnir_from and swir_from and (tuple(vnir_from) != tuple(vnir_shape) or tuple(swir_from) != tuple(swir_shape)):
+        print('---> homography found on VNIR', tuple(vnir_from), 'and SWIR', tuple(swir_from),
+              'grids, rescaled to VNIR', tuple(vnir_shape), 'and SWIR', tuple(swir_shape))
+        M = rescale_homography(M, swir_from, swir_shape, vnir_from, vnir_shape)
+    return M
+
+def main(vnir_path,swir_path,use_cache=True,workers=1,auto=False,min_inliers=12,detector='orb',
+         interpolation='linear', prefetch=0, roi=None, strip_rows=256):
     global not_satisfied
 
-    # load images envi
-    (vnir_arr, vnir_profile, vnir_wavelengths),\
-        (swir_arr, swir_profile, swir_wavelengths) = load_images_envi(vnir_path, swir_path)
-
+    # open the images envi, only the bands shown are read until the image is saved
+    with stage('load'):
+        (vnir_arr, vnir_profile, vnir_wavelengths),\
+            (swir_arr, swir_profile, swir_wavelengths) = load_images_envi(vnir_path, swir_path)
+        vnir_scale, swir_scale = reflectance_scale(vnir_profile), reflectance_scale(swir_profile)
+
+        # reuse the homography from an earlier session on exactly this pair
+        key = registration_key(vnir_path, swir_path, vnir_arr, vnir_wavelengths, swir_arr, swir_wavelengths,
+                               vnir_scale, swir_scale)
+    sidecar_path = homography_sidecar_path(swir_path)
+    if use_cache and os.path.exists(sidecar_path):
+        record = load_homography(sidecar_path)
+        if record['key'] == key:
+            print('---> using the cached homography in: ', sidecar_path)
+            save_image_envi(swir_arr, swir_wavelengths, swir_path, vnir_arr, vnir_profile, record['homography'],
+                            workers=workers, swir_scale=swir_scale, interpolation=interpolation,
+                            prefetch=prefetch, roi=roi, strip_rows=strip_rows)
+            return
+        print('---> cached homography is for different data, picking points again')
+
+    with stage('load_registration_bands'):
+        vnir_image, swir_image = registration_images(vnir_arr, vnir_wavelengths, swir_arr, swir_wavelengths,
+                                                     vnir_scale, swir_scale)
+
+    # automatic control points, the GUI is only needed if too few of them are inliers
+    if auto:
+        print('---> matching control points automatically...')
+        with stage('auto_registration', detector=detector):
+            match = auto_control_points(vnir_image, swir_image, detector=detector)
+        if match is not None and match['n_inliers'] >= min_inliers:
+            print('---> %d inliers out of %d points, reprojection error rms %.2f px, max %.2f px'
+                  % (match['n_inliers'], len(match['vnir_points']), match['rms_error'], match['max_error']))
+            save_homography(sidecar_path, match['M'], match['vnir_points'], match['swir_points'], match['mask'],
+                            key, vnir_path, swir_path, vnir_arr.shape[1:], swir_arr.shape[1:])
+            save_image_envi(swir_arr, swir_wavelengths, swir_path, vnir_arr, vnir_profile, match['M'],
+                            workers=workers, swir_scale=swir_scale, interpolation=interpolation,
+                            prefetch=prefetch, roi=roi, strip_rows=strip_rows)
+            return
+        print('---> only %d inliers (need %d), falling back to picking the points in the GUI'
+              % (0 if match is None else match['n_inliers'], min_inliers))
+
+    # picking the points by hand, only this needs matplotlib
+    import matplotlib.pyplot as plt
+
+    # overview pyramids of what the GUI shows, built once for all the retries; the
+    # overlay shows the first SWIR band, read once here
+    display = display_pyramids(vnir_image, swir_image)
+    overlay_pyramids = (ImagePyramid(vnir_image), ImagePyramid(np.fliplr(read_bands(swir_arr, 0, swir_scale))))
 
     not_satisfied = True
     while not_satisfied:
-        fig, ax1, ax2, vnir_image, vnir_image_uint8, swir_image, swir_image_uint8 = init_figs(vnir_arr,
-                  vnir_wavelengths,
-                  swir_arr,
-                  swir_wavelengths)
+        fig, ax1, ax2, vnir_image, vnir_image_uint8, swir_image, swir_image_uint8 = init_figs(vnir_image,
+                                                                                              swir_image,
+                                                                                              display)
 
         vnir_points = []
         swir_points = []
@@ -269,7 +754,15 @@ def main(vnir_path,swir_path):
         # point passed to homography should be x, y order
         vnir_points = np.array(vnir_points)
         swir_points = np.array(swir_points)
-        M, mask = cv2.findHomography(swir_points, vnir_points, cv2.RANSAC, 5)
+        fit = fit_homography(swir_points, vnir_points)
+        if fit is None:
+            print("Error: no homography fits these points, they may be collinear or picked twice.")
+            print("Please select at least 4 corresponding points spread over both images.")
+            continue
+        M, mask = fit
+        errors = reprojection_error(M, swir_points[mask.ravel() == 1], vnir_points[mask.ravel() == 1])
+        print('---> %d inliers, reprojection error rms %.2f px, max %.2f px'
+              % (int(mask.sum()), np.sqrt(np.mean(errors**2)), errors.max()))
 
 
         # show the result and see if the use is satisfied
@@ -279,17 +772,35 @@ def main(vnir_path,swir_path):
             if event.key == 'escape':  # Close figure if Escape key is pressed
                 not_satisfied = False;
                 plt.close(fig)
-        ax.imshow(cv2.warpPerspective(np.fliplr(swir_arr[0]), M, (vnir_image.shape[1], vnir_image.shape[0])),
-                   alpha=0.5)
-        ax.imshow(vnir_image, alpha=0.5)
+        fig.overlay_views = overlay_view(ax, overlay_pyramids[0], overlay_pyramids[1], M)
         ax.set_title('Overlay of Coregistered Image \n'
                      'if satisfied press Escape to save image\n'
                      'if NOT satisfied close the figure to restart.')
         fig.canvas.mpl_connect('key_press_event', on_key)
         plt.show()
 
+    # keep the homography, the points and the RANSAC inliers for the next scans
+    save_homography(sidecar_path, M, vnir_points, swir_points, mask, key, vnir_path, swir_path,
+                    vnir_arr.shape[1:], swir_arr.shape[1:])
+
     # save image at last
-    save_image_envi(swir_arr, swir_wavelengths, swir_path, vnir_arr, vnir_profile, M)
+    save_image_envi(swir_arr, swir_wavelengths, swir_path, vnir_arr, vnir_profile, M, workers=workers,
+                    swir_scale=swir_scale, interpolation=interpolation,
+                    prefetch=prefetch, roi=roi, strip_rows=strip_rows)
+
+def register_headless(vnir_path, swir_path, homography, output_path=None, workers=1, checkpoint=False,
+                      interpolation='linear', prefetch=0, roi=None, strip_rows=256):
+    # warps the SWIR cube with an already known homography, no GUI: `homography` is
+    # a 3x3 matrix or the path of a sidecar/text file (see resolve_homography). The rig
+    # geometry is fixed, so the homography from one scan is good for the others too.
+    with stage('load'):
+        (vnir_arr, vnir_profile, vnir_wavelengths),\
+            (swir_arr, swir_profile, swir_wavelengths) = load_images_envi(vnir_path, swir_path)
+    homography = resolve_homography(homography, vnir_arr.shape[1:], swir_arr.shape[1:])
+    save_image_envi(swir_arr, swir_wavelengths, swir_path, vnir_arr, vnir_profile, homography,
+                    output_path=output_path, workers=workers, swir_scale=reflectance_scale(swir_profile),
+                    checkpoint=checkpoint, interpolation=interpolation, prefetch=prefetch, roi=roi,
+                    strip_rows=strip_rows)
 
 if __name__ == "__main__":
 
@@ -313,5 +824,49 @@ if __name__ == "__main__":
     vnir_path = vnir_path+ 'VNIR/data_VNIR_cropped.hdr'
     swir_path = '/home/fzhcis/mylab/gdrive/projects_with_Dave/for_Fei/Data/Ducky_and_Fragment/'
     swir_path = swir_path + 'SWIR/data_SWIR_cropped.hdr'
-    main(vnir_path,swir_path)
 
+    parser = argparse.ArgumentParser(description='Register a SWIR cube to a VNIR cube.')
+    parser.add_argument('--vnir', default=vnir_path, help='VNIR ENVI header (.hdr)')
+    parser.add_argument('--swir', default=swir_path, help='SWIR ENVI header (.hdr)')
+    parser.add_argument('--homography', default=None,
+                        help='homography sidecar (.json) from an earlier session or a text file with a 3x3 matrix; '
+                             'warps the SWIR headless, without the GUI')
+    parser.add_argument('--reselect', action='store_true',
+                        help='ignore the cached homography of this pair and pick the points again')
+    parser.add_argument('--auto', action='store_true',
+                        help='pick the control points automatically by feature matching, GUI only as a fallback')
+    parser.add_argument('--min-inliers', type=int, default=12,
+                        help='fewest RANSAC inliers accepted from the automatic matching (default: %(default)s)')
+    parser.add_argument('--detector', choices=['orb', 'akaze', 'sift'], default='orb',
+                        help='feature detector for --auto (default: %(default)s)')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='threads warping strips of the SWIR in parallel (default: %(default)s)')
+    parser.add_argument('--interpolation', choices=sorted(interpolations), default='linear',
+                        help='kernel resampling the SWIR onto the VNIR grid (default: %(default)s)')
+    parser.add_argument('--strip-rows', type=int, default=256,
+                        help='rows of the VNIR grid warped per strip (default: %(default)s)')
+    parser.add_argument('--prefetch', type=int, default=0,
+                        help='strips read ahead and written behind on their own threads while strips are '
+                             'warped, 0 to do one after the other (default: %(default)s)')
+    parser.add_argument('--roi', type=parse_roi, default=None, metavar='ROW0:ROW1,COL0:COL1',
+                        help='only warp this window of the VNIR grid, reading only the SWIR it samples from '
+                             '(python slice bounds, either may be left out)')
+    parser.add_argument('--checkpoint', action='store_true',
+                        help='with --homography, keep a content-hashed checkpoint of the warped SWIR and only '
+                             'warp the strips whose inputs changed')
+    parser.add_argument('--report', default=None,
+                        help='append the time, CPU, bytes and peak memory of every stage to this JSON-lines file')
+    parser.add_argument('--profile', default=None, help='run under cProfile and write the stats to this file')
+    args = parser.parse_args()
+    configure(args.report, scene=args.swir)
+
+    with profiled(args.profile), stage('coregister'):
+        if args.homography is not None:
+            register_headless(args.vnir, args.swir, args.homography, workers=args.workers,
+                              checkpoint=args.checkpoint, interpolation=args.interpolation,
+                              prefetch=args.prefetch, roi=args.roi, strip_rows=args.strip_rows)
+        else:
+            main(args.vnir, args.swir, use_cache=not args.reselect, workers=args.workers,
+                 auto=args.auto, min_inliers=args.min_inliers, detector=args.detector,
+                 interpolation=args.interpolation, prefetch=args.prefetch, roi=args.roi,
+                 strip_rows=args.strip_rows)
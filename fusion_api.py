@@ -0,0 +1,253 @@
+'''
++
+=======================================================================
+
+ NAME:
+      fusion_api
+
+ DESCRIPTION:
+	the registration and the fusion as functions to call from python, returning
+the cubes in memory (or tile by tile) instead of only writing them to disk.
+- register(vnir, swir, homography) warps the SWIR onto the VNIR grid, as
+coregister_controlpoints_gui does headless
+- fuse(vnir, swir) fuses a registered pair into the uint16 full spectrum cube, as
+build_cube does; with homography= the raw SWIR is warped tile by tile on the way,
+as in register_and_fuse, and the warped SWIR is never held whole
+- the cubes can be paths (ENVI headers or chunked stores), spectral images, numpy
+arrays or memmaps, all [rows, cols, bands]
+- both return a numpy array by default; out= an array fills that array instead and
+out= a path writes an ENVI file there and returns its memmap; tiles=True returns a
+generator of ((row0, row1, col0, col1), tile) computed as they are asked for
+- roi=(row0, row1, col0, col1) (None for an open end, or a 'row0:row1,col0:col1'
+string) only registers/fuses that window of the VNIR grid
+
+ USES:
+numpy
+and, when called, spectral, cv2, fusion_plan, coregister_controlpoints_gui, tile_executor,
+chunked_store (from this repository)
+
+ NOTES:
+importing this module only imports numpy, the pipeline modules are imported by the
+functions that need them.
+
+ HISTORY:
+2026/10/17: created
+
+=======================================================================
+-
+'''
+
+import numpy as np
+
+
+def open_cube(cube, wavelengths=None, scale=None):
+    '''
+    A [rows, cols, bands] view of cube (a path, a spectral image or an array), its
+    wavelengths, the factor its values are divided by to get reflectance and its
+    metadata (a dict, empty for arrays). wavelengths and scale override the header.
+    '''
+    from chunked_store import ChunkedCube, is_store, open_store
+    metadata = {}
+    if isinstance(cube, str):
+        if is_store(cube):
+            cube = open_store(cube)
+        else:
+            import spectral.io.envi as envi
+            cube = envi.open(cube)
+    if hasattr(cube, 'open_memmap'):
+        view, metadata = cube.open_memmap(interleave='bip'), dict(cube.metadata)
+    elif isinstance(cube, ChunkedCube):
+        view, metadata = cube, dict(cube.metadata)
+    else:
+        view = cube
+    if wavelengths is None and 'wavelength' in metadata:
+        wavelengths = np.array([float(w) for w in metadata['wavelength']])
+    if scale is None:
+        scale = float(metadata.get('reflectance scale factor', 1) or 1)
+    return view, wavelengths, scale, metadata
+
+
+def create_output(out, shape, dtype, metadata):
+    # the array results go to: a new array, the given one or a new ENVI file at the path
+    if out is None:
+        return np.empty(shape, dtype=dtype)
+    if isinstance(out, str):
+        import spectral.io.envi as envi
+        md = dict(metadata)
+        md['file type'] = 'ENVI Standard'
+        image = envi.create_image(out, metadata=md, dtype=dtype, interleave='bip', shape=shape, offset=0, force=True)
+        return image.open_memmap(interleave='bip', writable=True)
+    if tuple(out.shape) != tuple(shape):
+        raise ValueError('out has shape %s, the result %s' % (tuple(out.shape), tuple(shape)))
+    return out
+
+
+def run(tiles, compute, out, lazy, workers=1):
+    '''
+    compute(tile, out_tile) returns the result of a tile, written into the out_tile
+    view of out if there is one. All the tiles are run (on workers threads) and out
+    returned, or with lazy a generator running them one by one is returned.
+    '''
+    def flush():
+        if hasattr(out, 'flush'):
+            out.flush()
+
+    def view(tile):
+        row0, row1, col0, col1 = tile
+        return None if out is None else out[row0:row1, col0:col1]
+
+    if lazy:
+        def generate():
+            for tile in tiles:
+                yield tile, compute(tile, view(tile))
+            flush()
+        return generate()
+
+    from tile_executor import run_tiles
+    run_tiles(tiles, lambda tile: compute(tile, view(tile)), workers=workers)
+    flush()
+    return out
+
+
+def region_tiles(roi, nrows, ncols, strip_rows):
+    '''
+    The window (row0, row1, col0, col1) of the roi on the nrows x ncols grid, and a
+    function giving the tiles of the window with the bounds they have on the grid.
+    '''
+    from tile_executor import iter_tiles, parse_roi, roi_window
+    region = roi_window(parse_roi(roi) if isinstance(roi, str) else roi, nrows, ncols)
+    row_off, col_off = region[0], region[2]
+    tiles = list(iter_tiles(region[1] - row_off, region[3] - col_off, strip_rows))
+    return region, tiles, lambda tile: (tile[0] + row_off, tile[1] + row_off, tile[2] + col_off, tile[3] + col_off)
+
+
+def read_block(view, rows, cols, bands=None):
+    # view[rows, cols, bands] as an array; bands is None for all of them, or an index
+    # array (a chunked store is read over the run of bands covering it)
+    if bands is None:
+        return view[rows, cols]
+    from chunked_store import ChunkedCube
+    from fusion_plan import band_index
+    index = band_index(bands)
+    if isinstance(index, slice) or not isinstance(view, ChunkedCube):
+        return view[rows, cols, index]
+    return view[rows, cols, int(bands[0]):int(bands[-1]) + 1][:, :, bands - bands[0]]
+
+
+def swir_warper(homography, swir_view, vnir_shape, interpolation='linear', scale=1.0, bands=None):
+    '''
+    warp(tile) -> the float32 [rows, cols, bands] SWIR on the tile of the VNIR grid,
+    divided by scale; reads only the block of SWIR the tile samples from, and only
+    the given bands (all of them if None).
+    '''
+    from coregister_controlpoints_gui import build_remap, remap_source_window, remap_bands, resolve_homography
+    swir_shape = tuple(swir_view.shape[:2])
+    M = resolve_homography(homography, vnir_shape, swir_shape)
+    nbands = swir_view.shape[2] if bands is None else len(bands)
+
+    def warp(tile):
+        row0, row1, col0, col1 = tile
+        map_x, map_y = build_remap(M, swir_shape, vnir_shape, rows=(row0, row1), cols=(col0, col1))
+        window = remap_source_window(map_x, map_y, swir_shape, interpolation)
+        warped = np.zeros((row1 - row0, col1 - col0, nbands), dtype=np.float32)
+        if window is not None:
+            y0, y1, x0, x1 = window
+            src = np.array(read_block(swir_view, slice(y0, y1), slice(x0, x1), bands), dtype=np.float32)
+            if scale != 1:
+                src /= np.float32(scale)
+            remap_bands(src, map_x - np.float32(x0), map_y - np.float32(y0), warped, interpolation)
+        return warped
+    return warp
+
+
+def register(vnir, swir, homography, interpolation='linear', out=None, tiles=False, strip_rows=256, workers=1,
+             swir_scale=None, roi=None):
+    '''
+    Warps swir onto the grid of vnir (a cube, or its (rows, cols)) with homography, a
+    3x3 matrix or the path of a sidecar/text file (coregister_controlpoints_gui).
+    Returns the float32 [rows, cols, SWIR bands] reflectance (the SWIR values divided
+    by swir_scale, by default its header's reflectance scale factor), the same as
+    the file the headless warp writes; see out and tiles above.
+    '''
+    from tile_executor import crop_metadata
+    from coregister_controlpoints_gui import warped_metadata
+    swir_view, swir_wvl, swir_scale, swir_md = open_cube(swir, scale=swir_scale)
+    if isinstance(vnir, tuple) and len(vnir) == 2:
+        vnir_shape, vnir_md = vnir, {}
+    else:
+        vnir_view, _, _, vnir_md = open_cube(vnir)
+        vnir_shape = tuple(vnir_view.shape[:2])
+    warp = swir_warper(homography, swir_view, vnir_shape, interpolation, swir_scale)
+    metadata = warped_metadata(vnir_md, swir_wvl) if swir_wvl is not None else dict(vnir_md)
+    region, window_tiles, on_grid = region_tiles(roi, vnir_shape[0], vnir_shape[1], strip_rows)
+    if roi is not None:
+        metadata = crop_metadata(metadata, region)
+    shape = (region[1] - region[0], region[3] - region[2], swir_view.shape[2])
+    out = create_output(out, shape, np.float32, metadata) if out is not None or not tiles else None
+
+    def compute(tile, out_tile):
+        warped = warp(on_grid(tile))
+        if out_tile is not None:
+            out_tile[...] = warped
+        return warped
+    return run(window_tiles, compute, out, tiles, workers)
+
+
+def fuse(vnir, swir, homography=None, plan=None, scale_factor=10000, interpolation='linear', out=None, tiles=False,
+         strip_rows=256, workers=1, plan_dir=None, vnir_wavelengths=None, swir_wavelengths=None, vnir_scale=None,
+         swir_scale=None, keep=None, bin_width=None, roi=None):
+    '''
+    Fuses vnir and swir into the uint16 [rows, cols, bands] full spectrum cube with
+    values reflectance * scale_factor. swir is already on the VNIR grid, or with a
+    homography it is the raw SWIR and is warped tile by tile (register_and_fuse),
+    divided by its scale before the warp like the headless warp does, so a given
+    plan is then one for a SWIR scale of 1.
+
+    plan is a fusion_plan.FusionPlan (or the path of a saved one); by default it is
+    built from the wavelengths and the reflectance scale factors of the cubes
+    (cached in plan_dir, if given), keeping only the wavelength ranges keep and/or
+    binned every bin_width (fusion_plan.band_selection); the input bands the plan
+    does not use are not read. Arrays have no header, so without a plan their
+    wavelengths must be given, and their scales are 1 unless given. See out and
+    tiles above.
+    '''
+    from fusion_plan import FusionPlan, output_metadata
+    from tile_executor import crop_metadata
+    vnir_view, vnir_wvl, vnir_scale, vnir_md = open_cube(vnir, vnir_wavelengths, vnir_scale)
+    swir_view, swir_wvl, swir_scale, swir_md = open_cube(swir, swir_wavelengths, swir_scale)
+    if isinstance(plan, str):
+        plan = FusionPlan.load(plan)
+    elif plan is None:
+        if vnir_wvl is None or swir_wvl is None:
+            raise ValueError('the wavelengths of both cubes (or a plan) are needed to fuse them')
+        # a warped SWIR is reflectance already
+        plan = FusionPlan.cached(vnir_wvl, swir_wvl, scale_factor, vnir_scale=vnir_scale,
+                                 swir_scale=swir_scale if homography is None else 1.0, plan_dir=plan_dir, keep=keep,
+                                 bin_width=bin_width)
+    nrows, ncols = vnir_view.shape[:2]
+    # only the bands the plan uses are read, as in build_cube
+    tile_plan = plan.on_used_bands()
+    if homography is not None:
+        # the raw SWIR is scaled to reflectance and warped
+        swir_tile = swir_warper(homography, swir_view, (nrows, ncols), interpolation, scale=swir_scale,
+                                bands=plan.swir_bands)
+    elif tuple(swir_view.shape[:2]) != (nrows, ncols):
+        raise ValueError('the SWIR (%d x %d) is not on the VNIR grid (%d x %d), give its homography'
+                         % (swir_view.shape[0], swir_view.shape[1], nrows, ncols))
+    else:
+        swir_tile = lambda tile: read_block(swir_view, slice(tile[0], tile[1]), slice(tile[2], tile[3]),
+                                            plan.swir_bands)
+    # the header build_cube writes
+    metadata = output_metadata(vnir_md, plan, plan.scale_factor)
+    region, window_tiles, on_grid = region_tiles(roi, nrows, ncols, strip_rows)
+    if roi is not None:
+        metadata = crop_metadata(metadata, region)
+    shape = (region[1] - region[0], region[3] - region[2], plan.n_out)
+    out = create_output(out, shape, np.uint16, metadata) if out is not None or not tiles else None
+
+    def compute(tile, out_tile):
+        tile = on_grid(tile)
+        row0, row1, col0, col1 = tile
+        vnir_tile = read_block(vnir_view, slice(row0, row1), slice(col0, col1), plan.vnir_bands)
+        return tile_plan.apply(vnir_tile, swir_tile(tile), out=out_tile)
+    return run(window_tiles, compute, out, tiles, workers)
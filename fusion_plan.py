@@ -0,0 +1,508 @@
+'''
++
+=======================================================================
+
+ NAME:
+      fusion_plan
+
+ DESCRIPTION:
+	the spectral part of the VNIR/SWIR fusion as a single linear operator.
+- get_overlap works out the wavelength bookkeeping: the bands of each cube in
+the region of spectral overlap, the SWIR bands kept after it, the final wavelength
+array and the blending weights
+- FusionPlan folds all of it - band selection, the SWIR -> VNIR resampling of the
+overlap (spectral.BandResampler), the linear blend weights, the output scale factor
+and the scale factors of the inputs - into one sparse [output bands, VNIR + SWIR
+bands] matrix, so a tile of the fused cube is one sparse matrix product
+- the plan is saved to an .npz file named after a hash of the wavelength grids and
+scale factors, and reused for every scene taken with the same sensors
+- the output bands can be cut down to wavelength ranges (keep) and/or binned onto a
+regular grid (bin_width, spectral.BandResampler); the selection is one more sparse
+matrix multiplied into the operator, and vnir_bands/swir_bands are the input bands
+the remaining output bands use
+- output bands that are a single input band times a gain (all of them outside the
+overlap, unless they are binned) skip the sparse product: they are copied as they
+are when the gain is 1 and the input is an unsigned integer, otherwise scaled
+- output_metadata gives the header of the fused cube made with a plan
+
+ USES:
+numpy
+scipy.sparse
+spectralPy (from the python package spectral)
+hashlib, zipfile
+stage_timing (from this repository)
+
+ NOTES:
+the sparse product accumulates every output value over its nonzero weights in a
+fixed order, one pixel at a time (no BLAS blocking), so the result does not depend
+on the size or shape of the tile. The copied and scaled bands equal the product
+too (one float32 weight times the float32 value).
+a VNIR overlap band that no SWIR band reaches (beyond the last one by more than
+its width) gets no SWIR share and is kept as it is.
+
+ HISTORY:
+2026/10/17: created, replaces the per band-range passes of build_cube.fuse_strip
+
+=======================================================================
+-
+'''
+
+import numpy as np
+import scipy.sparse
+from spectral import BandResampler
+import copy
+import hashlib
+import os
+import zipfile
+from stage_timing import part
+
+# bump when the way the operator is built changes, so stale plans are rebuilt
+plan_version = 1
+
+# pixels fused per sparse product in FusionPlan.apply
+chunk_pixels = 1024
+
+# where the command line tools keep their plans
+default_plan_dir = os.path.join(os.path.expanduser('~'), '.cache', 'vnir_swir_fusion')
+
+# header fields with one value per band, which the VNIR ones do not give for a selection of the bands
+band_fields = ['fwhm', 'band names', 'bbl', 'data gain values', 'data offset values',
+               'data reflectance gain values', 'data reflectance offset values',
+               'band minimum', 'band maximum', 'band mean', 'band stddev']
+
+
+def get_overlap(vnir_wvl, swir_wvl):
+    '''
+    Works out the wavelength bookkeeping for the fusion: which bands of each cube
+    fall in the region of spectral overlap, the SWIR bands kept after it, the
+    final wavelength array and the blending weights.  Returns a dict.
+    '''
+    ### Getting the overlap region
+    swir_overlap = swir_wvl[np.where(swir_wvl <= vnir_wvl[-1])]
+    vnir_overlap = vnir_wvl[np.where(vnir_wvl >= swir_wvl[0])]
+
+    # get the indices - will need them later for sorting the cube by ascending wavelengths
+    swir_overlap_indices = np.argwhere(swir_wvl <= vnir_wvl[-1])
+    vnir_overlap_indices = np.argwhere(vnir_wvl >= swir_wvl[0])
+
+    N_vnir_overlap, M_swir_overlap = len(vnir_overlap), len(swir_overlap)
+    n_overlap = N_vnir_overlap + M_swir_overlap
+
+    # these are the indices in the full combined wvl array that are the overlap
+    # after concatenating the two wvl arrays together
+    full_wvl_overlap_indices = np.concatenate((vnir_overlap_indices,swir_overlap_indices))
+    # flatten this array
+    full_wvl_overlap_indices = np.reshape(full_wvl_overlap_indices,-1)
+
+    # last index in vnir cube before the overlap region, total # of bands in vnir - # in overlap
+    last_vnir_b4_overlap = len(vnir_wvl) - N_vnir_overlap
+    # starting index of the swir cube in the full list of indices, last of the overlap indices + 1
+    first_swir_after_overlap = full_wvl_overlap_indices[n_overlap-1] +1
+
+    ###
+    # get the final wavelength array: vnir_wvl + swir_wvl[first_swir_after_overlap: swir_bil.nbands
+    # this is for the header file in the final output cube
+    ###
+    final_wvl = np.concatenate((vnir_wvl,swir_wvl[first_swir_after_overlap:-1]))
+    final_nbands = np.size(final_wvl)
+    final_wvl = np.reshape(final_wvl,final_nbands)
+
+    #-> compute the weights for the weighted average between the two
+    n3 = np.size(vnir_overlap_indices)
+    wgt_start = 0.5/(n3-1)
+    wgt = np.arange(n3)/(n3)+wgt_start
+
+    return {'vnir_overlap': vnir_overlap,
+            'swir_overlap': swir_overlap,
+            'vnir_overlap_indices': np.reshape(vnir_overlap_indices,-1),
+            'swir_overlap_indices': np.reshape(swir_overlap_indices,-1),
+            'last_vnir_b4_overlap': last_vnir_b4_overlap,
+            'first_swir_after_overlap': first_swir_after_overlap,
+            'final_wvl': final_wvl,
+            'final_nbands': final_nbands,
+            'wgt': wgt}
+
+
+def quantize(buf, out):
+    # round to nearest and saturate to the uint16 range, astype('uint16') alone
+    # truncates and silently wraps anything outside [0, 65535]
+    np.rint(buf, out=buf)
+    np.clip(buf, 0, 65535, out=buf)
+    np.copyto(out, buf, casting='unsafe')
+
+
+def plan_key(vnir_wvl, swir_wvl, scale_factor, vnir_scale=1.0, swir_scale=1.0, keep=None, bin_width=None):
+    # identifies a plan: the two wavelength grids, the scale factors and the band selection
+    h = hashlib.sha256()
+    h.update(('fusion plan v%d' % plan_version).encode())
+    h.update(np.asarray(vnir_wvl, dtype=np.float64).tobytes())
+    h.update(b'|')
+    h.update(np.asarray(swir_wvl, dtype=np.float64).tobytes())
+    h.update(np.asarray([scale_factor, vnir_scale, swir_scale], dtype=np.float64).tobytes())
+    if keep or bin_width:
+        h.update(repr((selection_ranges(keep), float(bin_width or 0))).encode())
+    return h.hexdigest()
+
+
+def selection_ranges(keep):
+    # the (low, high) ranges of keep sorted and merged where they overlap, or None
+    if not keep:
+        return None
+    ranges = []
+    for lo, hi in sorted((min(float(a), float(b)), max(float(a), float(b))) for a, b in keep):
+        if ranges and lo <= ranges[-1][1]:
+            ranges[-1] = (ranges[-1][0], max(ranges[-1][1], hi))
+        else:
+            ranges.append((lo, hi))
+    return tuple(ranges)
+
+
+def parse_ranges(text):
+    # '400:1340,1460:1790' -> ((400.0, 1340.0), (1460.0, 1790.0)); None for ''
+    if not text:
+        return None
+    return selection_ranges([[float(v) for v in item.split(':')] for item in text.split(',')])
+
+
+def band_selection(wvl, keep=None, bin_width=None):
+    '''
+    The [new bands, bands] matrix taking a spectrum on the wavelengths wvl to the
+    bands within the keep ranges ((low, high) pairs, all of wvl if None) or, with
+    bin_width, to bands every bin_width resampled from those (spectral.BandResampler,
+    gaussian responses bin_width wide), each range on its own so no bin reaches
+    across a gap. Returns the matrix, the new wavelengths and their FWHM (None
+    without binning).
+    '''
+    wvl = np.asarray(wvl, dtype=np.float64)
+    rows, new_wvl, new_fwhm = [], [], []
+    for lo, hi in selection_ranges(keep) or ((wvl.min(), wvl.max()),):
+        inside = np.flatnonzero((wvl >= lo) & (wvl <= hi))
+        if inside.size == 0:
+            continue
+        if not bin_width:
+            m = np.zeros((inside.size, wvl.size))
+            m[np.arange(inside.size), inside] = 1
+            rows.append(m)
+            new_wvl.append(wvl[inside])
+            continue
+        lo, hi = max(lo, wvl[inside].min()), min(hi, wvl[inside].max())
+        centers = np.arange(np.ceil(lo / bin_width) * bin_width, hi + 1e-9, bin_width)
+        m = np.zeros((centers.size, wvl.size))
+        m[:, inside] = np.nan_to_num(BandResampler(wvl[inside], centers, fwhm2=[bin_width] * centers.size).matrix)
+        # bins the bands of the range do not reach are dropped
+        covered = m.sum(axis=1) > 0
+        rows.append(m[covered])
+        new_wvl.append(centers[covered])
+        new_fwhm.append(np.full(covered.sum(), float(bin_width)))
+    if not rows:
+        raise ValueError('no output bands within the wavelength ranges %s' % (selection_ranges(keep),))
+    return np.vstack(rows), np.concatenate(new_wvl), np.concatenate(new_fwhm) if bin_width else None
+
+
+def band_index(bands):
+    # a slice when the bands are a contiguous run (a view instead of a copy on read)
+    if bands.size > 0 and bands[-1] - bands[0] + 1 == bands.size:
+        return slice(int(bands[0]), int(bands[-1]) + 1)
+    return bands
+
+
+class FusionPlan:
+    '''
+    The fusion of a (VNIR grid, SWIR grid) pair as one sparse operator.
+
+    operator     [n_out, n_vnir + n_swir] float32 CSR matrix; output band i of a
+                 pixel is operator[i] . concatenate(vnir spectrum, swir spectrum),
+                 already multiplied by the output scale factor
+    vnir_bands, swir_bands   the input bands the operator actually uses
+    direct_rows  output bands that are one input band (direct_cols, a column of the
+                 operator) times direct_gains; the other output bands, blend_rows,
+                 are blend_operator (their rows, on the columns blend_cols) applied
+                 to the gathered bands
+    out_wvl      wavelengths of the output bands
+    out_fwhm     their FWHM when they are binned (bin_width), otherwise None
+    keep, bin_width   the band selection (see band_selection), None for every band
+    '''
+
+    def __init__(self, vnir_wvl, swir_wvl, operator, out_wvl, scale_factor=10000, vnir_scale=1.0,
+                 swir_scale=1.0, keep=None, bin_width=None, out_fwhm=None):
+        self.vnir_wvl = np.asarray(vnir_wvl, dtype=np.float64)
+        self.swir_wvl = np.asarray(swir_wvl, dtype=np.float64)
+        self.scale_factor = scale_factor
+        self.vnir_scale = float(vnir_scale)
+        self.swir_scale = float(swir_scale)
+        self.out_wvl = np.asarray(out_wvl, dtype=np.float64)
+        self.out_fwhm = None if out_fwhm is None else np.asarray(out_fwhm, dtype=np.float64)
+        self.keep = selection_ranges(keep)
+        self.bin_width = float(bin_width) if bin_width else None
+        self.key = plan_key(self.vnir_wvl, self.swir_wvl, scale_factor, self.vnir_scale, self.swir_scale,
+                            self.keep, self.bin_width)
+
+        n_vnir = self.vnir_wvl.size
+        used = np.unique(operator.indices)
+        self.vnir_bands = used[used < n_vnir]
+        self.swir_bands = used[used >= n_vnir] - n_vnir
+        # keep only the columns of the used bands, in the order the tiles are gathered
+        self.operator = operator.tocsc()[:, used].tocsr().astype(np.float32)
+        self.operator.sort_indices()
+
+        # split the output bands into those copied or scaled from one input band and
+        # the blended ones, which keep their weights in the same order
+        counts = np.diff(self.operator.indptr)
+        self.direct_rows = np.flatnonzero(counts == 1)
+        self.direct_cols = self.operator.indices[self.operator.indptr[self.direct_rows]]
+        self.direct_gains = self.operator.data[self.operator.indptr[self.direct_rows]]
+        self.blend_rows = np.flatnonzero(counts != 1)
+        blend = self.operator[self.blend_rows]
+        self.blend_cols = np.unique(blend.indices)
+        self.blend_operator = blend.tocsc()[:, self.blend_cols].tocsr()
+        self.blend_operator.sort_indices()
+        self._runs = None
+
+    @property
+    def n_out(self):
+        return self.out_wvl.size
+
+    @classmethod
+    def build(cls, vnir_wvl, swir_wvl, scale_factor=10000, vnir_scale=1.0, swir_scale=1.0, keep=None,
+              bin_width=None):
+        '''
+        Builds the plan from the wavelength grids.  vnir_scale and swir_scale are
+        what the raw values of each cube are divided by to get reflectance; keep and
+        bin_width select the output bands (band_selection).
+        '''
+        vnir_wvl = np.asarray(vnir_wvl, dtype=np.float64)
+        swir_wvl = np.asarray(swir_wvl, dtype=np.float64)
+        ov = get_overlap(vnir_wvl, swir_wvl)
+        n_vnir = vnir_wvl.size
+
+        # the overlap is the tail of the VNIR bands and the head of the SWIR bands
+        n_cube1 = ov['last_vnir_b4_overlap']
+        n3 = np.size(ov['vnir_overlap_indices'])
+        first_swir = ov['first_swir_after_overlap']
+        n_cube3 = ov['final_nbands'] - n_cube1 - n3
+        wgt = ov['wgt']
+        vnir_gain = scale_factor / vnir_scale
+        swir_gain = scale_factor / swir_scale
+
+        rows, cols, vals = [], [], []
+        #-> cube 1: VNIR before the overlap
+        rows.append(np.arange(n_cube1))
+        cols.append(np.arange(n_cube1))
+        vals.append(np.full(n_cube1, vnir_gain))
+
+        #-> cube 2: the VNIR in the overlap blended with the SWIR overlap spectrally
+        #-> resampled to the VNIR wavelengths, [vnir overlap, swir overlap]
+        #-> a VNIR band no SWIR band reaches (BandResampler gives a row of NaN) is kept as it is
+        resample = np.nan_to_num(BandResampler(ov['swir_overlap'], ov['vnir_overlap']).matrix)
+        reached = resample.sum(axis=1) > 0
+        rows.append(n_cube1 + np.arange(n3))
+        cols.append(n_cube1 + np.arange(n3))
+        vals.append(np.where(reached, 1.0 - wgt, 1.0) * vnir_gain)
+        j, k = np.nonzero(resample)
+        rows.append(n_cube1 + j)
+        cols.append(n_vnir + ov['swir_overlap_indices'][k])
+        vals.append(resample[j, k] * (wgt[j] * swir_gain))
+
+        #-> cube 3: SWIR after the overlap
+        rows.append(n_cube1 + n3 + np.arange(n_cube3))
+        cols.append(n_vnir + first_swir + np.arange(n_cube3))
+        vals.append(np.full(n_cube3, swir_gain))
+
+        # the weights are rounded to float32 once, here
+        operator = scipy.sparse.csr_matrix((np.concatenate(vals).astype(np.float32),
+                                            (np.concatenate(rows), np.concatenate(cols))),
+                                           shape=(ov['final_nbands'], n_vnir + swir_wvl.size))
+        out_wvl, out_fwhm = ov['final_wvl'], None
+        if keep or bin_width:
+            # the selection is applied to the operator, not to the fused bands
+            selection, out_wvl, out_fwhm = band_selection(out_wvl, keep, bin_width)
+            operator = scipy.sparse.csr_matrix(selection) @ operator
+            operator.eliminate_zeros()
+        return cls(vnir_wvl, swir_wvl, operator, out_wvl, scale_factor, vnir_scale, swir_scale, keep, bin_width,
+                   out_fwhm)
+
+    def save(self, path):
+        # written under a temporary name and renamed, so concurrent runs never read half a plan
+        tmp_path = path + '.%d.tmp' % os.getpid()
+        with open(tmp_path, 'wb') as f:
+            np.savez(f, key=self.key, vnir_wvl=self.vnir_wvl, swir_wvl=self.swir_wvl, out_wvl=self.out_wvl,
+                     scales=np.array([self.scale_factor, self.vnir_scale, self.swir_scale]),
+                     data=self.operator.data, indices=self.operator.indices, indptr=self.operator.indptr,
+                     vnir_bands=self.vnir_bands, swir_bands=self.swir_bands,
+                     keep=np.array(self.keep or [], dtype=np.float64).reshape(-1, 2),
+                     bin_width=self.bin_width or 0.0,
+                     out_fwhm=self.out_fwhm if self.out_fwhm is not None else np.zeros(0))
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as f:
+            vnir_wvl, swir_wvl = f['vnir_wvl'], f['swir_wvl']
+            scale_factor, vnir_scale, swir_scale = f['scales']
+            n_vnir = vnir_wvl.size
+            # expand the operator back to all the input bands
+            used = np.concatenate((f['vnir_bands'], n_vnir + f['swir_bands']))
+            operator = scipy.sparse.csr_matrix((f['data'], used[f['indices']], f['indptr']),
+                                               shape=(f['out_wvl'].size, n_vnir + swir_wvl.size))
+            # plans saved before the band selection existed have none
+            keep = [tuple(r) for r in f['keep']] if 'keep' in f.files else None
+            bin_width = f['bin_width'].item() if 'bin_width' in f.files else None
+            out_fwhm = f['out_fwhm'] if 'out_fwhm' in f.files and f['out_fwhm'].size else None
+            plan = cls(vnir_wvl, swir_wvl, operator, f['out_wvl'], scale_factor.item(), vnir_scale, swir_scale,
+                       keep, bin_width, out_fwhm)
+            if str(f['key']) != plan.key:
+                raise ValueError('fusion plan ' + path + ' is stale or corrupt, delete it to rebuild it')
+        return plan
+
+    @classmethod
+    def cached(cls, vnir_wvl, swir_wvl, scale_factor=10000, vnir_scale=1.0, swir_scale=1.0, plan_dir=None,
+               keep=None, bin_width=None):
+        '''
+        Loads the plan for these grids, scale factors and band selection from
+        plan_dir, building and saving it there the first time.  With plan_dir=None
+        nothing is saved.  A saved plan that is stale or cannot be read is rebuilt
+        and overwritten.
+        '''
+        if not plan_dir:
+            return cls.build(vnir_wvl, swir_wvl, scale_factor, vnir_scale, swir_scale, keep, bin_width)
+        key = plan_key(vnir_wvl, swir_wvl, scale_factor, vnir_scale, swir_scale, keep, bin_width)
+        path = os.path.join(plan_dir, 'fusion_plan_' + key[:16] + '.npz')
+        if os.path.exists(path):
+            try:
+                plan = cls.load(path)
+            except (OSError, ValueError, KeyError, EOFError, zipfile.BadZipFile) as e:
+                print('---> rebuilding the fusion plan, the saved one is unusable: ', e)
+                plan = None
+            if plan is not None and plan.key == key:
+                print('---> using the fusion plan in: ', path)
+                return plan
+        plan = cls.build(vnir_wvl, swir_wvl, scale_factor, vnir_scale, swir_scale, keep, bin_width)
+        os.makedirs(plan_dir, exist_ok=True)
+        plan.save(path)
+        print('---> fusion plan saved to: ', path)
+        return plan
+
+    def on_used_bands(self, vnir=True, swir=True):
+        '''
+        The same plan for tiles holding only the used bands (vnir_bands, swir_bands,
+        in that order) of the VNIR and/or the SWIR, read with band_index.
+        '''
+        plan = copy.copy(self)
+        if vnir:
+            plan.vnir_bands = np.arange(self.vnir_bands.size)
+        if swir:
+            plan.swir_bands = np.arange(self.swir_bands.size)
+        plan._runs = None
+        return plan
+
+    def tile_bands(self, columns=None):
+        # the bands of the VNIR and of the SWIR tile holding the given operator columns (all of them if None)
+        if columns is None:
+            return self.vnir_bands, self.swir_bands
+        nv = self.vnir_bands.size
+        return self.vnir_bands[columns[columns < nv]], self.swir_bands[columns[columns >= nv] - nv]
+
+    def direct_runs(self):
+        '''
+        The direct rows as runs [source, out0, out1, band0, gain]: output bands out0
+        to out1 are bands band0... of the VNIR (source 0) or the SWIR (source 1) tile
+        times gain.
+        '''
+        if self._runs is None:
+            nv = self.vnir_bands.size
+            runs = []
+            for row, col, gain in zip(self.direct_rows, self.direct_cols, self.direct_gains):
+                source, band = (0, self.vnir_bands[col]) if col < nv else (1, self.swir_bands[col - nv])
+                last = runs[-1] if runs else None
+                if last and last[0] == source and last[2] == row and last[3] + row - last[1] == band \
+                        and last[4] == gain:
+                    last[2] += 1
+                else:
+                    runs.append([source, int(row), int(row) + 1, int(band), gain])
+            self._runs = runs
+        return self._runs
+
+    def gather(self, vnir_tile, swir_tile, x=None, columns=None):
+        # the used bands of a [rows, cols, bands] tile pair (or only those of the given
+        # operator columns) as a float32 [bands, pixels] block
+        n1, n2 = vnir_tile.shape[0], vnir_tile.shape[1]
+        vnir_bands, swir_bands = self.tile_bands(columns)
+        nv = vnir_bands.size
+        if x is None:
+            x = np.empty((nv + swir_bands.size, n1 * n2), dtype=np.float32)
+        # plain ndarrays: spectral's ImageArray keeps the band axis when indexing a single band
+        vnir_tile = np.asarray(vnir_tile)
+        swir_tile = np.asarray(swir_tile)
+        x[:nv].reshape(nv, n1, n2)[...] = np.moveaxis(vnir_tile[:, :, band_index(vnir_bands)], 2, 0)
+        x[nv:].reshape(-1, n1, n2)[...] = np.moveaxis(swir_tile[:, :, band_index(swir_bands)], 2, 0)
+        return x
+
+    def apply(self, vnir_tile, swir_tile, out=None):
+        '''
+        Fuses a [rows, cols, bands] tile of the registered VNIR and SWIR cubes (raw
+        values, any dtype) into the uint16 full spectrum tile `out`, allocated if
+        not given.  The runs of direct bands whose gain is 1 are copied whole when
+        their tile holds unsigned integers of up to 16 bits (the rounding and
+        saturation would leave them unchanged); the rest of the tile goes through in
+        blocks of about chunk_pixels pixels so the scaled bands and the band <-> pixel
+        transposes around the product stay in cache.
+        '''
+        # plain ndarrays: spectral's ImageArray keeps the band axis when indexing a single band
+        tiles = (np.asarray(vnir_tile), np.asarray(swir_tile))
+        n1, n2 = tiles[0].shape[0], tiles[0].shape[1]
+        if out is None:
+            out = np.empty((n1, n2, self.n_out), dtype=np.uint16)
+        scaled = []
+        with part('copy'):
+            for run in self.direct_runs():
+                source, out0, out1, band0, gain = run
+                if gain == 1 and np.can_cast(tiles[source].dtype, np.uint16, 'safe'):
+                    out[:, :, out0:out1] = tiles[source][:, :, band0:band0 + out1 - out0]
+                else:
+                    scaled.append(run)
+        n_blend = self.blend_rows.size
+        if not scaled and not n_blend:
+            return out
+        out_blend = band_index(self.blend_rows)
+        block_cols = min(n2, chunk_pixels)
+        block_rows = max(1, chunk_pixels // block_cols)
+        # timed as a whole, the blocks are too small for a timer each
+        with part('resample_blend'):
+            for r0 in range(0, n1, block_rows):
+                for c0 in range(0, n2, block_cols):
+                    r1, c1 = min(r0 + block_rows, n1), min(c0 + block_cols, n2)
+                    out_block = out[r0:r1, c0:c1]
+                    for source, out0, out1, band0, gain in scaled:
+                        buf = np.multiply(tiles[source][r0:r1, c0:c1, band0:band0 + out1 - out0], gain,
+                                          dtype=np.float32)
+                        quantize(buf, out_block[:, :, out0:out1])
+                    if not n_blend:
+                        continue
+                    x = self.gather(tiles[0][r0:r1, c0:c1], tiles[1][r0:r1, c0:c1], columns=self.blend_cols)
+                    # resampling and blending of the overlap are all in the one product
+                    y = (self.blend_operator @ x).reshape(n_blend, r1 - r0, c1 - c0)
+                    if isinstance(out_blend, slice):
+                        quantize(y, np.moveaxis(out_block[:, :, out_blend], 2, 0))
+                    else:
+                        q = np.empty(y.shape, dtype=np.uint16)
+                        quantize(y, q)
+                        out_block[:, :, out_blend] = np.moveaxis(q, 0, 2)
+        return out
+
+
+def output_metadata(vnir_image, plan, scale_factor):
+    # the header of the fused cube; vnir_image is the VNIR image or its metadata
+    md = dict(getattr(vnir_image, 'metadata', vnir_image))
+    md['wavelength'] = plan.out_wvl
+    # md['nrows'] = vnir_img.shape[0]
+    # md['ncols'] = vnir_img.shape[1]
+    md['dtype'] = 'uint16'
+    md['bands'] = plan.n_out
+    md['reflectance scale factor'] = scale_factor
+    # the VNIR band widths do not describe a selection of the bands
+    if plan.keep or plan.out_fwhm is not None:
+        for field in band_fields:
+            md.pop(field, None)
+    if plan.out_fwhm is not None:
+        md['fwhm'] = plan.out_fwhm
+    return md
@@ -0,0 +1,394 @@
+'''
++
+=======================================================================
+
+ NAME:
+      mosaic_cubes
+
+ DESCRIPTION:
+	mosaics several fused (full spectrum) cubes, e.g. the scans of one night, into a
+single cube, streamed tile by tile.
+- each cube comes with a placement: a 3x3 transform taking its pixel coordinates
+(x = column, y = row) to those of the mosaic, as the homography takes SWIR pixels
+to VNIR pixels, or just the row and column of the mosaic its first pixel lands on
+- the mosaic grid is the box around every placed cube
+- for every tile of the mosaic, each cube overlapping it is mapped back through its
+inverse transform; a cube placed by whole pixels is copied as it is, any other is
+resampled with the kernel of --interpolation (coregister_controlpoints_gui)
+- the cubes are blended with feathered weights: a cube's weight rises from 0 at its
+edge to 1 at --feather pixels inside it, so the seams fade over that distance;
+pixels whose bands are all 0 are taken as no data and get no weight
+- the tiling, statistics and overviews work as in build_cube
+
+ USES:
+numpy
+spectral (from the python package spectral)
+argparse, csv, json
+time
+coregister_controlpoints_gui, tile_executor, stage_timing, chunked_store, overviews,
+band_stats (from this repository)
+
+ PARAMETERS:
+manifest                 CSV (with a header row) or JSON list of the cubes, paths
+                         relative to the manifest:
+                           cube       ENVI header or chunked store (.zcube) of the cube
+                           transform  (optional) 3x3 text file or homography sidecar
+                                      (.json) placing the cube in the mosaic
+                           row, col   (optional) where the cube's first pixel goes in
+                                      the mosaic, if it has no transform (default 0, 0)
+--out path.hdr           mosaic output cube
+--feather N              width in pixels of the blend at the seams, 0 to average the
+                         overlaps (default 32)
+--interpolation nearest|linear|cubic|lanczos   kernel resampling cubes that are not
+                         placed by whole pixels (default linear)
+--strip-rows N, --tile-cols N, --workers N, --prefetch N, --interleave bsq|bil|bip,
+--format envi|chunked, --chunks R,C,B, --codec zlib|lz4, --overviews [F ...],
+--no-stats, --report file, --profile file   as in build_cube
+
+ RETURNS:
+the mosaic, with the data type, bands and metadata of the first cube
+
+ NOTES:
+all cubes must have the same bands, data type and reflectance scale factor.
+
+ HISTORY:
+2026/10/17: created
+
+=======================================================================
+-
+'''
+
+import numpy as np
+import spectral.io.envi as envi
+import argparse
+import csv
+import json
+import os
+import time
+from band_stats import BandStats, save_stats
+from coregister_controlpoints_gui import load_homography, remap_source_window, remap_bands, interpolations
+from tile_executor import iter_tiles, run_tiles, run_pipeline, tile_cols_for, round_up
+from stage_timing import stage, part, count_bytes, configure, profiled
+from chunked_store import create_store, store_path, is_store, open_store, default_chunks
+from overviews import create_overviews
+
+# header fields of an input that do not hold for the mosaic
+dropped_fields = ('band minimum', 'band maximum', 'band mean', 'band stddev', 'map info',
+                  'coordinate system string', 'description')
+
+
+def read_placements(manifest_path):
+    if manifest_path.lower().endswith('.json'):
+        with open(manifest_path) as f:
+            entries = json.load(f)
+        if isinstance(entries, dict):
+            entries = entries['cubes']
+    else:
+        with open(manifest_path, newline='') as f:
+            entries = [row for row in csv.DictReader(f)]
+
+    base = os.path.dirname(os.path.abspath(manifest_path))
+    placements = []
+    for n, entry in enumerate(entries):
+        cube = (entry.get('cube') or '').strip()
+        if not cube:
+            raise ValueError('manifest entry %d has no cube' % n)
+        transform = entry.get('transform')
+        if isinstance(transform, str) and transform.strip():
+            M = load_homography(os.path.join(base, transform.strip()))['homography']
+        elif transform is not None and not isinstance(transform, str):
+            M = transform
+        else:
+            row, col = (float(str(entry.get(k) or 0).strip() or 0) for k in ('row', 'col'))
+            M = [[1, 0, col], [0, 1, row], [0, 0, 1]]
+        placements.append({'cube': os.path.join(base, cube), 'transform': np.asarray(M, dtype=np.float64)})
+    return placements
+
+
+def open_cube(path):
+    # a [rows, cols, bands] view of an ENVI cube or a chunked store, and its metadata
+    if is_store(path):
+        cube = open_store(path)
+        return cube, dict(cube.metadata), None
+    image = envi.open(path)
+    return image.open_memmap(interleave='bip'), dict(image.metadata), image.metadata.get('interleave', 'bsq')
+
+
+def pixel_shift(M):
+    # (rows, cols) if M only moves a cube by whole pixels, otherwise None
+    shift = np.rint(M[:2, 2])
+    if np.allclose(M, [[1, 0, shift[0]], [0, 1, shift[1]], [0, 0, 1]], rtol=0, atol=1e-9):
+        return int(shift[1]), int(shift[0])
+    return None
+
+
+def placed_corners(M, shape, pad=0.0):
+    # the corners of a cube of shape (rows, cols) in mosaic coordinates, [4, (x, y)];
+    # pad=0.5 for the outer edges of the corner pixels rather than their centres
+    nrows, ncols = shape
+    x = np.array([-pad, ncols - 1 + pad, -pad, ncols - 1 + pad])
+    y = np.array([-pad, -pad, nrows - 1 + pad, nrows - 1 + pad])
+    p = M @ np.vstack([x, y, np.ones(4)])
+    return (p[:2] / p[2]).T
+
+
+def mosaic_grid(placements):
+    '''
+    The (rows, cols) of the mosaic holding every placed cube, with the transforms
+    moved so that its first pixel is 0, 0.
+    '''
+    corners = np.vstack([placed_corners(p['transform'], p['shape']) for p in placements])
+    x0, y0 = np.floor(corners.min(axis=0) + 1e-6)
+    x1, y1 = np.ceil(corners.max(axis=0) - 1e-6)
+    shift = np.array([[1.0, 0.0, -x0], [0.0, 1.0, -y0], [0.0, 0.0, 1.0]])
+    for p in placements:
+        p['transform'] = shift @ p['transform']
+        p['inverse'] = np.linalg.inv(p['transform'])
+        p['shift'] = pixel_shift(p['transform'])
+        (bx0, by0), (bx1, by1) = [f(placed_corners(p['transform'], p['shape'], 0.5), axis=0) for f in (np.min, np.max)]
+        # rows and columns of the mosaic the cube can reach
+        p['footprint'] = (int(np.floor(by0)), int(np.ceil(by1)) + 1, int(np.floor(bx0)), int(np.ceil(bx1)) + 1)
+    return int(y1 - y0) + 1, int(x1 - x0) + 1
+
+
+def placement_maps(Minv, rows, cols):
+    # the positions in a cube of the mosaic pixels rows x cols, as float32 cv2.remap maps
+    x = np.arange(cols[0], cols[1], dtype=np.float64)
+    y = np.arange(rows[0], rows[1], dtype=np.float64)[:, None]
+    w = Minv[2, 0] * x + Minv[2, 1] * y + Minv[2, 2]
+    w = np.where(w != 0, 1.0 / w, 0.0)
+    map_x = ((Minv[0, 0] * x + Minv[0, 1] * y + Minv[0, 2]) * w).astype(np.float32)
+    map_y = ((Minv[1, 0] * x + Minv[1, 1] * y + Minv[1, 2]) * w).astype(np.float32)
+    return map_x, map_y
+
+
+def feather_weights(map_x, map_y, shape, feather):
+    # 0 outside the cube, rising from its edge to 1 at feather pixels inside it
+    nrows, ncols = shape
+    d = np.minimum(np.minimum(map_x + 0.5, ncols - 0.5 - map_x), np.minimum(map_y + 0.5, nrows - 0.5 - map_y))
+    if feather <= 0:
+        return (d > 0).astype(np.float32)
+    return np.clip(d / np.float32(feather), 0, 1).astype(np.float32)
+
+
+def mosaic_stats(nbands, dtype, metadata):
+    # like band_stats.output_stats: the histograms cover reflectance 0 to 2 when the
+    # cubes are scaled integers
+    scale = float(metadata.get('reflectance scale factor', 0) or 0)
+    if np.issubdtype(np.dtype(dtype), np.integer) and scale:
+        return BandStats(nbands, (0, min(2 * scale, np.iinfo(dtype).max + 1)), dtype=dtype)
+    return BandStats(nbands, (0, 2), dtype=dtype)
+
+
+def mosaic_cubes(placements, outfilehdr, feather=32, interpolation='linear', strip_rows=256, tile_cols=0,
+                 workers=1, interleave='bip', output_format='envi', chunks=None, codec='zlib', overviews=None,
+                 stats=True, prefetch=0):
+
+    ###
+    # open the cubes, nothing is read yet
+    ###
+    with stage('load'):
+        interleaves = [interleave]
+        for p in placements:
+            print('opening cube: ', p['cube'])
+            p['view'], p['metadata'], il = open_cube(p['cube'])
+            p['shape'] = p['view'].shape[:2]
+            if il is not None:
+                interleaves.append(il)
+            print('   rows, cols, bands: ', *p['view'].shape)
+        first = placements[0]
+        nbands, dtype = first['view'].shape[2], np.dtype(first['view'].dtype)
+        for p in placements[1:]:
+            if p['view'].shape[2] != nbands or np.dtype(p['view'].dtype) != dtype:
+                raise ValueError('%s has %d bands of %s, the first cube %d of %s'
+                                 % (p['cube'], p['view'].shape[2], p['view'].dtype, nbands, dtype))
+            for key in ('wavelength', 'reflectance scale factor'):
+                a, b = first['metadata'].get(key), p['metadata'].get(key)
+                if (a is None) != (b is None) or (a is not None and not np.allclose(np.asarray(a, dtype=float),
+                                                                                    np.asarray(b, dtype=float))):
+                    raise ValueError('%s has another %s than the first cube' % (p['cube'], key))
+        nrows, ncols = mosaic_grid(placements)
+        print('MOSAIC rows, cols, bands: ', nrows, ncols, nbands)
+        print('')
+
+    ###
+    # pre-create the output on disk
+    ###
+    md = dict((k, v) for k, v in first['metadata'].items() if k not in dropped_fields)
+    md['file type'] = 'ENVI Standard'
+    md['description'] = 'mosaic of ' + ', '.join(os.path.basename(p['cube']) for p in placements)
+    store, out_mm = None, None
+    row_steps, col_steps = [1], [1]
+    if output_format == 'chunked':
+        outfilehdr = store_path(outfilehdr)
+        store = create_store(outfilehdr, (nrows, ncols, nbands), dtype, metadata=md, chunks=chunks, codec=codec)
+        row_steps.append(store.chunks[0])
+        col_steps.append(store.chunks[1])
+        interleave = 'bip'
+    else:
+        image = envi.create_image(outfilehdr, metadata=md, dtype=dtype, interleave=interleave,
+                                  shape=(nrows, ncols, nbands), offset=0, force=True)
+        out_mm = image.open_memmap(interleave='bip', writable=True)
+    ovr = create_overviews(outfilehdr, (nrows, ncols, nbands), md, overviews, interleave=interleave)
+    if ovr is not None:
+        row_steps.append(ovr.factors[-1])
+        col_steps.append(ovr.factors[-1])
+    strip_rows, tile_cols = round_up(strip_rows, *row_steps), round_up(tile_cols, *col_steps)
+    band_stats = mosaic_stats(nbands, dtype, md) if stats else None
+
+    # a tile is read, blended and written in three steps, overlapped with prefetch
+    load = np.array if prefetch else np.asarray
+
+    def read_tile(tile):
+        # the block of every cube the tile samples from
+        row0, row1, col0, col1 = tile
+        blocks = []
+        for p in placements:
+            f_row0, f_row1, f_col0, f_col1 = p['footprint']
+            if f_row1 <= row0 or f_row0 >= row1 or f_col1 <= col0 or f_col0 >= col1:
+                continue
+            with part('remap'):
+                map_x, map_y = placement_maps(p['inverse'], (row0, row1), (col0, col1))
+                if p['shift'] is not None:
+                    # placed by whole pixels: the block is the tile moved back onto the cube
+                    dr, dc = p['shift']
+                    window = (max(row0 - dr, 0), min(row1 - dr, p['shape'][0]),
+                              max(col0 - dc, 0), min(col1 - dc, p['shape'][1]))
+                    window = window if window[0] < window[1] and window[2] < window[3] else None
+                else:
+                    window = remap_source_window(map_x, map_y, p['shape'], interpolation)
+            if window is None:
+                continue
+            y0, y1, x0, x1 = window
+            with part('read'):
+                src = load(p['view'][y0:y1, x0:x1])
+            count_bytes(read=src.nbytes)
+            blocks.append((p, map_x, map_y, window, src))
+        return blocks
+
+    def blend_tile(tile, blocks):
+        row0, row1, col0, col1 = tile
+        acc = np.zeros((row1 - row0, col1 - col0, nbands), dtype=np.float32)
+        wsum = np.zeros((row1 - row0, col1 - col0), dtype=np.float32)
+        for p, map_x, map_y, (y0, y1, x0, x1), src in blocks:
+            with part('warp'):
+                valid = np.any(src != 0, axis=2)
+                if p['shift'] is not None:
+                    dr, dc = p['shift']
+                    rows = slice(y0 + dr - row0, y1 + dr - row0)
+                    cols = slice(x0 + dc - col0, x1 + dc - col0)
+                    values = np.zeros(acc.shape, dtype=np.float32)
+                    values[rows, cols] = src
+                    weight = np.zeros(wsum.shape, dtype=np.float32)
+                    weight[rows, cols] = valid
+                else:
+                    mx, my = map_x - np.float32(x0), map_y - np.float32(y0)
+                    values = remap_bands(src.astype(np.float32), mx, my, np.empty(acc.shape, dtype=np.float32),
+                                         interpolation)
+                    # no weight where the linear footprint of the pixel touches no data
+                    # or the outside of the cube
+                    weight = np.empty(wsum.shape + (1,), dtype=np.float32)
+                    remap_bands(valid.astype(np.float32)[:, :, None], mx, my, weight, 'linear')
+                    weight = (weight[:, :, 0] > 0.999).astype(np.float32)
+            with part('blend'):
+                weight *= feather_weights(map_x, map_y, p['shape'], feather)
+                acc += values * weight[:, :, None]
+                wsum += weight
+        with part('blend'):
+            np.divide(acc, wsum[:, :, None], out=acc, where=wsum[:, :, None] > 0)
+            if np.issubdtype(dtype, np.integer):
+                info = np.iinfo(dtype)
+                out_tile = np.clip(np.rint(acc), info.min, info.max).astype(dtype)
+            else:
+                out_tile = acc.astype(dtype)
+        if ovr is not None:
+            ovr.write(row0, col0, out_tile)
+        if band_stats is not None:
+            with part('stats'):
+                band_stats.add(out_tile, row0, col0)
+        return out_tile
+
+    def write_tile(tile, out_tile):
+        row0, row1, col0, col1 = tile
+        with part('write'):
+            if store is not None:
+                store.write(row0, col0, out_tile)
+            else:
+                out_mm[row0:row1, col0:col1] = out_tile
+        count_bytes(written=out_tile.nbytes)
+        print('      -> rows', row0, 'to', row1, ', cols', col0, 'to', col1)
+
+    tile_cols = tile_cols_for(interleaves, tile_cols)
+    tiles = list(iter_tiles(nrows, ncols, strip_rows, tile_cols))
+    with stage('mosaic', tiles=len(tiles), workers=workers, prefetch=prefetch, cubes=len(placements)):
+        print('---> Mosaicking', len(placements), 'cubes in', len(tiles), 'tiles of', strip_rows, 'rows on', workers,
+              'worker(s), feather =', feather)
+        if prefetch:
+            run_pipeline(tiles, read_tile, blend_tile, write_tile, workers=workers, depth=prefetch)
+        else:
+            run_tiles(tiles, lambda tile: write_tile(tile, blend_tile(tile, read_tile(tile))), workers=workers)
+
+    with stage('save'):
+        print('---> Writing mosaic to: ', outfilehdr, end='')
+        if store is None:
+            out_mm.flush()
+            del out_mm
+            if band_stats is not None:
+                save_stats(outfilehdr, band_stats)
+        else:
+            if band_stats is not None:
+                save_stats(outfilehdr, band_stats, store)
+            store.close()
+        if ovr is not None:
+            ovr.close()
+        for p in placements:
+            if hasattr(p['view'], 'close'):
+                p['view'].close()
+        print('  ... done <---')
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description='Mosaic fused cubes, placed by transforms, into one cube.')
+    parser.add_argument('manifest', help='CSV or JSON list of the cubes (cube, and transform or row, col)')
+    parser.add_argument('--out', required=True, help='mosaic output header (.hdr)')
+    parser.add_argument('--feather', type=float, default=32,
+                        help='width in pixels of the blend at the seams, 0 to average the overlaps '
+                             '(default: %(default)s)')
+    parser.add_argument('--interpolation', choices=sorted(interpolations), default='linear',
+                        help='kernel resampling cubes not placed by whole pixels (default: %(default)s)')
+    parser.add_argument('--strip-rows', type=int, default=256, help='rows per tile (default: %(default)s)')
+    parser.add_argument('--tile-cols', type=int, default=0,
+                        help='columns per tile, 0 for full width strips; only used for BIP files (default: %(default)s)')
+    parser.add_argument('--workers', type=int, default=1, help='threads processing tiles (default: %(default)s)')
+    parser.add_argument('--prefetch', type=int, default=0,
+                        help='tiles read ahead and written behind on their own threads while tiles are blended, '
+                             '0 to do one after the other (default: %(default)s)')
+    parser.add_argument('--interleave', choices=['bsq', 'bil', 'bip'], default='bip',
+                        help='interleave of the mosaic (default: %(default)s)')
+    parser.add_argument('--format', choices=['envi', 'chunked'], default='envi',
+                        help='raw ENVI cube or chunked compressed store (default: %(default)s)')
+    parser.add_argument('--chunks', default=','.join(str(n) for n in default_chunks),
+                        help='rows,cols,bands of a chunk of the store (default: %(default)s)')
+    parser.add_argument('--codec', choices=['zlib', 'lz4'], default='zlib',
+                        help='compression of the store, lz4 needs the lz4 package (default: %(default)s)')
+    parser.add_argument('--overviews', type=int, nargs='*', default=None, metavar='F',
+                        help='also write overviews of the mosaic at these reduction factors '
+                             '(no factors: 4, 8, ... down to 128 pixels)')
+    parser.add_argument('--no-stats', action='store_true',
+                        help='do not gather the per-band statistics (header and <out>_stats.json)')
+    parser.add_argument('--report', default=None,
+                        help='append the time, CPU, bytes and peak memory of every stage to this JSON-lines file')
+    parser.add_argument('--profile', default=None, help='run under cProfile and write the stats to this file')
+    args = parser.parse_args()
+    args.chunks = tuple(int(n) for n in args.chunks.split(','))
+    configure(args.report, scene=args.out)
+
+    start_time = time.time()
+    with profiled(args.profile), stage('mosaic_cubes'):
+        mosaic_cubes(read_placements(args.manifest), args.out, feather=args.feather, interpolation=args.interpolation,
+                     strip_rows=args.strip_rows, tile_cols=args.tile_cols, workers=args.workers,
+                     interleave=args.interleave, output_format=args.format, chunks=args.chunks, codec=args.codec,
+                     overviews=args.overviews, stats=not args.no_stats, prefetch=args.prefetch)
+    print("--- %5.2f seconds ---" % (time.time() - start_time))
+    print('CODE COMPLETION!')
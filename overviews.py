@@ -0,0 +1,252 @@
+'''
++
+=======================================================================
+
+ NAME:
+      overviews
+
+ DESCRIPTION:
+	reduced-resolution overviews of the cubes and of the images shown in the GUI.
+- block_sums / block_mean average f x f pixel blocks (partial blocks at the right
+and bottom edges average the pixels they have)
+- OverviewWriter writes 1/f resolution copies of a cube (<base>_ovr<f>.hdr) while
+the cube itself is written tile by tile: each tile starts on a multiple of the
+largest factor, so every overview pixel comes from a single tile and the tiles can
+be reduced on any number of threads; with reuse=True the existing overviews are
+opened in place, so only the tiles that changed need to be written again
+- ImagePyramid keeps an image with its 2x, 4x, ... block means, and ViewportImage
+shows one on a matplotlib axes, drawing only the visible region of the level that
+best matches the screen pixels
+
+ USES:
+numpy
+glob
+spectral (from the python package spectral), for OverviewWriter
+
+ NOTES:
+the images on a ViewportImage are placed with extents in full resolution pixels,
+so clicks on the axes give full resolution coordinates at every level.
+
+ HISTORY:
+2026/10/17: created
+
+=======================================================================
+-
+'''
+
+import numpy as np
+import glob
+import os
+
+# the GUI stops adding pyramid levels once the smaller side of the image is this small
+min_level_size = 256
+
+
+def overview_factors(nrows, ncols, first=4, min_size=128):
+    # the default overview factors of a cube: 4, 8, 16, ... while the overview stays
+    # at least min_size pixels on its smaller side
+    factors = []
+    f = first
+    while min(nrows, ncols) // f >= min_size:
+        factors.append(f)
+        f *= 2
+    return factors
+
+
+def overview_path(path, factor):
+    # <base>_ovr<factor>.hdr next to an output given as .hdr or as a .zcube store
+    base = os.path.splitext(path)[0] if path.lower().endswith(('.hdr', '.zcube')) else path
+    return '%s_ovr%d.hdr' % (base, factor)
+
+
+def overview_files(path, factors):
+    # the headers and data files of the overviews of an output at factors
+    return [p for f in factors for p in (overview_path(path, f), overview_path(path, f)[:-4] + '.img')]
+
+
+def overview_paths(path):
+    # the overview headers that exist for an output, by factor
+    pattern = overview_path(path, 0).replace('_ovr0.hdr', '_ovr*.hdr')
+    found = {}
+    for p in glob.glob(pattern):
+        suffix = p[len(pattern) - len('*.hdr'):-len('.hdr')]
+        if suffix.isdigit():
+            found[int(suffix)] = p
+    return dict(sorted(found.items()))
+
+
+def block_sums(x, f, counts=None):
+    '''
+    Sums f x f blocks of the first two axes of x in float64 (exact for any uint16
+    data); counts, the pixels behind each row and column of x (all 1 if None), is
+    summed alongside and returned as (row counts, column counts).
+    '''
+    rows, cols = x.shape[0], x.shape[1]
+    if counts is None:
+        counts = (np.ones(rows), np.ones(cols))
+    r_idx, c_idx = np.arange(0, rows, f), np.arange(0, cols, f)
+    s = np.add.reduceat(x, r_idx, axis=0, dtype=np.float64)
+    s = np.add.reduceat(s, c_idx, axis=1)
+    return s, (np.add.reduceat(counts[0], r_idx), np.add.reduceat(counts[1], c_idx))
+
+
+def block_mean(x, f):
+    s, (n_r, n_c) = block_sums(x, f)
+    n = np.outer(n_r, n_c)
+    return s / (n[:, :, None] if s.ndim == 3 else n)
+
+
+class OverviewWriter:
+    '''
+    Writes the overviews of a [rows, cols, bands] cube at each of factors, tile by
+    tile; every tile handed to write() must start on a multiple of the largest factor.
+    With reuse=True the overviews already written are opened in place.
+    '''
+
+    def __init__(self, path, shape, metadata, factors, dtype='uint16', interleave='bip', reuse=False):
+        import spectral.io.envi as envi
+        self.factors = sorted(factors)
+        self.paths, self.views = [], []
+        self.files = overview_files(path, self.factors)
+        self.reused = reuse
+        nrows, ncols, nbands = shape
+        for f in self.factors:
+            if reuse:
+                image = envi.open(overview_path(path, f))
+            else:
+                md = dict(metadata)
+                md['file type'] = 'ENVI Standard'
+                md['description'] = '1/%d resolution overview of %s' % (f, os.path.basename(path))
+                image = envi.create_image(overview_path(path, f), metadata=md, dtype=dtype, interleave=interleave,
+                                          shape=(-(-nrows // f), -(-ncols // f), nbands), offset=0, force=True)
+            self.paths.append(overview_path(path, f))
+            self.views.append(image.open_memmap(interleave='bip', writable=True))
+
+    def write(self, row0, col0, tile):
+        if row0 % self.factors[-1] or col0 % self.factors[-1]:
+            raise ValueError('tile at %d, %d does not start on a multiple of %d'
+                             % (row0, col0, self.factors[-1]))
+        # each level is summed from the sums of the one before, so the tile is read once
+        sums, counts, prev = tile, None, 1
+        for f, view in zip(self.factors, self.views):
+            sums, counts = block_sums(sums, f // prev, counts)
+            prev = f
+            mean = sums / np.outer(*counts)[:, :, None]
+            r0, c0 = row0 // f, col0 // f
+            out = view[r0:r0 + mean.shape[0], c0:c0 + mean.shape[1]]
+            if np.issubdtype(out.dtype, np.integer):
+                mean = np.rint(mean)
+            out[...] = mean
+
+    def close(self):
+        for view in self.views:
+            view.flush()
+        self.views = []
+
+
+def create_overviews(path, shape, metadata, factors, interleave='bip', checkpoint=None):
+    # an OverviewWriter for the output at path; factors None for no overviews, [] for
+    # the default ones of this shape. None if there are none to write. The overviews
+    # saved with checkpoint are reused while they are current.
+    if factors is None:
+        return None
+    factors = factors or overview_factors(shape[0], shape[1])
+    if not factors:
+        return None
+    reuse = checkpoint is not None and checkpoint.sidecars_current(overview_files(path, factors))
+    return OverviewWriter(path, shape, metadata, factors, interleave=interleave, reuse=reuse)
+
+
+class ImagePyramid:
+    '''
+    An image (2D, or [rows, cols, channels]) with its 2x, 4x, ... block means,
+    down to min_size pixels on the smaller side.  levels[k] is 1/2**k resolution.
+    '''
+
+    def __init__(self, image, min_size=None):
+        min_size = min_level_size if min_size is None else min_size
+        self.levels = [image]
+        while min(self.levels[-1].shape[:2]) >= 2 * min_size:
+            self.levels.append(block_mean(self.levels[-1], 2).astype(image.dtype))
+        self.shape = image.shape
+
+    def level_for(self, extent_px, screen_px):
+        # the coarsest level still having at least one pixel per screen pixel
+        k = 0
+        while k + 1 < len(self.levels) and extent_px / 2**(k + 1) >= screen_px:
+            k += 1
+        return k
+
+    def grid(self, x0, x1, y0, y1, screen_px):
+        '''
+        The level k best for showing full resolution columns x0:x1 and rows y0:y1
+        on screen_px pixels, the rows i0:i1 and columns j0:j1 of that level covering
+        them, and their extent in full resolution pixels.
+        '''
+        k = self.level_for(max(x1 - x0, y1 - y0), screen_px)
+        g = 2**k
+        level = self.levels[k]
+        i0, i1 = max(int(np.floor(y0 / g)), 0), min(int(np.ceil(y1 / g)), level.shape[0])
+        j0, j1 = max(int(np.floor(x0 / g)), 0), min(int(np.ceil(x1 / g)), level.shape[1])
+        extent = (j0 * g - 0.5, min(j1 * g, self.shape[1]) - 0.5, min(i1 * g, self.shape[0]) - 0.5, i0 * g - 0.5)
+        return k, (i0, i1, j0, j1), extent
+
+    def window(self, x0, x1, y0, y1, screen_px):
+        # the block of the best level for the region and its extent, see grid()
+        k, (i0, i1, j0, j1), extent = self.grid(x0, x1, y0, y1, screen_px)
+        return self.levels[k][i0:i1, j0:j1], extent
+
+    def to_level(self, k):
+        # 3x3 matrix taking full resolution pixel coordinates (x, y) to those of level k
+        g = 2.0**k
+        return np.array([[1 / g, 0, -(g - 1) / (2 * g)], [0, 1 / g, -(g - 1) / (2 * g)], [0, 0, 1]])
+
+
+def visible_region(ax, shape):
+    # full resolution (x0, x1, y0, y1) shown on the axes, clipped to an image of shape
+    (xa, xb), (ya, yb) = sorted(ax.get_xlim()), sorted(ax.get_ylim())
+    x0, x1 = max(int(np.floor(xa + 0.5)), 0), min(int(np.ceil(xb + 0.5)), shape[1])
+    y0, y1 = max(int(np.floor(ya + 0.5)), 0), min(int(np.ceil(yb + 0.5)), shape[0])
+    return x0, max(x1, x0 + 1), y0, max(y1, y0 + 1)
+
+
+def screen_pixels(ax):
+    bbox = ax.get_window_extent()
+    return max(int(max(bbox.width, bbox.height)), 1)
+
+
+class ViewportImage:
+    '''
+    Shows a large image on ax through its pyramid: the axes keep full resolution
+    coordinates and, whenever they are panned or zoomed, render(ax, x0, x1, y0, y1,
+    screen_px) is asked for the (block, extent) to draw.  By default that is the
+    pyramid window; the GUI's overlay passes its own to warp just that region.
+    '''
+
+    def __init__(self, ax, shape, render, **imshow_kwargs):
+        self.ax, self.shape, self.render = ax, shape, render
+        block, extent = render(ax, 0, shape[1], 0, shape[0], screen_pixels(ax))
+        self.im = ax.imshow(block, extent=extent, **imshow_kwargs)
+        ax.set_xlim(-0.5, shape[1] - 0.5)
+        ax.set_ylim(shape[0] - 0.5, -0.5)
+        # the limits are the user's from now on, a new extent must not reset them
+        ax.set_autoscale_on(False)
+        self._shown = None
+        ax.callbacks.connect('xlim_changed', self.update)
+        ax.callbacks.connect('ylim_changed', self.update)
+
+    def update(self, ax=None):
+        region = visible_region(self.ax, self.shape)
+        screen_px = screen_pixels(self.ax)
+        if (region, screen_px) == self._shown:
+            return
+        self._shown = (region, screen_px)
+        block, extent = self.render(self.ax, *region, screen_px)
+        self.im.set_data(block)
+        self.im.set_extent(extent)
+
+
+def pyramid_view(ax, pyramid, **imshow_kwargs):
+    # a ViewportImage drawing the pyramid itself
+    return ViewportImage(ax, pyramid.shape, lambda ax, x0, x1, y0, y1, px: pyramid.window(x0, x1, y0, y1, px),
+                         **imshow_kwargs)
@@ -0,0 +1,351 @@
+'''
++
+=======================================================================
+
+ NAME:
+      register_and_fuse
+
+ DESCRIPTION:
+	registers the SWIR cube to the VNIR cube and builds the full spectrum cube
+in a single pass, without writing and re-reading the intermediate warped SWIR cube.
+- for every tile of the VNIR grid, maps the tile back through the homography, reads
+the block of SWIR it samples from and warps it onto the tile (the remap of
+coregister_controlpoints_gui.save_image_envi)
+- fuses the warped SWIR tile with the VNIR tile (fusion_plan.FusionPlan) and writes it
+straight into the full spectrum output cube
+- writing the warped SWIR cube as well is optional (--warped-out)
+- the tiling, statistics, --roi and --keep / --bin-width work as in build_cube
+
+ USES:
+numpy
+cv2 (from the package OpenCV)
+spectral (from the python package spectral)
+argparse
+time
+coregister_controlpoints_gui, fusion_plan, stage_timing, tile_executor, chunked_store,
+overviews, checkpoint, band_stats (from this repository)
+
+ PARAMETERS:
+--vnir path.hdr          VNIR ENVI header
+--swir path.hdr          raw (unregistered) SWIR ENVI header
+--homography file        homography sidecar (.json) or 3x3 text file
+--out path.hdr           full spectrum output cube
+--warped-out path.hdr    (optional) also write the warped SWIR cube here
+--interpolation nearest|linear|cubic|lanczos   kernel of the warp (default linear), as in
+                         coregister_controlpoints_gui
+--scale-factor N, --strip-rows N, --tile-cols N, --workers N, --plan-dir dir,
+--interleave bsq|bil|bip, --format envi|chunked, --chunks R,C,B, --codec zlib|lz4,
+--overviews [F ...], --checkpoint, --no-stats, --prefetch N, --keep LO:HI,..., --bin-width W,
+--roi row0:row1,col0:col1, --report file, --profile file   as in build_cube
+
+ RETURNS:
+the full spectrum uint16 ENVI cube, the same as warping with
+coregister_controlpoints_gui and then fusing with build_cube
+
+=======================================================================
+-
+'''
+
+import numpy as np
+from spectral import open_image
+import spectral.io.envi as envi
+import argparse
+import time
+from fusion_plan import FusionPlan, default_plan_dir, band_index, parse_ranges, output_metadata
+from coregister_controlpoints_gui import (build_remap, remap_source_window, remap_bands,
+                                          warped_metadata, resolve_homography, interpolations)
+from tile_executor import (iter_tiles, run_tiles, run_pipeline, tile_cols_for, round_up, parse_roi, roi_window,
+                           crop_metadata)
+from stage_timing import stage, part, count_bytes, configure, profiled
+from chunked_store import create_store, store_path, default_chunks
+from overviews import create_overviews
+from checkpoint import Checkpoint, content_key, image_layout
+from band_stats import output_stats, save_stats, stats_path
+
+
+def register_and_fuse(vnir_path, swir_path, homography, full_outfilehdr, warped_outfilehdr=None,
+                      scale_factor=10000, strip_rows=256, tile_cols=0, workers=1, plan_dir=None, interleave='bip',
+                      output_format='envi', chunks=None, codec='zlib', overviews=None, checkpoint=False,
+                      interpolation='linear', stats=True, prefetch=0, keep=None, bin_width=None, roi=None):
+
+    ###
+    # open up the two files as memmaps, nothing is read yet
+    ###
+    with stage('load'):
+        print ('opening VNIR image file: ', vnir_path)
+        vnir_image = open_image(vnir_path)
+        vnir_mm = vnir_image.open_memmap(interleave='bip')
+        print('VNIR IMAGE rows, cols, bands: ', vnir_image.nrows, vnir_image.ncols, vnir_image.nbands)
+        print ('opening SWIR image file: ', swir_path)
+        swir_image = open_image(swir_path)
+        swir_mm = swir_image.open_memmap(interleave='bip')
+        print('SWIR IMAGE rows, cols, bands: ', swir_image.nrows, swir_image.ncols, swir_image.nbands)
+        print('')
+    homography = resolve_homography(homography, (vnir_image.nrows, vnir_image.ncols),
+                                     (swir_image.nrows, swir_image.ncols))
+
+    with stage('overlap'):
+        print('---> determining region of spectral overlap...')
+        swir_wvl = np.copy(swir_image.bands.centers)
+        # the SWIR is divided by its scale factor before it is warped, as the headless
+        # warp does, so the plan is the one build_cube uses on the warped cube
+        plan = FusionPlan.cached(np.copy(vnir_image.bands.centers), swir_wvl, scale_factor,
+                                 vnir_scale=vnir_image.scale_factor, plan_dir=plan_dir, keep=keep,
+                                 bin_width=bin_width)
+        print(' ...done <---')
+
+    ###
+    # pre-create the outputs on disk
+    ###
+    vnir_shape = (vnir_image.nrows, vnir_image.ncols)
+    swir_shape = (swir_image.nrows, swir_image.ncols)
+    md = output_metadata(vnir_image, plan, scale_factor)
+    md['file type'] = 'ENVI Standard'
+    # with a region of interest only that window of the VNIR grid is warped and fused
+    region = roi_window(roi, *vnir_shape)
+    if roi is not None:
+        md = crop_metadata(md, region)
+        print('---> region of interest: rows', region[0], 'to', region[1], ', cols', region[2], 'to', region[3])
+    nrows, ncols = region[1] - region[0], region[3] - region[2]
+    row_off, col_off = region[0], region[2]
+    roi_key = () if roi is None else (region,)
+    store, out_mm = None, None
+    row_steps, col_steps = [1], [1]
+    if checkpoint and output_format != 'envi':
+        print('---> a chunked store is always written whole, not checkpointed')
+    # a tile is keyed by the homography, its VNIR data and the SWIR block it samples
+    inputs = [vnir_image.filename, swir_image.filename]
+    layouts = (image_layout(vnir_image), image_layout(swir_image))
+    ck = Checkpoint(full_outfilehdr, content_key('register_and_fuse', plan.key, (nrows, ncols, plan.n_out),
+                                                 interleave, interpolation, layouts, *roi_key),
+                    params_key=content_key(homography), inputs=inputs,
+                    enabled=checkpoint and output_format == 'envi')
+    if output_format == 'chunked':
+        # tiles are fused into memory and handed to the store whole, as in build_cube
+        full_outfilehdr = store_path(full_outfilehdr)
+        store = create_store(full_outfilehdr, (nrows, ncols, plan.n_out), 'uint16', metadata=md, chunks=chunks,
+                             codec=codec)
+        row_steps.append(store.chunks[0])
+        col_steps.append(store.chunks[1])
+        interleave = 'bip'
+    else:
+        out_mm = ck.open_output(md, 'uint16', interleave, (nrows, ncols, plan.n_out))
+    ovr = create_overviews(full_outfilehdr, (nrows, ncols, plan.n_out), md, overviews, interleave=interleave,
+                           checkpoint=ck)
+    if ovr is not None:
+        row_steps.append(ovr.factors[-1])
+        col_steps.append(ovr.factors[-1])
+    strip_rows, tile_cols = round_up(strip_rows, *row_steps), round_up(tile_cols, *col_steps)
+    band_stats = output_stats(plan, scale_factor) if stats else None
+    # statistics and overviews saved with the checkpoint are kept, as in build_cube
+    keep_stats = band_stats is not None and ck.sidecars_current([stats_path(full_outfilehdr)])
+    read_back = (ovr is not None and not ovr.reused) or (band_stats is not None and not keep_stats)
+    skipped = []
+    warped_mm, warped_ck = None, None
+    if warped_outfilehdr is not None:
+        warped_md = warped_metadata(vnir_image.metadata, swir_wvl)
+        if roi is not None:
+            warped_md = crop_metadata(warped_md, region)
+        warped_ck = Checkpoint(warped_outfilehdr, content_key('warped', (nrows, ncols, swir_image.nbands), 'bsq',
+                                                              interpolation, layouts, *roi_key),
+                               params_key=content_key(homography), inputs=inputs, enabled=checkpoint)
+        warped_mm = warped_ck.open_output(warped_md, 'float32', 'bsq', (nrows, ncols, swir_image.nbands))
+
+    # a tile is read, warped and fused, and written in three steps; with prefetch they
+    # overlap (tile_executor.run_pipeline), and the tiles are then copied out of and into
+    # the memmaps by the reader and writer threads instead of being used in place; a tile
+    # is keyed from the memmaps before, so one that is up to date is not copied
+    load = np.array if prefetch else np.asarray
+    # only the bands the plan uses are read and warped, all of the SWIR if it is written too
+    vnir_bands = band_index(plan.vnir_bands)
+    swir_bands = band_index(plan.swir_bands) if warped_mm is None else slice(None)
+    n_warped = plan.swir_bands.size if warped_mm is None else swir_image.nbands
+    tile_plan = plan.on_used_bands(swir=warped_mm is None)
+
+    def read_tile(tile):
+        row0, row1, col0, col1 = tile
+        with part('remap'):
+            rows, cols = (row0 + row_off, row1 + row_off), (col0 + col_off, col1 + col_off)
+            map_x, map_y = build_remap(homography, swir_shape, vnir_shape, rows=rows, cols=cols)
+            window = remap_source_window(map_x, map_y, swir_shape, interpolation)
+        vnir_tile = vnir_mm[rows[0]:rows[1], cols[0]:cols[1], vnir_bands]
+
+        keys = []
+        def tile_key():
+            if not keys:
+                src = swir_mm[window[0]:window[1], window[2]:window[3], swir_bands] if window is not None else None
+                keys.append(content_key(homography, window, vnir_tile, src))
+            return keys[0]
+        key = ck.stale(tile, tile_key)
+        warped_key = warped_ck.stale(tile, tile_key) if warped_ck is not None else None
+        if key is None and warped_key is None:
+            # up to date; only overviews or statistics made anew need the fused tile
+            if read_back:
+                return None, load(out_mm[row0:row1, col0:col1])
+            skipped.append(tile)
+            return None, None
+        # the tile is redone for both outputs, so the one that was current is recorded again
+        if key is None:
+            key = tile_key()
+        if warped_key is None and warped_ck is not None:
+            warped_key = tile_key()
+
+        src = None
+        if window is not None:
+            # read just the block of SWIR this tile samples from
+            y0, y1, x0, x1 = window
+            with part('read_swir'):
+                block = swir_mm[y0:y1, x0:x1, swir_bands]
+                src = block.astype(np.float32)
+                if swir_image.scale_factor != 1:
+                    src /= np.float32(swir_image.scale_factor)
+            count_bytes(read=block.nbytes)
+        return (key, warped_key), (map_x, map_y, window, load(vnir_tile), src)
+
+    def fuse_tile(tile, data):
+        row0, row1, col0, col1 = tile
+        keys, tile_data = data
+        warped_tile = None
+        if keys is None:
+            out_tile = tile_data
+        else:
+            map_x, map_y, window, vnir_tile, src = tile_data
+            swir_tile = np.zeros((row1 - row0, col1 - col0, n_warped), dtype=np.float32)
+            if window is not None:
+                y0, y1, x0, x1 = window
+                with part('warp'):
+                    remap_bands(src, map_x - np.float32(x0), map_y - np.float32(y0), swir_tile, interpolation)
+            if warped_mm is not None:
+                warped_tile = swir_tile
+            if store is None and not prefetch:
+                out_tile = tile_plan.apply(vnir_tile, swir_tile, out=out_mm[row0:row1, col0:col1])
+            else:
+                out_tile = tile_plan.apply(vnir_tile, swir_tile)
+            count_bytes(read=vnir_tile.nbytes)
+        if out_tile is not None:
+            if ovr is not None:
+                ovr.write(row0, col0, out_tile)
+            if band_stats is not None:
+                with part('stats'):
+                    band_stats.add(out_tile, row0, col0)
+        return keys, out_tile, warped_tile
+
+    def write_tile(tile, result):
+        row0, row1, col0, col1 = tile
+        keys, out_tile, warped_tile = result
+        if keys is None:
+            return
+        key, warped_key = keys
+        if warped_tile is not None:
+            with part('write_warped'):
+                warped_mm[row0:row1, col0:col1] = warped_tile
+            count_bytes(written=warped_tile.nbytes)
+            warped_ck.record(tile, warped_key)
+        if store is not None:
+            store.write(row0, col0, out_tile)
+        elif prefetch:
+            out_mm[row0:row1, col0:col1] = out_tile
+        ck.record(tile, key)
+        count_bytes(written=out_tile.nbytes)
+        print('      -> rows', row0, 'to', row1, ', cols', col0, 'to', col1)
+
+    tile_cols = tile_cols_for([vnir_image.metadata['interleave'], interleave], tile_cols)
+    tiles = list(iter_tiles(nrows, ncols, strip_rows, tile_cols))
+    with stage('warp_fuse', tiles=len(tiles), workers=workers, prefetch=prefetch):
+        print('---> Warping and fusing the cube in', len(tiles), 'tiles of', strip_rows, 'rows on', workers,
+              'worker(s), scale factor =', scale_factor)
+        if prefetch:
+            run_pipeline(tiles, read_tile, fuse_tile, write_tile, workers=workers, depth=prefetch)
+        else:
+            run_tiles(tiles, lambda tile: write_tile(tile, fuse_tile(tile, read_tile(tile))), workers=workers)
+        ck.report()
+        if keep_stats and ck.computed:
+            # the saved statistics are out of date, the tiles skipped are read back for new ones
+            run_tiles(skipped, lambda t: band_stats.add(out_mm[t[0]:t[1], t[2]:t[3]], t[0], t[2]), workers=workers)
+            keep_stats = False
+
+    with stage('save'):
+        print('---> Writing cube to: ', full_outfilehdr, end='')
+        sidecars = []
+        if ovr is not None:
+            ovr.close()
+            sidecars += ovr.files
+        if store is None:
+            out_mm.flush()
+            del out_mm
+            if band_stats is not None:
+                if not keep_stats:
+                    save_stats(full_outfilehdr, band_stats)
+                sidecars.append(stats_path(full_outfilehdr))
+            ck.save(md, sidecars)
+        else:
+            if band_stats is not None:
+                save_stats(full_outfilehdr, band_stats, store)
+            store.close()
+        if warped_mm is not None:
+            warped_mm.flush()
+            del warped_mm
+            warped_ck.save(warped_md)
+        print('  ... done <---')
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description='Register the SWIR cube to the VNIR cube and fuse them in one pass.')
+    parser.add_argument('--vnir', required=True, help='VNIR ENVI header (.hdr)')
+    parser.add_argument('--swir', required=True, help='raw SWIR ENVI header (.hdr)')
+    parser.add_argument('--homography', required=True, help='homography sidecar (.json) or 3x3 text file')
+    parser.add_argument('--out', required=True, help='full spectrum output header (.hdr)')
+    parser.add_argument('--warped-out', default=None, help='also write the warped SWIR cube to this header')
+    parser.add_argument('--interpolation', choices=sorted(interpolations), default='linear',
+                        help='kernel resampling the SWIR onto the VNIR grid (default: %(default)s)')
+    parser.add_argument('--scale-factor', type=int, default=10000,
+                        help='reflectance scale factor of the uint16 output (default: %(default)s)')
+    parser.add_argument('--strip-rows', type=int, default=256, help='rows per tile (default: %(default)s)')
+    parser.add_argument('--tile-cols', type=int, default=0,
+                        help='columns per tile, 0 for full width strips; only used for BIP files (default: %(default)s)')
+    parser.add_argument('--workers', type=int, default=1, help='threads processing tiles (default: %(default)s)')
+    parser.add_argument('--plan-dir', default=default_plan_dir,
+                        help='directory the fusion plans are cached in, "" to not cache (default: %(default)s)')
+    parser.add_argument('--interleave', choices=['bsq', 'bil', 'bip'], default='bip',
+                        help='interleave of the fused cube (default: %(default)s)')
+    parser.add_argument('--format', choices=['envi', 'chunked'], default='envi',
+                        help='raw ENVI cube or chunked compressed store (default: %(default)s)')
+    parser.add_argument('--chunks', default=','.join(str(n) for n in default_chunks),
+                        help='rows,cols,bands of a chunk of the store (default: %(default)s)')
+    parser.add_argument('--codec', choices=['zlib', 'lz4'], default='zlib',
+                        help='compression of the store, lz4 needs the lz4 package (default: %(default)s)')
+    parser.add_argument('--overviews', type=int, nargs='*', default=None, metavar='F',
+                        help='also write overviews of the fused cube at these reduction factors '
+                             '(no factors: 4, 8, ... down to 128 pixels)')
+    parser.add_argument('--checkpoint', action='store_true',
+                        help='keep a content-hashed checkpoint and only recompute the tiles whose inputs changed')
+    parser.add_argument('--prefetch', type=int, default=0,
+                        help='tiles read ahead and written behind on their own threads while tiles are warped '
+                             'and fused, 0 to do one after the other (default: %(default)s)')
+    parser.add_argument('--roi', type=parse_roi, default=None, metavar='ROW0:ROW1,COL0:COL1',
+                        help='only fuse this window of the VNIR grid, reading just the SWIR it maps to')
+    parser.add_argument('--keep', type=parse_ranges, default=None, metavar='LO:HI,...',
+                        help='only output the bands within these wavelength ranges, e.g. 400:1340,1460:1790')
+    parser.add_argument('--bin-width', type=float, default=None,
+                        help='resample the output onto bands this far apart (in the units of the wavelengths)')
+    parser.add_argument('--no-stats', action='store_true',
+                        help='do not gather the per-band statistics (header and <out>_stats.json)')
+    parser.add_argument('--report', default=None,
+                        help='append the time, CPU, bytes and peak memory of every stage to this JSON-lines file')
+    parser.add_argument('--profile', default=None, help='run under cProfile and write the stats to this file')
+    args = parser.parse_args()
+    args.chunks = tuple(int(n) for n in args.chunks.split(','))
+    configure(args.report, scene=args.out)
+
+    start_time = time.time()
+    with profiled(args.profile), stage('register_and_fuse'):
+        register_and_fuse(args.vnir, args.swir, args.homography, args.out, warped_outfilehdr=args.warped_out,
+                          scale_factor=args.scale_factor, strip_rows=args.strip_rows, tile_cols=args.tile_cols,
+                          workers=args.workers, plan_dir=args.plan_dir, interleave=args.interleave,
+                          output_format=args.format, chunks=args.chunks, codec=args.codec,
+                          overviews=args.overviews, checkpoint=args.checkpoint, interpolation=args.interpolation,
+                          stats=not args.no_stats, prefetch=args.prefetch, keep=args.keep,
+                          bin_width=args.bin_width, roi=args.roi)
+    print("--- %5.2f seconds ---" % (time.time() - start_time))
+    print('CODE COMPLETION!')
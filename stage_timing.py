@@ -0,0 +1,204 @@
+'''
++
+=======================================================================
+
+ NAME:
+      stage_timing
+
+ DESCRIPTION:
+	named stage spans for the pipeline scripts, written as a JSON-lines report.
+- `with stage('fuse', scene=...):` records, for the stage, the wall and CPU time,
+the bytes the code read and wrote (count_bytes), the bytes the process read and
+wrote at the storage layer (/proc/self/io, Linux), the peak RSS during the stage
+and whether it finished or raised
+- `with part('warp'):` inside a stage, e.g. in the per-tile code, adds its wall
+time to the 'parts' of the innermost open stage; it is thread safe, so the tile
+workers of tile_executor can all report into the same stage
+- each finished stage is appended to the report straight away, so the report of a
+run that crashed ends with the stage that failed (status 'error')
+- profiled(path) runs a block under cProfile and dumps the stats to path
+
+ USES:
+cProfile, json, resource, threading, time
+
+ NOTES:
+stages are meant for the coarse steps of a run (loading, warping, fusing, saving)
+and are opened from the main thread; per tile work goes in part().
+The peak RSS of a stage uses the kernel's resettable high-water mark
+(/proc/self/clear_refs) when available, otherwise it is the peak of the process
+so far (ru_maxrss).
+
+ HISTORY:
+2026/10/17: created
+
+=======================================================================
+-
+'''
+
+import contextlib
+import cProfile
+import json
+import os
+import sys
+import threading
+import time
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+# JSON-lines report the finished stages are appended to, None to only keep them in memory
+report_path = None
+# every finished stage of this process, as the dicts written to the report
+records = []
+# extra fields written with every stage, e.g. the scene
+context = {}
+
+_open_stages = []
+_lock = threading.Lock()
+
+
+def configure(report=None, **fields):
+    # where the report goes and the fields every stage of this run carries
+    global report_path
+    report_path = report
+    context.clear()
+    context.update(fields)
+
+
+def _status_kb(field):
+    # a 'VmHWM:   1234 kB' style line of /proc/self/status, None if not available
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith(field + ':'):
+                    return int(line.split()[1])
+    except (OSError, ValueError):
+        pass
+    return None
+
+
+def _reset_peak_rss():
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except OSError:
+        return False
+
+
+def _peak_rss_mb():
+    hwm = _status_kb('VmHWM')
+    if hwm is not None:
+        return hwm / 1024.0
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss / 1024.0**2 if sys.platform == 'darwin' else rss / 1024.0
+
+
+def _io_bytes():
+    # bytes this process read from and wrote to storage so far (page cache hits not included)
+    try:
+        with open('/proc/self/io') as f:
+            io = dict(line.split(':') for line in f)
+        return int(io['read_bytes']), int(io['write_bytes'])
+    except (OSError, KeyError, ValueError):
+        return None, None
+
+
+def _write(record):
+    records.append(record)
+    if report_path is None:
+        return
+    # one write per line in append mode, so processes can share a report
+    with open(report_path, 'a') as f:
+        f.write(json.dumps(record, default=str) + '\n')
+
+
+@contextlib.contextmanager
+def stage(name, **fields):
+    '''
+    Records the enclosed block as the stage `name`; extra keyword arguments are
+    written with it.
+    '''
+    parent = _open_stages[-1] if _open_stages else None
+    if parent is not None:
+        # the peak is reset below, so the parent keeps what it has seen so far
+        parent['_peak'] = max(parent['_peak'] or 0, _peak_rss_mb() or 0)
+    span = {'stage': name, 'parent': parent['stage'] if parent else None, 'depth': len(_open_stages),
+            'start': time.strftime('%Y-%m-%dT%H:%M:%S'), 'pid': os.getpid(),
+            'bytes_read': 0, 'bytes_written': 0, 'parts': {}, '_peak': None}
+    span.update(context)
+    span.update(fields)
+    span['peak_rss_is_stage_peak'] = _reset_peak_rss()
+    io_read, io_written = _io_bytes()
+    wall, cpu = time.perf_counter(), time.process_time()
+    _open_stages.append(span)
+    try:
+        yield span
+        span['status'] = 'ok'
+    except BaseException as e:
+        span['status'] = 'error'
+        span['error'] = '%s: %s' % (type(e).__name__, e)
+        raise
+    finally:
+        _open_stages.pop()
+        span['wall_s'] = time.perf_counter() - wall
+        span['cpu_s'] = time.process_time() - cpu
+        io_read_end, io_written_end = _io_bytes()
+        if io_read is not None and io_read_end is not None:
+            span['io_read_bytes'] = io_read_end - io_read
+            span['io_write_bytes'] = io_written_end - io_written
+        peak, children_peak = _peak_rss_mb(), span.pop('_peak')
+        span['peak_rss_mb'] = max(children_peak or 0, peak) if peak is not None else None
+        if parent is not None:
+            with _lock:
+                parent['bytes_read'] += span['bytes_read']
+                parent['bytes_written'] += span['bytes_written']
+            parent['_peak'] = max(parent['_peak'] or 0, span['peak_rss_mb'] or 0)
+        _write(span)
+
+
+@contextlib.contextmanager
+def part(name):
+    # adds the wall time of the block to parts[name] of the innermost open stage
+    if not _open_stages:
+        yield
+        return
+    span = _open_stages[-1]
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        seconds = time.perf_counter() - start
+        with _lock:
+            span['parts'][name] = span['parts'].get(name, 0.0) + seconds
+
+
+def count_bytes(read=0, written=0):
+    # bytes of image data the code read/wrote, credited to the innermost open stage
+    if not _open_stages:
+        return
+    span = _open_stages[-1]
+    with _lock:
+        span['bytes_read'] += int(read)
+        span['bytes_written'] += int(written)
+
+
+@contextlib.contextmanager
+def profiled(path=None):
+    # runs the block under cProfile and dumps the stats to path (view them with pstats
+    # or snakeviz); does nothing if path is None
+    if path is None:
+        yield
+        return
+    profile = cProfile.Profile()
+    profile.enable()
+    try:
+        yield
+    finally:
+        profile.disable()
+        profile.dump_stats(path)
+        print('---> profile written to: ', path)
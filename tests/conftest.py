@@ -0,0 +1,80 @@
+'''
+shared fixtures of the tests: a small synthetic VNIR/SWIR pair, registered, on the
+wavelength grids of the real sensors, and its fusion by the in-memory build_cube,
+the baseline every streamed stage is compared with
+'''
+
+import os
+import shutil
+import sys
+import numpy as np
+import pytest
+import spectral.io.envi as envi
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# a scene that does not divide evenly into the tiles the tests use
+nrows, ncols = 37, 29
+vnir_wvl = np.round(np.linspace(398.0, 1002.0, 375), 3)
+swir_wvl = np.round(np.linspace(899.0, 2502.0, 267), 3)
+
+
+def write_cube(path, data, wavelengths, interleave='bil', scale=10000, metadata=None):
+    # an ENVI cube at path (.hdr) holding the [rows, cols, bands] data
+    md = {'wavelength': [str(w) for w in wavelengths], 'file type': 'ENVI Standard'}
+    if scale is not None:
+        md['reflectance scale factor'] = scale
+    md.update(metadata or {})
+    image = envi.create_image(path, metadata=md, dtype=data.dtype, interleave=interleave, shape=data.shape,
+                              force=True)
+    mm = image.open_memmap(interleave='bip', writable=True)
+    mm[...] = data
+    mm.flush()
+    return path
+
+
+def synthetic_cube(rng, shape, wavelengths, scale=10000):
+    # smooth spectra that vary from pixel to pixel, as uint16 reflectance * scale
+    bumps = rng.uniform(0.1, 0.6, (shape[0], shape[1], 3))
+    centers = np.array([600.0, 1200.0, 2100.0])
+    spectra = sum(bumps[:, :, i:i + 1] * np.exp(-((wavelengths - centers[i]) / 400.0) ** 2) for i in range(3))
+    spectra = spectra + rng.normal(0, 0.01, (shape[0], shape[1], wavelengths.size))
+    return np.clip(np.rint(spectra * scale), 0, 65535).astype(np.uint16)
+
+
+def copy_cube(src_hdr, dst_hdr):
+    # a copy of the ENVI cube src_hdr (header and data file) at dst_hdr
+    shutil.copy(src_hdr, dst_hdr)
+    shutil.copy(envi.open(src_hdr).filename, dst_hdr[:-4] + '.img')
+    return dst_hdr
+
+
+def read_cube(hdr):
+    return np.array(envi.open(hdr).open_memmap(interleave='bip'))
+
+
+@pytest.fixture(scope='session')
+def pair(tmp_path_factory):
+    '''
+    The synthetic pair: the paths without .hdr (as build_cube takes them) and with
+    it, and the arrays.
+    '''
+    workdir = tmp_path_factory.mktemp('pair')
+    rng = np.random.default_rng(1)
+    vnir = synthetic_cube(rng, (nrows, ncols), vnir_wvl)
+    swir = synthetic_cube(rng, (nrows, ncols), swir_wvl)
+    map_info = ['UTM', '1', '1', '500000', '4000000', '0.5', '0.5', '18', 'North', 'WGS-84']
+    write_cube(str(workdir / 'vnir.hdr'), vnir, vnir_wvl, metadata={'map info': map_info})
+    write_cube(str(workdir / 'swir.hdr'), swir, swir_wvl)
+    return {'dir': workdir, 'vnir': str(workdir / 'vnir'), 'swir': str(workdir / 'swir'),
+            'vnir_hdr': str(workdir / 'vnir.hdr'), 'swir_hdr': str(workdir / 'swir.hdr'),
+            'vnir_data': vnir, 'swir_data': swir}
+
+
+@pytest.fixture(scope='session')
+def baseline(pair, tmp_path_factory):
+    # the fused cube of the pair from the in-memory build_cube
+    from build_cube import build_cube
+    out = str(tmp_path_factory.mktemp('baseline') / 'full.hdr')
+    build_cube(pair['vnir'], pair['swir'], out)
+    return read_cube(out)
@@ -0,0 +1,54 @@
+'''
+the automatic control points: a textured image and a copy of it warped with a known
+homography (and mirrored, as the SWIR camera sees the scene) give that homography back
+'''
+
+import cv2
+import numpy as np
+import pytest
+
+
+def textured_pair(M, shape=(400, 440), seed=5):
+    # the VNIR image, and the SWIR image whose flipped version M takes onto it
+    rng = np.random.default_rng(seed)
+    vnir = cv2.GaussianBlur(rng.uniform(0, 1, shape).astype(np.float32), (0, 0), 2.0)
+    swir_flipped = cv2.warpPerspective(vnir, M, (shape[1], shape[0]), flags=cv2.INTER_LINEAR | cv2.WARP_INVERSE_MAP)
+    return vnir, np.fliplr(swir_flipped)
+
+
+def projection_error(M, M_true, shape):
+    x, y = np.meshgrid(np.linspace(50, shape[1] - 50, 7), np.linspace(50, shape[0] - 50, 7))
+    pts = np.stack([x.ravel(), y.ravel()], axis=1).reshape(-1, 1, 2)
+    return np.abs(cv2.perspectiveTransform(pts, M) - cv2.perspectiveTransform(pts, M_true)).max()
+
+
+@pytest.mark.parametrize('min_size', [256, 128])
+def test_recovers_known_homography(min_size):
+    # min_size 128 matches on the half resolution level and refines at full resolution
+    from coregister_controlpoints_gui import auto_control_points
+    a = np.deg2rad(3.0)
+    M_true = np.array([[1.02 * np.cos(a), -np.sin(a), 12.0], [np.sin(a), 1.02 * np.cos(a), -7.5], [2e-6, 0, 1]])
+    vnir, swir = textured_pair(M_true)
+    match = auto_control_points(vnir, swir, min_size=min_size)
+    assert match is not None
+    assert match['n_inliers'] >= 12
+    assert match['rms_error'] < 0.5
+    assert projection_error(match['M'], M_true, vnir.shape) < 0.5
+
+
+def test_no_match_on_a_flat_image():
+    from coregister_controlpoints_gui import auto_control_points
+    flat = np.full((300, 300), 0.5, dtype=np.float32)
+    flat[0, 0] = 0.0
+    assert auto_control_points(flat, flat) is None
+
+
+def test_no_homography_for_collinear_points():
+    # cv2.findHomography gives no matrix for points on a line, the GUI asks for new ones
+    from coregister_controlpoints_gui import fit_homography
+    swir = np.array([[0, 0], [10, 10], [20, 20], [30, 30], [40, 40]], dtype=np.float64)
+    assert fit_homography(swir, swir * 2) is None
+    square = np.array([[0, 0], [100, 0], [100, 100], [0, 100]], dtype=np.float64)
+    M, mask = fit_homography(square, square + 5)
+    assert np.allclose(M, [[1, 0, 5], [0, 1, 5], [0, 0, 1]], atol=1e-6)
+    assert mask.sum() == 4
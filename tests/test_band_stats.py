@@ -0,0 +1,75 @@
+'''
+the per-band statistics gathered while the cube is written, against numpy on the
+written cube; the tiling and the number of threads do not change them
+'''
+
+import numpy as np
+import pytest
+import spectral.io.envi as envi
+from conftest import read_cube, vnir_wvl, swir_wvl
+
+
+@pytest.fixture(scope='module')
+def tiled(pair, tmp_path_factory):
+    # a cube fused in 8 row by 16 column tiles (tiled BIP) on 3 threads
+    from build_cube import build_cube_streamed
+    from band_stats import load_stats
+    out = str(tmp_path_factory.mktemp('tiled') / 'full.hdr')
+    build_cube_streamed(pair['vnir'], pair['swir'], out, strip_rows=8, tile_cols=16, workers=3)
+    return read_cube(out), load_stats(out), envi.open(out).metadata
+
+
+def test_moments_match_numpy(tiled):
+    cube, stats, md = tiled
+    x = cube.reshape(-1, cube.shape[2]).astype(np.float64)
+    assert stats['count'] == x.shape[0]
+    assert np.array_equal(stats['minimum'], x.min(axis=0))
+    assert np.array_equal(stats['maximum'], x.max(axis=0))
+    assert np.allclose(stats['mean'], x.mean(axis=0), rtol=1e-12)
+    assert np.allclose(stats['stddev'], x.std(axis=0), rtol=1e-9)
+
+
+def test_header_fields(tiled):
+    cube, stats, md = tiled
+    x = cube.reshape(-1, cube.shape[2]).astype(np.float64)
+    assert [int(v) for v in md['band minimum']] == x.min(axis=0).tolist()
+    assert [int(v) for v in md['band maximum']] == x.max(axis=0).tolist()
+    assert np.allclose([float(v) for v in md['band mean']], x.mean(axis=0), rtol=1e-5)
+    assert np.allclose([float(v) for v in md['band stddev']], x.std(axis=0), rtol=1e-5)
+
+
+def test_histogram_and_percentiles(tiled):
+    # the histograms count every hist_step-th row and column of the cube, and the q-th
+    # percentile interpolated from them falls in a bin where that sample reaches q %
+    from band_stats import percentiles
+    cube, stats, md = tiled
+    step = stats['hist_step']
+    sample = cube[::step, ::step].reshape(-1, cube.shape[2]).astype(np.float64)
+    low, high = stats['hist_range']
+    width = (high - low) / stats['hist_bins']
+    edges = np.linspace(low, high, stats['hist_bins'] + 1)
+    expected = np.stack([np.histogram(np.clip(sample[:, b], low, high - 1), edges)[0] for b in range(cube.shape[2])])
+    assert np.array_equal(stats['histogram'], expected)
+    q = np.array([2, 50, 98])
+    bin_low = low + np.clip(np.floor((percentiles(stats, q) - low) / width), 0, stats['hist_bins'] - 1) * width
+    below = (sample.T[:, None, :] < bin_low[:, :, None]).mean(axis=2)
+    through = (sample.T[:, None, :] < bin_low[:, :, None] + width).mean(axis=2)
+    assert np.all(below <= q / 100.0 + 1e-9) and np.all(q / 100.0 <= through + 1e-9)
+
+
+def test_stats_do_not_depend_on_tiling(pair, tiled, tmp_path):
+    from build_cube import build_cube, build_cube_streamed
+    from band_stats import load_stats
+    for n, kwargs in enumerate([dict(strip_rows=256), dict(strip_rows=5, workers=2, prefetch=2)]):
+        out = str(tmp_path / ('full%d.hdr' % n))
+        build_cube_streamed(pair['vnir'], pair['swir'], out, **kwargs)
+        assert load_stats(out) == tiled[1]
+    # the in-memory build has the same cube outside the blended bands, and the same
+    # statistics there
+    from fusion_plan import FusionPlan
+    out = str(tmp_path / 'in_memory.hdr')
+    build_cube(pair['vnir'], pair['swir'], out)
+    in_memory = load_stats(out)
+    copied = np.setdiff1d(np.arange(tiled[0].shape[2]), FusionPlan.build(vnir_wvl, swir_wvl).blend_rows)
+    for field in ('minimum', 'maximum', 'mean', 'stddev'):
+        assert np.array_equal(np.array(in_memory[field])[copied], np.array(tiled[1][field])[copied])
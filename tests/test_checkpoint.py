@@ -0,0 +1,99 @@
+'''
+the checkpoints of the streamed build_cube: a rerun skips the tiles whose inputs
+did not change, recomputes the others, and always ends with the cube a fresh build
+gives
+'''
+
+import os
+import re
+import numpy as np
+import spectral.io.envi as envi
+from conftest import copy_cube, read_cube
+
+
+def tile_counts(output):
+    # (up to date, recomputed) from the report of the last run in the captured output
+    counts = re.findall(r'checkpoint: (\d+) tile\(s\) up to date, (\d+) recomputed', output)
+    return tuple(int(n) for n in counts[-1]) if counts else None
+
+
+def build(vnir, swir, out, **kwargs):
+    from build_cube import build_cube_streamed
+    build_cube_streamed(vnir, swir, out, strip_rows=8, **kwargs)
+    return read_cube(out)
+
+
+def test_checkpoint_skip_and_update(pair, tmp_path, capsys):
+    from checkpoint import checkpoint_path
+    vnir = copy_cube(pair['vnir_hdr'], str(tmp_path / 'vnir.hdr'))[:-4]
+    swir = copy_cube(pair['swir_hdr'], str(tmp_path / 'swir.hdr'))[:-4]
+    out = str(tmp_path / 'full.hdr')
+    first = build(vnir, swir, out, checkpoint=True)
+    assert os.path.exists(checkpoint_path(out))
+    assert np.array_equal(first, build(vnir, swir, str(tmp_path / 'fresh.hdr')))
+
+    # nothing changed: every tile (5 strips of 8 rows) is skipped
+    capsys.readouterr()
+    assert np.array_equal(build(vnir, swir, out, checkpoint=True), first)
+    assert tile_counts(capsys.readouterr().out) == (5, 0)
+
+    # two VNIR rows of the second strip changed: only that strip is redone
+    mm = envi.open(vnir + '.hdr').open_memmap(interleave='bip', writable=True)
+    mm[10:12] = mm[10:12] // 2
+    mm.flush()
+    del mm
+    updated = build(vnir, swir, out, checkpoint=True)
+    assert tile_counts(capsys.readouterr().out) == (4, 1)
+    assert np.array_equal(updated, build(vnir, swir, str(tmp_path / 'fresh2.hdr')))
+    assert not np.array_equal(updated[8:16], first[8:16])
+    assert np.array_equal(updated[16:], first[16:])
+
+
+def test_checkpoint_rebuilds_on_other_settings(pair, tmp_path, capsys):
+    # another scale factor changes every value: the cube is rebuilt, not patched
+    out = str(tmp_path / 'full.hdr')
+    build(pair['vnir'], pair['swir'], out, checkpoint=True)
+    capsys.readouterr()
+    rebuilt = build(pair['vnir'], pair['swir'], out, checkpoint=True, scale_factor=5000)
+    assert tile_counts(capsys.readouterr().out) is None
+    assert np.array_equal(rebuilt, build(pair['vnir'], pair['swir'], str(tmp_path / 'fresh.hdr'),
+                                         scale_factor=5000))
+
+
+def test_checkpoint_resume_without_record(pair, tmp_path):
+    # a run that died before saving its checkpoint leaves none: the next run redoes everything
+    from checkpoint import checkpoint_path
+    out = str(tmp_path / 'full.hdr')
+    first = build(pair['vnir'], pair['swir'], out, checkpoint=True)
+    os.remove(checkpoint_path(out))
+    mm = envi.open(out).open_memmap(interleave='bip', writable=True)
+    mm[:8] = 0
+    mm.flush()
+    del mm
+    assert np.array_equal(build(pair['vnir'], pair['swir'], out, checkpoint=True), first)
+
+
+def test_checkpoint_keeps_current_sidecars(pair, tmp_path):
+    # the statistics and overviews saved with the checkpoint are kept while nothing
+    # changed, and are made anew, as a fresh build makes them, once a tile changed
+    from band_stats import stats_path, load_stats
+    from overviews import overview_path
+    vnir = copy_cube(pair['vnir_hdr'], str(tmp_path / 'vnir.hdr'))[:-4]
+    swir = copy_cube(pair['swir_hdr'], str(tmp_path / 'swir.hdr'))[:-4]
+    out = str(tmp_path / 'full.hdr')
+    sidecars = [stats_path(out), overview_path(out, 2), overview_path(out, 2)[:-4] + '.img']
+    build(vnir, swir, out, checkpoint=True, overviews=[2])
+    before = [os.stat(p).st_mtime_ns for p in sidecars]
+    build(vnir, swir, out, checkpoint=True, overviews=[2], prefetch=2)
+    assert [os.stat(p).st_mtime_ns for p in sidecars] == before
+
+    mm = envi.open(vnir + '.hdr').open_memmap(interleave='bip', writable=True)
+    mm[10:12] = mm[10:12] // 2
+    mm.flush()
+    del mm
+    build(vnir, swir, out, checkpoint=True, overviews=[2])
+    fresh = str(tmp_path / 'fresh.hdr')
+    build(vnir, swir, fresh, overviews=[2])
+    assert load_stats(out) == load_stats(fresh)
+    assert envi.read_envi_header(out)['band mean'] == envi.read_envi_header(fresh)['band mean']
+    assert np.array_equal(read_cube(overview_path(out, 2)), read_cube(overview_path(fresh, 2)))
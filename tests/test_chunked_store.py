@@ -0,0 +1,69 @@
+'''
+the chunked store: a cube written block by block reads back the same, whole or in
+any window, and build_cube writes the same fused cube to a store as to ENVI
+'''
+
+import numpy as np
+import pytest
+from conftest import read_cube
+
+
+@pytest.mark.parametrize('codec', ['zlib', 'lz4'])
+def test_store_round_trip(pair, tmp_path, codec):
+    from chunked_store import create_store, open_store, is_store
+    if codec == 'lz4':
+        pytest.importorskip('lz4.frame')
+    data = pair['swir_data']
+    path = str(tmp_path / 'cube.zcube')
+    store = create_store(path, data.shape, data.dtype, metadata={'wavelength': [1.0, 2.0]}, chunks=(8, 16, 50),
+                         codec=codec)
+    assert not is_store(path)
+    for row0 in range(0, data.shape[0], 16):
+        store.write(row0, 0, data[row0:row0 + 16])
+    store.close()
+    assert is_store(path)
+    cube = open_store(path)
+    assert cube.shape == data.shape and cube.dtype == data.dtype
+    assert np.array_equal(cube.read(), data)
+    assert np.array_equal(cube[5:30, 3:20, 40:120], data[5:30, 3:20, 40:120])
+    assert np.array_equal(cube[7, :, -1], data[7, :, -1])
+    assert np.array_equal(cube.wavelengths, [1.0, 2.0])
+    cube.close()
+
+
+def test_unaligned_block_is_refused(tmp_path):
+    from chunked_store import create_store
+    store = create_store(str(tmp_path / 'cube.zcube'), (20, 20, 4), np.uint16, chunks=(8, 8, 4))
+    with pytest.raises(ValueError):
+        store.write(4, 0, np.zeros((8, 20, 4), dtype=np.uint16))
+    with pytest.raises(ValueError):
+        store.write(0, 0, np.zeros((5, 20, 4), dtype=np.uint16))
+    store.write(16, 0, np.zeros((4, 20, 4), dtype=np.uint16))
+
+
+def test_envi_store_round_trip(pair, tmp_path):
+    from chunked_store import envi_to_store, store_to_envi
+    envi_to_store(pair['vnir_hdr'], str(tmp_path / 'vnir.zcube'), chunks=(16, 16, 64))
+    store_to_envi(str(tmp_path / 'vnir.zcube'), str(tmp_path / 'vnir.hdr'), interleave='bsq')
+    assert np.array_equal(read_cube(str(tmp_path / 'vnir.hdr')), pair['vnir_data'])
+
+
+@pytest.mark.parametrize('streamed', [False, True])
+def test_build_cube_to_store(pair, baseline, tmp_path, streamed):
+    # a store of the fused cube holds what the ENVI output does
+    from build_cube import build_cube, build_cube_streamed
+    from chunked_store import open_store
+    out = str(tmp_path / 'full.hdr')
+    if streamed:
+        envi_out = str(tmp_path / 'envi.hdr')
+        build_cube_streamed(pair['vnir'], pair['swir'], envi_out, strip_rows=8)
+        expected = read_cube(envi_out)
+        build_cube_streamed(pair['vnir'], pair['swir'], out, strip_rows=8, output_format='chunked',
+                            chunks=(16, 16, 64))
+    else:
+        expected = baseline
+        build_cube(pair['vnir'], pair['swir'], out, output_format='chunked', chunks=(16, 16, 64))
+    cube = open_store(str(tmp_path / 'full.zcube'))
+    assert np.array_equal(cube.read(), expected)
+    assert cube.scale_factor == 10000
+    cube.close()
@@ -0,0 +1,65 @@
+'''
+the float32 fusion kernel against the original float64 algorithm of build_cube
+(VNIR before the overlap, the overlap blended with the resampled SWIR, the SWIR
+after it), and the rounding and saturation to uint16
+'''
+
+import numpy as np
+from spectral import BandResampler
+from conftest import vnir_wvl, swir_wvl
+
+
+def reference_fusion(vnir, swir, scale_factor=10000):
+    # the fusion as the original build_cube did it, in float64, on reflectance
+    from fusion_plan import get_overlap
+    ov = get_overlap(vnir_wvl, swir_wvl)
+    n1, n2 = vnir.shape[:2]
+    cube1 = vnir[:, :, :ov['last_vnir_b4_overlap']]
+    cube3 = swir[:, :, ov['first_swir_after_overlap']:-1]
+    vnir_overlap = vnir[:, :, ov['vnir_overlap_indices']]
+    swir_overlap = swir[:, :, ov['swir_overlap_indices']].reshape(-1, ov['swir_overlap_indices'].size)
+    resample = BandResampler(ov['swir_overlap'], ov['vnir_overlap']).matrix
+    new_swir = resample.dot(swir_overlap.T).T.reshape(n1, n2, -1)
+    cube2 = vnir_overlap * (1.0 - ov['wgt']) + new_swir * ov['wgt']
+    full = np.concatenate((cube1, cube2, cube3), axis=2) * scale_factor
+    return np.clip(np.rint(full), 0, 65535).astype(np.uint16)
+
+
+def test_kernel_matches_reference(pair):
+    from fusion_plan import FusionPlan
+    vnir = pair['vnir_data'] / 10000.0
+    swir = pair['swir_data'] / 10000.0
+    plan = FusionPlan.build(vnir_wvl, swir_wvl, 10000)
+    fused = plan.apply(vnir.astype(np.float32), swir.astype(np.float32))
+    reference = reference_fusion(vnir, swir)
+    assert fused.shape == reference.shape
+    assert np.abs(fused.astype(np.int32) - reference).max() <= 1
+    assert np.array_equal(plan.out_wvl, FusionPlan.build(vnir_wvl, swir_wvl).out_wvl)
+
+
+def test_kernel_raw_counts(pair):
+    # the raw uint16 counts with their scale factor in the plan give the same cube
+    from fusion_plan import FusionPlan
+    plan = FusionPlan.build(vnir_wvl, swir_wvl, 10000, vnir_scale=10000, swir_scale=10000)
+    fused = plan.apply(pair['vnir_data'], pair['swir_data'])
+    reference = reference_fusion(pair['vnir_data'] / 10000.0, pair['swir_data'] / 10000.0)
+    assert np.abs(fused.astype(np.int32) - reference).max() <= 1
+
+
+def test_quantize_rounds_and_saturates():
+    from fusion_plan import quantize
+    buf = np.array([-3.0, 0.4, 0.6, 2.5, 65534.6, 70000.0, 1e9], dtype=np.float32)
+    out = np.empty(buf.shape, dtype=np.uint16)
+    quantize(buf, out)
+    assert out.tolist() == [0, 0, 1, 2, 65535, 65535, 65535]
+
+
+def test_kernel_saturates_out_of_range_reflectance():
+    # reflectance above 6.5535 saturates instead of wrapping around
+    from fusion_plan import FusionPlan
+    plan = FusionPlan.build(vnir_wvl, swir_wvl, 10000)
+    vnir = np.full((2, 3, vnir_wvl.size), 7.0, dtype=np.float32)
+    swir = np.full((2, 3, swir_wvl.size), -0.5, dtype=np.float32)
+    fused = plan.apply(vnir, swir)
+    assert np.all(fused[:, :, :10] == 65535)
+    assert np.all(fused[:, :, -10:] == 0)
@@ -0,0 +1,88 @@
+'''
+the fusion plan: its cache round trip, its key, and the weights of its operator
+'''
+
+import os
+import numpy as np
+import pytest
+from conftest import vnir_wvl, swir_wvl
+
+
+def test_cached_plan_round_trip(pair, tmp_path):
+    from fusion_plan import FusionPlan
+    plan = FusionPlan.cached(vnir_wvl, swir_wvl, 10000, 10000, 10000, plan_dir=str(tmp_path))
+    files = os.listdir(str(tmp_path))
+    assert len(files) == 1 and files[0].endswith('.npz')
+    loaded = FusionPlan.cached(vnir_wvl, swir_wvl, 10000, 10000, 10000, plan_dir=str(tmp_path))
+    assert loaded.key == plan.key
+    assert (loaded.operator != plan.operator).nnz == 0
+    assert np.array_equal(loaded.out_wvl, plan.out_wvl)
+    assert np.array_equal(loaded.apply(pair['vnir_data'], pair['swir_data']),
+                          plan.apply(pair['vnir_data'], pair['swir_data']))
+
+
+def test_selection_round_trip(tmp_path):
+    from fusion_plan import FusionPlan
+    plan = FusionPlan.build(vnir_wvl, swir_wvl, keep=((400, 900), (1000, 2000)), bin_width=10)
+    path = str(tmp_path / 'plan.npz')
+    plan.save(path)
+    loaded = FusionPlan.load(path)
+    assert loaded.keep == plan.keep and loaded.bin_width == plan.bin_width
+    assert np.array_equal(loaded.out_fwhm, plan.out_fwhm)
+    assert (loaded.operator != plan.operator).nnz == 0
+
+
+def test_plan_key():
+    from fusion_plan import plan_key
+    key = plan_key(vnir_wvl, swir_wvl, 10000)
+    assert key == plan_key(vnir_wvl.copy(), swir_wvl.copy(), 10000)
+    assert key != plan_key(vnir_wvl, swir_wvl, 5000)
+    assert key != plan_key(vnir_wvl, swir_wvl, 10000, swir_scale=1000)
+    assert key != plan_key(vnir_wvl, swir_wvl, 10000, keep=((400, 900),))
+    assert key != plan_key(vnir_wvl[:-1], swir_wvl, 10000)
+
+
+def test_stale_plan_file_is_refused(tmp_path):
+    from fusion_plan import FusionPlan
+    path = str(tmp_path / 'plan.npz')
+    FusionPlan.build(vnir_wvl, swir_wvl).save(path)
+    with np.load(path) as f:
+        fields = dict(f)
+    fields['key'] = 'not the key'
+    np.savez(path, **fields)
+    with pytest.raises(ValueError):
+        FusionPlan.load(path)
+
+
+@pytest.mark.parametrize('damage', ['stale', 'truncated'])
+def test_unusable_cached_plan_is_rebuilt(tmp_path, damage):
+    # cached() rebuilds a plan it cannot use and overwrites the file with a good one
+    from fusion_plan import FusionPlan
+    plan = FusionPlan.cached(vnir_wvl, swir_wvl, 10000, plan_dir=str(tmp_path))
+    path = str(tmp_path / os.listdir(str(tmp_path))[0])
+    if damage == 'stale':
+        with np.load(path) as f:
+            fields = dict(f)
+        fields['key'] = 'not the key'
+        np.savez(path, **fields)
+    else:
+        with open(path, 'r+b') as f:
+            f.truncate(os.path.getsize(path) // 2)
+    rebuilt = FusionPlan.cached(vnir_wvl, swir_wvl, 10000, plan_dir=str(tmp_path))
+    assert rebuilt.key == plan.key
+    assert (rebuilt.operator != plan.operator).nnz == 0
+    assert FusionPlan.load(path).key == plan.key
+
+
+@pytest.mark.parametrize('grids', [(vnir_wvl, swir_wvl),
+                                   # the last VNIR band is beyond the reach of every SWIR band
+                                   (np.round(np.linspace(398, 1002, 120), 3), np.round(np.linspace(899, 2502, 90), 3))])
+def test_operator_weights(grids):
+    # every output band is a weighted average of input bands: finite weights summing to 1
+    from fusion_plan import FusionPlan
+    plan = FusionPlan.build(grids[0], grids[1], 10000)
+    assert np.all(np.isfinite(plan.operator.data))
+    assert np.allclose(np.asarray(plan.operator.sum(axis=1)).ravel(), 10000, rtol=1e-5)
+    vnir = np.full((2, 2, grids[0].size), 0.25, dtype=np.float32)
+    swir = np.full((2, 2, grids[1].size), 0.25, dtype=np.float32)
+    assert np.all(plan.apply(vnir, swir) == 2500)
@@ -0,0 +1,58 @@
+'''
+the homography sidecar: what save_homography writes load_homography reads back, and
+a headless warp with the sidecar, the text file or the matrix gives the same cube
+'''
+
+import json
+import numpy as np
+from conftest import read_cube
+
+
+H = np.array([[0.99, -0.03, 1.5], [0.03, 0.99, -0.7], [1e-5, 0.0, 1.0]])
+
+
+def test_sidecar_round_trip(pair, tmp_path):
+    from coregister_controlpoints_gui import save_homography, load_homography, homography_sidecar_path
+    sidecar = homography_sidecar_path(str(tmp_path / 'swir.hdr'))
+    assert sidecar == str(tmp_path / 'swir_homography.json')
+    vnir_points, swir_points = np.random.default_rng(3).uniform(0, 30, (2, 6, 2))
+    mask = np.array([1, 1, 0, 1, 1, 1])
+    save_homography(sidecar, H, vnir_points, swir_points, mask, 'abc', pair['vnir_hdr'], pair['swir_hdr'],
+                    vnir_shape=(37, 29), swir_shape=(37, 29))
+    record = load_homography(sidecar)
+    assert np.array_equal(record['homography'], H)
+    assert record['key'] == 'abc'
+    assert np.array_equal(record['vnir_points'], vnir_points) and np.array_equal(record['swir_points'], swir_points)
+    assert record['inlier_mask'] == mask.tolist()
+    assert record['vnir_shape'] == [37, 29] and record['swir_shape'] == [37, 29]
+
+    np.savetxt(str(tmp_path / 'H.txt'), H)
+    assert np.array_equal(load_homography(str(tmp_path / 'H.txt'))['homography'], H)
+
+
+def test_resolve_rescales_other_grids(tmp_path):
+    # a sidecar found on 2x binned grids is rescaled; on the same grids it is used as it is
+    from coregister_controlpoints_gui import resolve_homography, rescale_homography
+    sidecar = str(tmp_path / 'swir_homography.json')
+    with open(sidecar, 'w') as f:
+        json.dump({'homography': H.tolist(), 'key': None, 'vnir_shape': [40, 30], 'swir_shape': [20, 16]}, f)
+    assert np.array_equal(resolve_homography(H, (40, 30), (20, 16)), H)
+    assert np.array_equal(resolve_homography(sidecar, (40, 30), (20, 16)), H)
+    M = resolve_homography(sidecar, (80, 60), (40, 32))
+    assert np.allclose(M, rescale_homography(H, (20, 16), (40, 32), (40, 30), (80, 60)))
+    assert not np.allclose(M, H)
+
+
+def test_headless_warp_from_sidecar(pair, tmp_path):
+    from coregister_controlpoints_gui import register_headless, save_homography
+    sidecar = str(tmp_path / 'swir_homography.json')
+    save_homography(sidecar, H, np.zeros((4, 2)), np.zeros((4, 2)), np.ones(4), None, pair['vnir_hdr'],
+                    pair['swir_hdr'], vnir_shape=pair['vnir_data'].shape[:2], swir_shape=pair['swir_data'].shape[:2])
+    np.savetxt(str(tmp_path / 'H.txt'), H)
+    outs = [str(tmp_path / name) for name in ('json.hdr', 'txt.hdr', 'matrix.hdr')]
+    for homography, out in zip([sidecar, str(tmp_path / 'H.txt'), H], outs):
+        register_headless(pair['vnir_hdr'], pair['swir_hdr'], homography, output_path=out)
+    warped = read_cube(outs[0])
+    assert warped.shape[:2] == pair['vnir_data'].shape[:2]
+    assert np.array_equal(read_cube(outs[1]), warped)
+    assert np.array_equal(read_cube(outs[2]), warped)
@@ -0,0 +1,82 @@
+'''
+mosaicking: overlapping pieces of one cube, placed by whole pixels, give the cube
+back; the seams between different cubes are feathered
+'''
+
+import numpy as np
+import pytest
+from conftest import read_cube, write_cube, vnir_wvl
+
+
+def pieces(baseline, tmp_path):
+    # the top and bottom of the fused cube and the left and right of it, overlapping
+    cubes = [(baseline[:25], 0, 0), (baseline[15:], 15, 0), (baseline[:, :20], 0, 0), (baseline[:, 11:], 0, 11)]
+    paths = []
+    for n, (data, row, col) in enumerate(cubes):
+        paths.append((write_cube(str(tmp_path / ('piece%d.hdr' % n)), data, np.arange(data.shape[2])), row, col))
+    return paths
+
+
+@pytest.mark.parametrize('feather', [0, 4])
+@pytest.mark.parametrize('prefetch', [0, 2])
+def test_pieces_give_the_cube(baseline, tmp_path, feather, prefetch):
+    from mosaic_cubes import mosaic_cubes
+    placements = [{'cube': path, 'transform': np.array([[1.0, 0, col], [0, 1, row], [0, 0, 1]])}
+                  for path, row, col in pieces(baseline, tmp_path)]
+    out = str(tmp_path / 'mosaic.hdr')
+    mosaic_cubes(placements, out, feather=feather, strip_rows=8, workers=2, prefetch=prefetch)
+    assert np.array_equal(read_cube(out), baseline)
+
+
+def test_manifest_placements(baseline, tmp_path):
+    # a CSV manifest placing the pieces by row, col or by a transform file
+    from mosaic_cubes import mosaic_cubes, read_placements
+    paths = pieces(baseline, tmp_path)
+    np.savetxt(str(tmp_path / 'T.txt'), [[1, 0, 0], [0, 1, 15], [0, 0, 1]])
+    with open(str(tmp_path / 'mosaic.csv'), 'w') as f:
+        f.write('cube,transform,row,col\npiece0.hdr,,,\npiece1.hdr,T.txt,,\npiece3.hdr,,0,11\n')
+    placements = read_placements(str(tmp_path / 'mosaic.csv'))
+    assert [p['cube'] for p in placements] == [paths[n][0] for n in (0, 1, 3)]
+    assert np.array_equal(placements[1]['transform'], [[1, 0, 0], [0, 1, 15], [0, 0, 1]])
+    out = str(tmp_path / 'mosaic.hdr')
+    mosaic_cubes(placements, out, strip_rows=8)
+    assert np.array_equal(read_cube(out), baseline)
+
+
+def constant_pair(tmp_path, left=1000, right=3000):
+    # two flat cubes of 20 columns, the right one placed 10 columns further; tall
+    # enough that the middle row is beyond the feather of their top and bottom edges
+    a = np.full((16, 20, 4), left, dtype=np.uint16)
+    b = np.full((16, 20, 4), right, dtype=np.uint16)
+    return [{'cube': write_cube(str(tmp_path / 'a.hdr'), a, vnir_wvl[:4]), 'transform': np.eye(3)},
+            {'cube': write_cube(str(tmp_path / 'b.hdr'), b, vnir_wvl[:4]),
+             'transform': np.array([[1.0, 0, 10], [0, 1, 0], [0, 0, 1]])}]
+
+
+def test_feathered_seam(tmp_path):
+    from mosaic_cubes import mosaic_cubes
+    out = str(tmp_path / 'mosaic.hdr')
+    mosaic_cubes(constant_pair(tmp_path), out, feather=5)
+    row = read_cube(out)[8, :, 0].astype(float)
+    assert row.shape == (30,)
+    assert np.all(row[:10] == 1000) and np.all(row[20:] == 3000)
+    # the weight of each cube rises by 1/5 a pixel from its edge, from 0.1 at the edge pixel
+    ramp = np.minimum(np.arange(10) + 0.5, 5) / 5
+    wa, wb = ramp[::-1], ramp
+    assert np.array_equal(row[10:20], np.rint((1000 * wa + 3000 * wb) / (wa + wb)))
+    assert np.all(np.diff(row) >= 0)
+
+    mosaic_cubes(constant_pair(tmp_path), out, feather=0)
+    assert np.all(read_cube(out)[:, 10:20] == 2000)
+
+
+def test_no_data_gets_no_weight(tmp_path):
+    from mosaic_cubes import mosaic_cubes
+    placements = constant_pair(tmp_path)
+    a = np.full((16, 20, 4), 1000, dtype=np.uint16)
+    a[:, 15:] = 0
+    write_cube(placements[0]['cube'], a, vnir_wvl[:4])
+    out = str(tmp_path / 'mosaic.hdr')
+    mosaic_cubes(placements, out, feather=0)
+    mosaic = read_cube(out)
+    assert np.all(mosaic[:, 10:15] == 2000) and np.all(mosaic[:, 15:] == 3000)
@@ -0,0 +1,52 @@
+'''
+the overviews written alongside the fused cube: every pixel of a 1/f overview is the
+rounded mean of its f x f block of the cube, partial blocks at the edges included
+'''
+
+import numpy as np
+import pytest
+import spectral.io.envi as envi
+from conftest import read_cube
+
+
+def reference_overview(cube, f):
+    nrows, ncols = -(-cube.shape[0] // f), -(-cube.shape[1] // f)
+    out = np.empty((nrows, ncols, cube.shape[2]))
+    for i in range(nrows):
+        for j in range(ncols):
+            out[i, j] = cube[i * f:(i + 1) * f, j * f:(j + 1) * f].mean(axis=(0, 1))
+    return np.rint(out).astype(cube.dtype)
+
+
+@pytest.mark.parametrize('interleave', ['bip', 'bil', 'bsq'])
+@pytest.mark.parametrize('strip_rows, workers', [(8, 1), (16, 3)])
+def test_overviews_are_block_means(pair, tmp_path, interleave, strip_rows, workers):
+    from build_cube import build_cube_streamed
+    from overviews import overview_paths
+    out = str(tmp_path / 'full.hdr')
+    build_cube_streamed(pair['vnir'], pair['swir'], out, strip_rows=strip_rows, workers=workers,
+                        interleave=interleave, overviews=[2, 8])
+    cube = read_cube(out)
+    paths = overview_paths(out)
+    assert sorted(paths) == [2, 8]
+    for f, path in paths.items():
+        assert envi.open(path).metadata['interleave'] == interleave
+        assert np.array_equal(read_cube(path), reference_overview(cube, f))
+
+
+def test_in_memory_overviews(pair, baseline, tmp_path):
+    from build_cube import build_cube
+    from overviews import overview_path
+    out = str(tmp_path / 'full.hdr')
+    build_cube(pair['vnir'], pair['swir'], out, overviews=[2, 8])
+    for f in (2, 8):
+        assert np.array_equal(read_cube(overview_path(out, f)), reference_overview(baseline, f))
+
+
+def test_tile_must_start_on_a_block(tmp_path):
+    from overviews import OverviewWriter
+    writer = OverviewWriter(str(tmp_path / 'x.hdr'), (20, 20, 2), {}, [2, 4])
+    with pytest.raises(ValueError):
+        writer.write(6, 0, np.zeros((4, 20, 2), dtype=np.uint16))
+    writer.write(8, 0, np.ones((12, 20, 2), dtype=np.uint16))
+    writer.close()
@@ -0,0 +1,79 @@
+'''
+the bands copied or scaled outside the sparse product give the same fused cube as
+the product over every band
+'''
+
+import numpy as np
+import pytest
+from conftest import read_cube, vnir_wvl, swir_wvl
+
+
+def full_product(plan, vnir, swir):
+    # every output band through the whole operator, as FusionPlan.apply did before
+    from fusion_plan import quantize
+    n1, n2 = vnir.shape[:2]
+    out = np.empty((n1, n2, plan.n_out), dtype=np.uint16)
+    y = plan.operator @ plan.gather(vnir, swir)
+    quantize(y.reshape(plan.n_out, n1, n2), np.moveaxis(out, 2, 0))
+    return out
+
+
+def inputs(pair, dtype):
+    if dtype == 'float32':
+        return (pair['vnir_data'] / np.float32(10000)).astype(dtype), \
+            (pair['swir_data'] / np.float32(10000)).astype(dtype)
+    if dtype == 'int16':
+        # negative counts, which the copy must not pass through
+        return (pair['vnir_data'].astype(dtype) - 300), (pair['swir_data'].astype(dtype) - 300)
+    return pair['vnir_data'].astype(dtype), pair['swir_data'].astype(dtype)
+
+
+@pytest.mark.parametrize('dtype', ['uint16', 'uint8', 'int16', 'float32'])
+@pytest.mark.parametrize('scales', [(10000, 10000), (1000, 10000), (1, 1)])
+@pytest.mark.parametrize('selection', [{}, {'keep': ((400, 950), (1000, 2000))}, {'bin_width': 10}])
+def test_apply_equals_full_product(pair, dtype, scales, selection):
+    from fusion_plan import FusionPlan
+    vnir, swir = inputs(pair, dtype)
+    plan = FusionPlan.build(vnir_wvl, swir_wvl, 10000, scales[0], scales[1], **selection)
+    fused = plan.apply(vnir, swir)
+    assert np.array_equal(fused, full_product(plan, vnir, swir))
+    # on tiles of the used bands only, as the streamed stages read them
+    used = plan.on_used_bands().apply(vnir[:, :, plan.vnir_bands], swir[:, :, plan.swir_bands])
+    assert np.array_equal(used, fused)
+
+
+def test_non_overlap_bands_are_copied(pair):
+    # uint16 counts at the output scale: all but the overlap bands are copies of input bands
+    from fusion_plan import FusionPlan, get_overlap
+    plan = FusionPlan.build(vnir_wvl, swir_wvl, 10000, 10000, 10000)
+    n_overlap = get_overlap(vnir_wvl, swir_wvl)['vnir_overlap_indices'].size
+    assert plan.blend_rows.size == n_overlap
+    runs = plan.direct_runs()
+    assert all(gain == 1 for source, out0, out1, band0, gain in runs)
+    assert sum(out1 - out0 for source, out0, out1, band0, gain in runs) == plan.n_out - n_overlap
+    # the VNIR before the overlap and the SWIR after it, each one run
+    assert [run[0] for run in runs] == [0, 1]
+    fused = plan.apply(pair['vnir_data'], pair['swir_data'])
+    source, out0, out1, band0, gain = runs[0]
+    assert np.array_equal(fused[:, :, out0:out1], pair['vnir_data'][:, :, band0:band0 + out1 - out0])
+
+
+def test_apply_into_out_view(pair):
+    # the output can be a strided view, as a memmapped tile of a BSQ cube is
+    from fusion_plan import FusionPlan
+    plan = FusionPlan.build(vnir_wvl, swir_wvl, 10000, 10000, 10000)
+    out = np.zeros((plan.n_out,) + pair['vnir_data'].shape[:2], dtype=np.uint16)
+    plan.apply(pair['vnir_data'], pair['swir_data'], out=np.moveaxis(out, 0, 2))
+    assert np.array_equal(np.moveaxis(out, 0, 2), plan.apply(pair['vnir_data'], pair['swir_data']))
+
+
+def test_streamed_copies_baseline_bands(pair, baseline, tmp_path):
+    # the copied bands of the streamed cube are those of the in-memory build_cube, bit for bit
+    from build_cube import build_cube_streamed
+    from fusion_plan import FusionPlan
+    out = str(tmp_path / 'full.hdr')
+    build_cube_streamed(pair['vnir'], pair['swir'], out, strip_rows=8)
+    cube = read_cube(out)
+    plan = FusionPlan.build(vnir_wvl, swir_wvl, 10000, 10000, 10000)
+    assert np.array_equal(np.delete(cube, plan.blend_rows, axis=2), np.delete(baseline, plan.blend_rows, axis=2))
+    assert np.abs(cube.astype(np.int32) - baseline).max() <= 1
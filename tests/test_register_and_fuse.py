@@ -0,0 +1,51 @@
+'''
+the single pass (warp and fuse per tile) against the two steps it replaces: the
+headless warp of coregister_controlpoints_gui, then build_cube on the warped SWIR
+'''
+
+import numpy as np
+import pytest
+import spectral.io.envi as envi
+from conftest import read_cube
+
+H = np.array([[0.9994, -0.0349, 1.5], [0.0349, 0.9994, -0.7], [0.0, 0.0, 1.0]])
+
+
+@pytest.fixture(scope='module', params=['linear', 'cubic'])
+def two_steps(request, pair, tmp_path_factory):
+    from coregister_controlpoints_gui import register_headless
+    from build_cube import build_cube_streamed
+    tmp = tmp_path_factory.mktemp('two_steps')
+    warped, fused = str(tmp / 'warped.hdr'), str(tmp / 'fused.hdr')
+    register_headless(pair['vnir_hdr'], pair['swir_hdr'], H, output_path=warped, interpolation=request.param)
+    build_cube_streamed(pair['vnir'], warped[:-4], fused)
+    return request.param, read_cube(warped), read_cube(fused)
+
+
+@pytest.mark.parametrize('strip_rows, workers', [(256, 1), (8, 3)])
+def test_single_pass_equals_two_steps(pair, two_steps, tmp_path, strip_rows, workers):
+    from register_and_fuse import register_and_fuse
+    interpolation, warped, fused = two_steps
+    out, warped_out = str(tmp_path / 'fused.hdr'), str(tmp_path / 'warped.hdr')
+    register_and_fuse(pair['vnir_hdr'], pair['swir_hdr'], H, out, warped_outfilehdr=warped_out,
+                      strip_rows=strip_rows, workers=workers, interpolation=interpolation)
+    assert np.array_equal(read_cube(warped_out), warped)
+    # the warped SWIR is laid out like the one of the headless warp
+    assert envi.read_envi_header(warped_out)['interleave'] == 'bsq'
+    assert np.array_equal(read_cube(out), fused)
+
+
+def test_fusion_api_equals_two_steps(pair, two_steps):
+    from fusion_api import fuse
+    interpolation, warped, fused = two_steps
+    assert np.array_equal(fuse(pair['vnir_hdr'], pair['swir_hdr'], homography=H, interpolation=interpolation), fused)
+
+
+def test_fusion_api_band_selection(pair, tmp_path):
+    # fuse() reads only the bands a selection uses and gives the cube build_cube does
+    from fusion_api import fuse
+    from build_cube import build_cube_streamed
+    keep = ((500, 900), (1000, 2000))
+    out = str(tmp_path / 'kept.hdr')
+    build_cube_streamed(pair['vnir'], pair['swir'], out, keep=keep)
+    assert np.array_equal(fuse(pair['vnir_hdr'], pair['swir_hdr'], keep=keep), read_cube(out))
@@ -0,0 +1,95 @@
+'''
+regions of interest: parsing and clipping the window, and the fused or warped
+window against the same window of the whole scene
+'''
+
+import numpy as np
+import pytest
+import spectral.io.envi as envi
+from conftest import read_cube, nrows, ncols
+
+
+def test_parse_roi():
+    from tile_executor import parse_roi
+    assert parse_roi('1:5,2:7') == (1, 5, 2, 7)
+    assert parse_roi(':5,3:') == (None, 5, 3, None)
+    assert parse_roi(' : , : ') == (None, None, None, None)
+    for text in ['1:5', '1:5,2', '1:5,2:7,3:4', 'a:b,1:2']:
+        with pytest.raises(ValueError):
+            parse_roi(text)
+
+
+def test_roi_window():
+    from tile_executor import roi_window
+    assert roi_window(None, 10, 20) == (0, 10, 0, 20)
+    assert roi_window((2, None, None, 5), 10, 20) == (2, 10, 0, 5)
+    assert roi_window((-3, 50, 4, 100), 10, 20) == (0, 10, 4, 20)
+    for roi in [(10, 12, 0, 5), (3, 3, 0, 5), (0, 5, 25, 30)]:
+        with pytest.raises(ValueError):
+            roi_window(roi, 10, 20)
+
+
+def test_crop_metadata():
+    from tile_executor import crop_metadata
+    md = {'map info': ['UTM', '1', '1', '500000', '4000000', '0.5', '0.5'], 'bands': '3'}
+    cropped = crop_metadata(md, (4, 9, 2, 6))
+    assert cropped['map info'][1:3] == ['-1', '-3']
+    assert cropped['map info'][3:] == md['map info'][3:]
+    assert cropped['roi'] == ['4', '9', '2', '6']
+    assert md['map info'][1] == '1'
+
+
+@pytest.fixture(scope='module')
+def streamed(pair, tmp_path_factory):
+    from build_cube import build_cube_streamed
+    out = str(tmp_path_factory.mktemp('streamed') / 'full.hdr')
+    build_cube_streamed(pair['vnir'], pair['swir'], out)
+    return read_cube(out)
+
+
+@pytest.mark.parametrize('roi, window', [((5, 30, 3, 20), (5, 30, 3, 20)), ((None, 9, 11, None), (0, 9, 11, ncols))])
+def test_build_cube_roi(pair, streamed, tmp_path, roi, window):
+    from build_cube import build_cube_streamed
+    out = str(tmp_path / 'roi.hdr')
+    build_cube_streamed(pair['vnir'], pair['swir'], out, strip_rows=8, roi=roi)
+    row0, row1, col0, col1 = window
+    assert np.array_equal(read_cube(out), streamed[row0:row1, col0:col1])
+    md = envi.open(out).metadata
+    assert md['roi'] == [str(v) for v in window]
+    assert md['map info'][1:3] == ['%g' % (1 - col0), '%g' % (1 - row0)]
+
+
+def test_fusion_api_roi(pair, streamed):
+    from fusion_api import fuse
+    assert np.array_equal(fuse(pair['vnir_hdr'], pair['swir_hdr'], roi='5:30,3:20', strip_rows=8),
+                          streamed[5:30, 3:20])
+
+
+@pytest.fixture(scope='module')
+def homography(pair):
+    # a small rotation and shift of the SWIR grid (on top of the flip the warp folds in)
+    a = np.deg2rad(2.0)
+    H = np.array([[np.cos(a), -np.sin(a), 1.5], [np.sin(a), np.cos(a), -0.7], [0, 0, 1]])
+    path = str(pair['dir'] / 'H.txt')
+    np.savetxt(path, H)
+    return path
+
+
+def test_register_and_fuse_roi(pair, homography, tmp_path):
+    from register_and_fuse import register_and_fuse
+    full, roi = str(tmp_path / 'full.hdr'), str(tmp_path / 'roi.hdr')
+    register_and_fuse(pair['vnir_hdr'], pair['swir_hdr'], homography, full, warped_outfilehdr=str(tmp_path / 'fw.hdr'))
+    register_and_fuse(pair['vnir_hdr'], pair['swir_hdr'], homography, roi, warped_outfilehdr=str(tmp_path / 'rw.hdr'),
+                      strip_rows=8, roi=(5, 30, 3, 20))
+    assert np.array_equal(read_cube(roi), read_cube(full)[5:30, 3:20])
+    assert np.array_equal(read_cube(str(tmp_path / 'rw.hdr')), read_cube(str(tmp_path / 'fw.hdr'))[5:30, 3:20])
+
+
+def test_headless_warp_roi(pair, homography, tmp_path):
+    from coregister_controlpoints_gui import register_headless
+    full, roi = str(tmp_path / 'full.hdr'), str(tmp_path / 'roi.hdr')
+    register_headless(pair['vnir_hdr'], pair['swir_hdr'], homography, output_path=full)
+    register_headless(pair['vnir_hdr'], pair['swir_hdr'], homography, output_path=roi, strip_rows=8,
+                      roi=(5, 30, 3, 20))
+    assert read_cube(roi).shape == (25, 17, 267)
+    assert np.array_equal(read_cube(roi), read_cube(full)[5:30, 3:20])
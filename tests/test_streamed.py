@@ -0,0 +1,65 @@
+'''
+the streamed build_cube against the in-memory one. The in-memory build blends the
+reflectance spectral's load() gives, the streamed one the raw counts, so the blended
+overlap bands may differ by 1 in the last digit; every other band is the same. Any
+strip height, column tiling, number of threads and interleave gives the same cube.
+'''
+
+import numpy as np
+import pytest
+import spectral.io.envi as envi
+from conftest import read_cube, write_cube, vnir_wvl, swir_wvl
+
+
+def assert_matches_baseline(cube, baseline):
+    from fusion_plan import FusionPlan
+    plan = FusionPlan.build(vnir_wvl, swir_wvl, 10000, 10000, 10000)
+    assert cube.shape == baseline.shape
+    diff = np.abs(cube.astype(np.int32) - baseline)
+    assert diff.max() <= 1
+    assert np.array_equal(np.delete(cube, plan.blend_rows, axis=2), np.delete(baseline, plan.blend_rows, axis=2))
+
+
+@pytest.fixture(scope='module')
+def streamed(pair, tmp_path_factory):
+    from build_cube import build_cube_streamed
+    out = str(tmp_path_factory.mktemp('streamed') / 'full.hdr')
+    build_cube_streamed(pair['vnir'], pair['swir'], out)
+    return read_cube(out)
+
+
+def test_streamed_matches_in_memory(streamed, baseline):
+    assert_matches_baseline(streamed, baseline)
+
+
+@pytest.mark.parametrize('strip_rows, tile_cols, workers, prefetch',
+                         [(1, 0, 1, 0), (8, 0, 3, 0), (5, 7, 2, 0), (8, 0, 2, 2)])
+def test_streamed_tiling(pair, streamed, tmp_path, strip_rows, tile_cols, workers, prefetch):
+    from build_cube import build_cube_streamed
+    out = str(tmp_path / 'full.hdr')
+    build_cube_streamed(pair['vnir'], pair['swir'], out, strip_rows=strip_rows, tile_cols=tile_cols,
+                        workers=workers, prefetch=prefetch)
+    assert np.array_equal(read_cube(out), streamed)
+
+
+@pytest.mark.parametrize('interleave', ['bsq', 'bil', 'bip'])
+def test_streamed_interleaves(pair, streamed, tmp_path, interleave):
+    # the inputs and the output in any interleave
+    from build_cube import build_cube_streamed
+    vnir = write_cube(str(tmp_path / 'vnir.hdr'), pair['vnir_data'], vnir_wvl, interleave=interleave)
+    swir = write_cube(str(tmp_path / 'swir.hdr'), pair['swir_data'], swir_wvl, interleave=interleave)
+    out = str(tmp_path / 'full.hdr')
+    build_cube_streamed(vnir[:-4], swir[:-4], out, strip_rows=8, interleave=interleave)
+    assert envi.open(out).metadata['interleave'] == interleave
+    assert np.array_equal(read_cube(out), streamed)
+
+
+def test_streamed_header(pair, tmp_path):
+    from build_cube import build_cube_streamed
+    out = str(tmp_path / 'full.hdr')
+    build_cube_streamed(pair['vnir'], pair['swir'], out)
+    md = envi.open(out).metadata
+    wvl = np.array([float(w) for w in md['wavelength']])
+    assert int(md['bands']) == wvl.size == read_cube(out).shape[2]
+    assert np.all(np.diff(wvl) > 0)
+    assert float(md['reflectance scale factor']) == 10000
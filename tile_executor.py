@@ -0,0 +1,212 @@
+'''
++
+=======================================================================
+
+ NAME:
+      tile_executor
+
+ DESCRIPTION:
+	splits a scene into spatial tiles and runs a per-tile function over them,
+either serially or on a pool of threads.
+- the tile grid depends only on the tile size, never on the number of workers, so
+the serial and the threaded runs give the same output
+- each tile writes into its own region of the output, so no locking is needed;
+numpy releases the GIL in the heavy work, so threads keep all the cores busy
+- tile_cols_for keeps the tiles full width unless every file is BIP: a row of a
+BSQ or BIL file is one contiguous run per band, which column tiles would cut up
+- run_pipeline overlaps the I/O with the compute: a reader thread reads the next
+tiles and a writer thread writes the finished ones, with at most `depth` tiles
+waiting between the steps
+- parse_roi / roi_window give the region of interest (row0:row1,col0:col1) the tools
+process instead of the whole scene, and crop_metadata the header of such a window
+
+ USES:
+
+concurrent.futures
+numpy
+queue, threading
+threadpoolctl (optional, keeps BLAS from starting its own threads inside each worker)
+
+ HISTORY:
+2026/10/17: created for the multi-threaded tile fusion in build_cube
+
+=======================================================================
+-
+'''
+
+from concurrent.futures import ThreadPoolExecutor
+import contextlib
+import queue
+import threading
+import numpy as np
+
+try:
+    from threadpoolctl import threadpool_limits
+except ImportError:
+    threadpool_limits = None
+
+
+def iter_tiles(nrows, ncols, tile_rows, tile_cols=None):
+    # (row0, row1, col0, col1) in row-major order; full width strips by default
+    if tile_cols is None or tile_cols <= 0:
+        tile_cols = ncols
+    for row0 in range(0, nrows, tile_rows):
+        for col0 in range(0, ncols, tile_cols):
+            yield (row0, min(row0 + tile_rows, nrows), col0, min(col0 + tile_cols, ncols))
+
+
+def parse_roi(text):
+    '''
+    'row0:row1,col0:col1' -> (row0, row1, col0, col1), ends as in python slices
+    (exclusive); a bound left out is None, e.g. '100:400,:' for rows 100 to 399.
+    '''
+    try:
+        rows, cols = text.split(',')
+        bounds = [int(v) if v.strip() else None for part in (rows, cols) for v in part.split(':')]
+    except ValueError:
+        raise ValueError('a region of interest is given as row0:row1,col0:col1, not ' + repr(text))
+    if len(bounds) != 4:
+        raise ValueError('a region of interest is given as row0:row1,col0:col1, not ' + repr(text))
+    return tuple(bounds)
+
+
+def roi_window(roi, nrows, ncols):
+    # (row0, row1, col0, col1) of roi clipped to a nrows x ncols scene, the whole scene for None
+    if roi is None:
+        return (0, nrows, 0, ncols)
+    row0, row1, col0, col1 = roi
+    window = (max(row0 or 0, 0), nrows if row1 is None else min(row1, nrows),
+              max(col0 or 0, 0), ncols if col1 is None else min(col1, ncols))
+    if window[0] >= window[1] or window[2] >= window[3]:
+        raise ValueError('the region of interest %s is outside the %d x %d scene' % (tuple(roi), nrows, ncols))
+    return window
+
+
+def crop_metadata(metadata, window):
+    # the ENVI header of a window of a scene: its map info moves to the window's first
+    # pixel, and the window is recorded as 'roi' (row0, row1, col0, col1)
+    md = dict(metadata)
+    row0, row1, col0, col1 = window
+    if md.get('map info'):
+        info = list(md['map info'])
+        # the reference pixel is 1-based, in file columns and rows
+        info[1], info[2] = '%g' % (float(info[1]) - col0), '%g' % (float(info[2]) - row0)
+        md['map info'] = info
+    md['roi'] = [str(v) for v in window]
+    return md
+
+
+def round_up(size, *steps):
+    # a tile size rounded up to a multiple of every step (0, the full extent, stays 0)
+    step = int(np.lcm.reduce([int(s) for s in steps])) if steps else 1
+    return -(-size // step) * step if size else size
+
+
+def tile_cols_for(interleaves, tile_cols):
+    # the tile width to use for files with these ENVI interleaves ('bsq', 'bil', 'bip')
+    if tile_cols and any(il.lower() != 'bip' for il in interleaves):
+        print('---> not a BIP file, using full width strips instead of', tile_cols, 'column tiles')
+        return 0
+    return tile_cols
+
+
+def run_tiles(tiles, process_tile, workers=1):
+    '''
+    Calls process_tile(tile) for every tile, on `workers` threads if workers > 1.
+    Returns the list of results in tile order; an exception in any tile is
+    raised here.
+    '''
+    tiles = list(tiles)
+    if workers is None or workers <= 1:
+        return [process_tile(tile) for tile in tiles]
+
+    # the pool already uses every core, so stop BLAS from oversubscribing them
+    if threadpool_limits is not None:
+        limits = threadpool_limits(limits=1, user_api='blas')
+    else:
+        limits = contextlib.nullcontext()
+    with limits, ThreadPoolExecutor(max_workers=workers) as pool:
+        return list(pool.map(process_tile, tiles))
+
+
+def run_pipeline(tiles, read, compute, write, workers=1, depth=2):
+    '''
+    Calls write(tile, compute(tile, read(tile))) for every tile with the three
+    steps overlapped: one thread reads, `workers` threads compute and one thread
+    writes, handing the tiles on through queues of at most `depth` tiles (depth=2
+    is double buffering), so no more than 2 * depth + workers + 2 tiles are held at
+    a time. read must load the tile's data (not return lazy memmap views), and
+    write must not depend on the order the tiles arrive in. An exception in any
+    step stops the others and is raised here.
+    '''
+    tiles = list(tiles)
+    workers = max(workers or 1, 1)
+    to_compute, to_write = queue.Queue(maxsize=depth), queue.Queue(maxsize=depth)
+    failed, stop, done = [], threading.Event(), object()
+
+    def put(q, item):
+        while not stop.is_set():
+            try:
+                q.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def get(q):
+        while not stop.is_set():
+            try:
+                return q.get(timeout=0.1)
+            except queue.Empty:
+                pass
+        return done
+
+    def step(body):
+        def run():
+            try:
+                body()
+            except BaseException as e:
+                failed.append(e)
+                stop.set()
+        return threading.Thread(target=run, daemon=True)
+
+    def reader():
+        for tile in tiles:
+            if not put(to_compute, (tile, read(tile))):
+                return
+        for _ in range(workers):
+            put(to_compute, done)
+
+    def computer():
+        while True:
+            item = get(to_compute)
+            if item is done:
+                put(to_write, done)
+                return
+            tile, data = item
+            if not put(to_write, (tile, compute(tile, data))):
+                return
+
+    def writer():
+        finished = 0
+        while finished < workers:
+            item = get(to_write)
+            if item is done:
+                if stop.is_set():
+                    return
+                finished += 1
+                continue
+            write(*item)
+
+    if threadpool_limits is not None and workers > 1:
+        limits = threadpool_limits(limits=1, user_api='blas')
+    else:
+        limits = contextlib.nullcontext()
+    threads = [step(reader), step(writer)] + [step(computer) for _ in range(workers)]
+    with limits:
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+    if failed:
+        raise failed[0]